@@ -0,0 +1,97 @@
+"""This file contains a compact representation of the samples of InputQuery.get_TransformerCube_Input. A sample dictionary
+   stores the window three times (past, future and full_traj, float64) and its neighbor mask twice plus two sequence masks,
+   but all of them are slices or paddings of the full trajectory. CompactSample stores only the trajectory (float32), the
+   neighbor mask (uint8) and the split point, and derives the other entries when they are read, so pickles and memory
+   shrink to about a fifth while code that reads sample['past'], sample['future_neighMask'], ... keeps working. buildDataset
+   (see dataset.py) keeps them compact and derives the views of each element in the input pipeline.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+
+
+# entries of a sample, in the order of InputQuery.get_TransformerCube_Input
+SAMPLE_KEYS = ('past', 'past_neighMask', 'past_seqMask', 'future', 'future_neighMask', 'future_seqMask', 'full_traj',
+               'origin', 'origin_yaw', 'agent_id', 'scene', 'map_name', 'ego_id')
+# entries stored as they are
+INFO_KEYS = ('origin', 'origin_yaw', 'agent_id', 'scene', 'map_name', 'ego_id')
+
+
+def padded_view(traj, mask, start, end, length):
+    """ traj[start: end] and its neighbor and sequence masks, padded to length steps (see split_trajectory) """
+    padding = length - (end - start)
+    values = traj[..., start: end, :, :]
+    neigh_mask = mask[..., start: end, :].astype(np.float64)
+    seq_mask = np.zeros(length)
+    if padding > 0:
+        values = np.concatenate([values, np.zeros(values.shape[:-3] + (padding,) + values.shape[-2:], dtype=values.dtype)], axis=-3)
+        neigh_mask = np.concatenate([neigh_mask, np.ones(neigh_mask.shape[:-2] + (padding,) + neigh_mask.shape[-1:])], axis=-2)
+        seq_mask[end - start:] = 1
+    return values, neigh_mask, seq_mask
+
+
+def split_trajectory(traj, mask, split):
+    """
+    past and future views of trajectories, the same InputQuery.split_input returns: the past is traj[:split] and the future
+    traj[split - 1:] (it starts at the last point of the past), the shorter one padded with zeros and masked to the length
+    of the other one. Leading dimensions are treated as a batch, so it can be used on batches of samples (e.g. inside a
+    tf.numpy_function of the input pipeline).
+    :param traj  : (..., S, N, F) trajectories
+    :param mask  : (..., S, N) neighbor mask, 1 for padded positions
+    :param split : length of the past (inp_seq_l)
+    :return      : past, past_neighMask, past_seqMask, future, future_neighMask, future_seqMask
+    """
+    seq_l = traj.shape[-3]
+    length = max(split, seq_l - split + 1)
+    return padded_view(traj, mask, 0, split, length) + padded_view(traj, mask, split - 1, seq_l, length)
+
+
+class CompactSample(Mapping):
+    """
+    read only sample dictionary backed by the trajectory (S, N, 5) float32, the neighbor mask (S, N) uint8 and the split
+    point (inp_seq_l). Derived entries are rebuilt each time they are read (see split_trajectory), they are not kept.
+    """
+    def __init__(self, traj, mask, split, info: dict):
+        self.traj = np.asarray(traj, dtype=np.float32)
+        self.mask = np.asarray(mask, dtype=np.uint8)
+        self.split = int(split)
+        self.info = info
+
+    @classmethod
+    def from_sample(cls, sample, inp_seq_l):
+        """ compact form of a sample dictionary of InputQuery.get_TransformerCube_Input """
+        return cls(sample['full_traj'], cls.full_mask(sample, inp_seq_l), inp_seq_l, {key: sample[key] for key in INFO_KEYS})
+
+    @staticmethod
+    def full_mask(sample, inp_seq_l):
+        """ neighbor mask of the full trajectory of a sample dictionary """
+        tar_l = len(sample['full_traj']) - inp_seq_l
+        return np.concatenate([sample['past_neighMask'][:inp_seq_l], sample['future_neighMask'][1: tar_l + 1]], axis=0)
+
+    def __len__(self):
+        return len(SAMPLE_KEYS)
+
+    def __iter__(self):
+        return iter(SAMPLE_KEYS)
+
+    def __getitem__(self, key):
+        if key in self.info:
+            return self.info[key]
+        if key == 'full_traj':
+            return self.traj
+        if key not in SAMPLE_KEYS:
+            raise KeyError(key)
+        # only the past or the future half is built
+        position = SAMPLE_KEYS.index(key)
+        seq_l = len(self.traj)
+        length = max(self.split, seq_l - self.split + 1)
+        start, end = (0, self.split) if position < 3 else (self.split - 1, seq_l)
+        return padded_view(self.traj, self.mask, start, end, length)[position % 3]
+
+    def to_dict(self):
+        """ sample dictionary with all the entries """
+        views = split_trajectory(self.traj, self.mask, self.split)
+        sample = dict(zip(SAMPLE_KEYS[:6], views))
+        sample['full_traj'] = self.traj
+        sample.update(self.info)
+        return {key: sample[key] for key in SAMPLE_KEYS}
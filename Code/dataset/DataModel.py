@@ -5,6 +5,9 @@
 import matplotlib.pyplot as plt
 from ysdc_dataset_api.utils import get_to_track_frame_transform, read_scene_from_file, VehicleTrack
 from ysdc_dataset_api.features import FeatureRenderer
+from Code.dataset.TrajectoryStore import TrajectoryStore, ColumnarTimesteps
+from Code.dataset.Vocabulary import Vocabulary
+from Code.dataset.NeighborSlotCache import NeighborSlotCache
 import numpy as np
 
 
@@ -23,11 +26,40 @@ class Agent:
         self.indexes = []
         self.map_name = map_name
         self.timesteps = {}             # dict of steps in time
+        self._step_index = None         # (ordered step ids, step_id -> position), see step_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_step_index'] = None
+        return state
 
     def add_step(self, step_id, step):
         if self.timesteps.get(step_id) is None:
             self.timesteps[step_id] = step
 
+    def step_index(self):
+        """
+        positional index of the timesteps of the agent, built once and rebuilt only if new steps were added.
+        :return: (int32 array with the step ids in order, dictionary step_id -> position in that array)
+        """
+        timesteps = self.timesteps
+        if isinstance(timesteps, ColumnarTimesteps):
+            return timesteps.step_ids(), timesteps.positions()
+        index = getattr(self, '_step_index', None)
+        # steps are never removed, so a different length means that steps were added
+        if index is None or len(index[0]) != len(timesteps):
+            step_ids = np.fromiter(timesteps.keys(), dtype=np.int32, count=len(timesteps))
+            index = (step_ids, {step_id: i for i, step_id in enumerate(timesteps)})
+            self._step_index = index
+        return index
+
+    def step_column(self, field):
+        """ array with the value of a timestep attribute (x, y, rot, ...) for every step of the agent, in step order """
+        if isinstance(self.timesteps, ColumnarTimesteps):
+            return self.timesteps.column(field)
+        return np.fromiter((getattr(step, field) for step in self.timesteps.values()), dtype=np.float64,
+                           count=len(self.timesteps))
+
     def init_neighbors(self):
         return {self.agent_id: 1}
 
@@ -53,8 +85,11 @@ class Context:
         self.context_id = context_id
         self.neighbors = {}
         self.non_pred_neighbors = {}
-        self.humans = {}
-        self.objects = {}
+        # (n, 2) float32 x, y of the humans, objects and non prediction neighbors (in the order of non_pred_neighbors) of the
+        # context, filled only by loaders that read them (see NuscenesLoader.load_context_categories)
+        self.humans = np.zeros((0, 2), dtype=np.float32)
+        self.objects = np.zeros((0, 2), dtype=np.float32)
+        self.non_pred_positions = np.zeros((0, 2), dtype=np.float32)
         self.map = location
 
     def add_pred_neighbor(self, agent_id):
@@ -330,13 +365,33 @@ class Dataset:
 
     self.non_pred_agents is a dictionary similar to self.agents, but these are agents that are not candidates to a trajectory
     prediction (depends on the dataset to determine the ones that are and the ones that are not candidates)
+
+    All the ids (keys of the dictionaries above, Context.neighbors, Agent.timesteps, Agent.ego_id) are dense ints. The loaders
+    intern the external tokens once at load time in self.agent_vocab (agents and non prediction agents), self.context_vocab
+    (contexts / timesteps) and self.scene_vocab (ego vehicles), that keep the reverse table to export them.
+
+    self.store is None until compact() is called. After that, the timesteps of every agent live in a TrajectoryStore and
+    agent.timesteps is a read only view over it (see TrajectoryStore.py), so no more steps can be added.
+
+    self.slot_cache memoizes get_agent_neighbors by (agent, window). It is not pickled with the dataset, the Loader stores it
+    in its own file next to the dataset pickle (see Loader.save_slot_cache).
     """
     def __init__(self, verbose=True):
         self.agents = {}
         self.non_pred_agents = {}
-        self.contexts: {str: Context} = {}
-        self.ego_vehicles: dict[str] = {}
+        self.contexts: {int: Context} = {}
+        self.ego_vehicles: dict[int] = {}
+        self.agent_vocab = Vocabulary()
+        self.context_vocab = Vocabulary()
+        self.scene_vocab = Vocabulary()
         self.verbose = verbose
+        self.store: TrajectoryStore = None
+        self.slot_cache = NeighborSlotCache()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['slot_cache'] = None
+        return state
 
     def add_agent(self, agent_id, agent):
         if self.agents.get(agent_id) is None:
@@ -352,81 +407,187 @@ class Dataset:
         if self.ego_vehicles.get(ego_id) is None:
             self.ego_vehicles[ego_id] = egovehicle
 
-    def insert_context_neighbor(self, agent_id: str, context_id: str):
+    def insert_context_neighbor(self, agent_id: int, context_id: int):
         self.contexts[context_id].add_pred_neighbor(agent_id)
 
-    # get index of start and end of a trajectory for the ego vehicle
-    def get_trajectories_indexes(self, use_ego_vehicles=True, L=-1, overlap=0, min_neighbors=0):
+    def compact(self):
         """
-        get trajectories indexes (multiple trajectories can be obtained from a scene). This function gets the start and end
-        indexes of each subtrajectory of the scene trajectory
+        move the timesteps of all the agents (ego vehicles, agents and non prediction agents) to a columnar TrajectoryStore
+        and replace each agent.timesteps dictionary by a view over the store.
+        :return: TrajectoryStore
+        """
+        if getattr(self, 'store', None) is not None:
+            return self.store
+        all_agents = [agent for collection in (self.ego_vehicles, self.agents, self.non_pred_agents)
+                      for agent in collection.values()]
+        self.store = TrajectoryStore.from_agents(all_agents)
+        for agent_index, agent in enumerate(all_agents):
+            agent.timesteps = ColumnarTimesteps(self.store, agent_index)
+        print('[MSG] dataset compacted to', len(self.store), 'rows') if self.verbose else None
+        return self.store
+
+    def neighbor_counts(self):
+        """
+        number of prediction neighbors of each context, computed once the dataset is compacted (read only).
+        :return: int32 array indexed by context id
+        """
+        counts = getattr(self, '_neighbor_counts', None)
+        if counts is None and hasattr(self.contexts, 'neighbor_counts'):
+            # contexts opened from disk (see DatasetFile.py)
+            counts = self._neighbor_counts = self.contexts.neighbor_counts()
+        if counts is None or len(counts) != len(self.context_vocab):
+            counts = np.zeros(len(self.context_vocab), dtype=np.int32)
+            for context_id, context in self.contexts.items():
+                counts[context_id] = len(context.neighbors)
+            if getattr(self, 'store', None) is not None:
+                self._neighbor_counts = counts
+        return counts
+
+    def get_trajectory_windows(self, use_ego_vehicles=True, L=-1, overlap=0, min_neighbors=0, ego_ids=None):
+        """
+        get the start and end indexes of each subtrajectory (window) of all the ego vehicles at once. Windows are taken
+        every L - overlap points, but a window whose start has less than min_neighbors neighbors is moved forward point by
+        point until it has enough neighbors.
         :param use_ego_vehicles: use real ego_vehicles if True, else use each agent of self.agents as ego vehicle.
         :param L               : lenght of the trajectory. If -1, use all the points in trajectory
         :param overlap         : number of overlap points between subtrajectories of the main trajectory. 0 means no overlap,
                                  so if a trajectory contains 40 points, and L=20, indexes are going to be [(0, 20), (20, 40)]
         :param min_neighbors   : minimum number of neighbors an ego-vehicle starting point needs to have to be considered.
-        :return                : None
+        :param ego_ids         : ids of the ego vehicles to use (e.g. a single scene). If None, use all of them
+        :return                : int32 array (windows, 3) with rows (ego_id, start, end), sorted by ego vehicle and start
         """
         ego_vehicles: dict = self.ego_vehicles if use_ego_vehicles else self.agents
-        for ego_id, ego_vehicle in ego_vehicles.items():
-            timesteps = list(ego_vehicle.timesteps.keys())
-            if L == -1:
-                ego_vehicle.indexes.append((0, len(timesteps)))
-            else:
-                start, end = 0, L
-                while end <= len(timesteps):
-                    # verify if start has enough neighbors as requested
-                    if len(self.contexts[timesteps[start]].neighbors) < min_neighbors:
-                        start += 1
-                        end += 1
-                        continue
-                    # verify if trajectory can be built
-                    if end <= len(timesteps):
-                        ego_vehicle.indexes.append((start, end))
-                        start = end - overlap
-                        end = start + L
-
-    def get_agent_neighbors(self, agent: Agent, kth_traj):
-        if len(agent.indexes) == 0:
+        if ego_ids is None:
+            ego_ids = np.fromiter(ego_vehicles.keys(), dtype=np.int32, count=len(ego_vehicles))
+        else:
+            ego_ids = np.asarray(ego_ids, dtype=np.int32).reshape(-1)
+        step_ids = [ego_vehicles[ego_id].step_index()[0] for ego_id in ego_ids.tolist()]
+        lengths = np.fromiter((len(steps) for steps in step_ids), dtype=np.int64, count=len(step_ids))
+        if L == -1:
+            return np.stack([ego_ids, np.zeros_like(ego_ids), lengths.astype(np.int32)], axis=1)
+        if L - overlap <= 0:
+            raise ValueError('overlap should be smaller than L')
+
+        # steps of all the ego vehicles in a single flat array, ego vehicle a owns [offsets[a], offsets[a + 1])
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        frames = np.concatenate(step_ids) if len(step_ids) > 0 else np.zeros(0, dtype=np.int32)
+        total = len(frames)
+        # next_valid[i] = first position >= i whose context has enough neighbors. Positions of the following ego vehicles
+        # are >= offsets[a + 1], so they are rejected by the length check below. next_valid[total] is a sentinel
+        positions = np.where(self.neighbor_counts()[frames] >= min_neighbors, np.arange(total), total)
+        next_valid = np.append(np.minimum.accumulate(positions[::-1])[::-1], total)
+
+        # move the windows of all the ego vehicles at the same time, one window per iteration
+        egos = np.arange(len(ego_ids))
+        starts = next_valid[offsets[:-1]]
+        windows_ego, windows_start = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        while len(egos) > 0:
+            valid = starts + L <= offsets[egos + 1]
+            egos, starts = egos[valid], starts[valid]
+            windows_ego.append(egos)
+            windows_start.append(starts - offsets[egos])
+            starts = next_valid[np.minimum(starts + L - overlap, total)]
+
+        windows_ego = np.concatenate(windows_ego)
+        windows_start = np.concatenate(windows_start)
+        order = np.lexsort((windows_start, windows_ego))
+        windows_start = windows_start[order].astype(np.int32)
+        return np.stack([ego_ids[windows_ego[order]], windows_start, windows_start + L], axis=1)
+
+    # get index of start and end of a trajectory for the ego vehicle
+    def get_trajectories_indexes(self, use_ego_vehicles=True, L=-1, overlap=0, min_neighbors=0, ego_ids=None):
+        """
+        get trajectories indexes (multiple trajectories can be obtained from a scene). This function gets the start and end
+        indexes of each subtrajectory of the scene trajectory and stores them in ego_vehicle.indexes, replacing the ones of
+        previous calls. See get_trajectory_windows for the parameters.
+        :return                : int32 array of windows (see get_trajectory_windows)
+        """
+        ego_vehicles: dict = self.ego_vehicles if use_ego_vehicles else self.agents
+        windows = self.get_trajectory_windows(use_ego_vehicles, L, overlap, min_neighbors, ego_ids)
+        # cleared in place, the lists of a lazy dataset outlive its agent objects (see DatasetFile.LazyAgents)
+        for ego_id in (ego_vehicles.keys() if ego_ids is None else np.asarray(ego_ids).reshape(-1).tolist()):
+            ego_vehicles[ego_id].indexes.clear()
+        for ego_id, start, end in windows.tolist():
+            ego_vehicles[ego_id].indexes.append((start, end))
+        return windows
+
+    def get_agent_neighbors(self, agent: Agent, kth_traj, window=None, priority=None):
+        """
+        get the position (slot) of each neighbor of the agent in a window. Slots are given in order of first appearance,
+        except for the neighbors in priority (e.g. the nearest ones, see SpatialIndex.py), that take the first slots.
+        :param agent   : agent treated as ego vehicle
+        :param kth_traj: number of the window in agent.indexes, ignored if window is given
+        :param window  : (start, end) of the window
+        :param priority: ids of the neighbors that should take the first slots, in order. -1 values are ignored
+        :return        : dictionary neighbor_id -> slot
+        """
+        if window is None and len(agent.indexes) == 0:
             return None
         # get start and end of trajectory
-        start, end = agent.indexes[kth_traj]
+        start, end = agent.indexes[kth_traj] if window is None else window
+        # slots are consecutive from 1, so the cache only stores the neighbor ids in slot order
+        slot_cache: NeighborSlotCache = getattr(self, 'slot_cache', None)
+        if slot_cache is not None:
+            cache_key = (isinstance(agent, EgoVehicle), agent.agent_id, int(start), int(end),
+                         () if priority is None else tuple(int(p) for p in priority if p >= 0))
+            neighbor_ids = slot_cache.get(cache_key)
+            if neighbor_ids is not None:
+                return dict(zip(neighbor_ids.tolist(), range(1, len(neighbor_ids) + 1)))
         # get timestep keys
-        timestep_keys = list(agent.timesteps.keys())
+        timestep_keys, _ = agent.step_index()
         # first neighbor is always the agent itself
         neighbors = agent.init_neighbors()
         pos_available = len(neighbors) + 1              # +1 to account for the fact that ego-vehicle occupies position 0
 
+        if priority is not None:
+            for neighbor_id in priority:
+                if neighbor_id >= 0 and neighbors.get(neighbor_id) is None:
+                    neighbors[neighbor_id] = pos_available
+                    pos_available += 1
+
         # traverse all contexts (sample_annotation)
-        for key in timestep_keys[start: end]:
+        for key in timestep_keys[start: end].tolist():
             # traverse all neighbors and add the ones that are not yet
             for neighbor_id in self.contexts[key].neighbors:
                 if neighbors.get(neighbor_id) is None:
                     neighbors[neighbor_id] = pos_available
                     pos_available += 1
 
+        if slot_cache is not None:
+            slot_cache.put(cache_key, list(neighbors.keys()))
         return neighbors
 
-    def get_prediction_agents(self, size, skip=0, mode='single', overlap_points=0):
+    def get_prediction_agents(self, size, skip=0, mode='single', overlap_points=0, *, min_neighbors=0):
         """
         Sometimes datasets can be really heavy and even require transformations to the data that might result in a lot of resources
         as time and memory invested. In that case it could be helpful to retrieve the agents keys for which you want to perform a prediction
         in training or during inference. You could then pass this agents keys and the dictionary containing all the dataset information
         and retrieve the information with the transformations needed with a tensorflow or pytorch pipeline. As the information is stored
         in a dictionary, retrieving the information needed in the pipeline could be achieved in constant time.
+        The sub-trajectories of each agent are stored in agent.indexes (see get_trajectories_indexes).
+        To select subsets of extracted samples (by map, neighbors, speed, ...) see SampleCatalog.
 
-        :param size indicates the minimum size of points in the trajectory (see get_trajectories_indexes doc)
-        :param skip indicates points to skip from agents data retrived (see get_trajectories_indexes doc)
-        :param mode indicates how to treat trajectories that are bigger than the minimum size (see get_trajectories_indexes doc)
+        :param size indicates the length of the sub-trajectories (L in get_trajectory_windows)
+        :param skip indicates points to skip at the start of each agent trajectory, sub-trajectories starting before are dropped
+        :param mode indicates how to treat trajectories that are bigger than size: 'single' keeps the first sub-trajectory,
+                    'multiple' keeps all of them
         :param overlap_points indicates the number of points that two consecutive sub-trajectories can have
-        :return: List of agent keys
+        :param min_neighbors (keyword only) indicates the minimum number of neighbors at the start of a sub-trajectory
+        :return: List of agent keys with at least one sub-trajectory, in the order of self.agents
         """
-        self.get_trajectories_indexes(size, skip, mode, overlap_points)
-        agent_keys = []
-
-        for (key, agent) in self.agents.items():
-            if len(agent.indexes > 0):
-                agent_keys.append(key)
-
-        return agent_keys
+        if mode not in ('single', 'multiple'):
+            raise ValueError('unknown mode: ' + str(mode))
+        windows = self.get_trajectory_windows(use_ego_vehicles=False, L=size, overlap=overlap_points,
+                                              min_neighbors=min_neighbors)
+        windows = windows[windows[:, 1] >= skip]
+        if mode == 'single':
+            # windows are sorted by agent and start, the first one of each agent is kept
+            windows = windows[np.unique(windows[:, 0], return_index=True)[1]]
+        # cleared in place, as in get_trajectories_indexes
+        for agent_id in self.agents.keys():
+            self.agents[agent_id].indexes.clear()
+        for agent_id, start, end in windows.tolist():
+            self.agents[agent_id].indexes.append((start, end))
+        with_windows = set(windows[:, 0].tolist())
+        return [key for key in self.agents.keys() if key in with_windows]
 
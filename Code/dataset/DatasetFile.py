@@ -0,0 +1,310 @@
+"""This file contains the on-disk format of a Dataset: a directory with one .npy file per array plus a small header.json.
+   Arrays are opened with np.load(mmap_mode='r'), so opening a dataset only reads the header, pages are shared between
+   processes through the OS page cache and a query only reads the columns (and rows) it touches.
+
+   Agents and contexts are rebuilt as objects only when they are accessed (see LazyAgents and LazyContexts), and only the
+   objects of the most recently used scenes are kept (see ResidentScenes), so memory stays bounded whatever the dataset size.
+"""
+
+from collections import OrderedDict
+from collections.abc import Mapping
+import importlib
+import json
+import os
+
+import numpy as np
+from Code.dataset.DataModel import *
+from Code.dataset.TrajectoryStore import TrajectoryStore, ColumnarTimesteps, STEP_FIELDS
+from Code.dataset.Vocabulary import Vocabulary
+
+
+FORMAT_VERSION = 3
+COLLECTIONS = ('ego_vehicles', 'agents', 'non_pred_agents')
+VOCABULARIES = ('agent_vocab', 'context_vocab', 'scene_vocab')
+# (n, 2) position arrays of the contexts
+CONTEXT_POSITIONS = ('humans', 'objects', 'non_pred_positions')
+
+
+def class_name(cls):
+    return [cls.__module__, cls.__qualname__]
+
+
+def load_class(name):
+    module, qualname = name
+    return getattr(importlib.import_module(module), qualname)
+
+
+def csr(lists, dtype=np.int32):
+    """ offsets and flat values of a list of lists """
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(values) for values in lists])
+    values = np.fromiter((value for values in lists for value in values), dtype=dtype, count=offsets[-1])
+    return offsets, values
+
+
+# -------------------------------------------------------------- WRITE --------------------------------------------------------------
+def save_dataset(dataset: Dataset, path):
+    """
+    store a dataset in the directory path (created if needed). The dataset is compacted first (see Dataset.compact). The
+    header is written last (and the one of a previous dataset removed first), so an interrupted write is never opened.
+    :param dataset: Dataset
+    :param path   : directory of the dataset files
+    :return       : None
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.isfile(os.path.join(path, 'header.json')):
+        os.remove(os.path.join(path, 'header.json'))
+    store = dataset.compact()
+    arrays = {'frame': store.frame, 'agent': store.agent, 'agent_offsets': store.agent_offsets,
+              'agent_scene': store.agent_scene, 'agent_step_type': store.agent_step_type}
+    for field in STEP_FIELDS:
+        arrays['col_' + field] = store.columns[field]
+
+    # agents: every agent of the store belongs to a collection, its attributes are indexed by store index
+    map_index, class_index = {}, {}
+    agent_id = np.zeros(store.num_agents, dtype=np.int32)
+    agent_map = np.full(store.num_agents, -1, dtype=np.int32)
+    agent_class = np.zeros(store.num_agents, dtype=np.int8)
+    for collection_name in COLLECTIONS:
+        collection: dict = getattr(dataset, collection_name)
+        index = np.zeros(len(collection), dtype=np.int32)
+        vocab_size = len(dataset.scene_vocab if collection_name == 'ego_vehicles' else dataset.agent_vocab)
+        lookup = np.full(vocab_size, -1, dtype=np.int32)
+        for position, (id_, agent) in enumerate(collection.items()):
+            store_index = agent.timesteps.agent_index
+            index[position] = store_index
+            lookup[id_] = position
+            agent_id[store_index] = id_
+            if agent.map_name is not None:
+                agent_map[store_index] = map_index.setdefault(agent.map_name, len(map_index))
+            agent_class[store_index] = class_index.setdefault(type(agent), len(class_index))
+        arrays[collection_name + '_index'] = index
+        arrays[collection_name + '_lookup'] = lookup
+    arrays.update({'agent_id': agent_id, 'agent_map': agent_map, 'agent_class': agent_class})
+
+    # contexts: map, scene and neighbors of each context id, neighbors as offsets + flat ids
+    num_contexts = len(dataset.context_vocab)
+    context_exists = np.zeros(num_contexts, dtype=bool)
+    context_map = np.full(num_contexts, -1, dtype=np.int32)
+    context_scene = np.full(num_contexts, -1, dtype=np.int32)
+    context_scene[store.frame] = store.agent_scene[store.agent]
+    neighbors, non_pred_neighbors = [()] * num_contexts, [()] * num_contexts
+    for context_id, context in dataset.contexts.items():
+        context_exists[context_id] = True
+        if context.map is not None:
+            context_map[context_id] = map_index.setdefault(context.map, len(map_index))
+        neighbors[context_id] = context.neighbors.keys()
+        non_pred_neighbors[context_id] = context.non_pred_neighbors.keys()
+    arrays['neighbor_offsets'], arrays['neighbors'] = csr(neighbors)
+    arrays['non_pred_offsets'], arrays['non_pred_neighbors'] = csr(non_pred_neighbors)
+    for attribute in CONTEXT_POSITIONS:
+        positions = [np.zeros((0, 2), dtype=np.float32)] * num_contexts
+        for context_id, context in dataset.contexts.items():
+            positions[context_id] = np.asarray(getattr(context, attribute), dtype=np.float32).reshape(-1, 2)
+        arrays[attribute + '_offsets'] = np.cumsum([0] + [len(p) for p in positions]).astype(np.int64)
+        arrays[attribute] = np.concatenate(positions) if num_contexts > 0 else np.zeros((0, 2), dtype=np.float32)
+    arrays.update({'context_exists': context_exists, 'context_map': context_map, 'context_scene': context_scene,
+                   'maps': np.asarray(list(map_index.keys()), dtype=str)})
+    for vocab_name in VOCABULARIES:
+        arrays[vocab_name] = getattr(dataset, vocab_name).to_array()
+
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+    header = {'format_version': FORMAT_VERSION,
+              'num_rows': len(store),
+              'num_agents': store.num_agents,
+              'step_types': [[class_name(step_class), list(fields)] for step_class, fields in store.step_types],
+              'agent_classes': [class_name(cls) for cls in class_index.keys()],
+              'arrays': sorted(arrays.keys())}
+    with open(os.path.join(path, 'header.json.tmp'), 'w') as file:
+        json.dump(header, file, indent=1)
+    os.replace(os.path.join(path, 'header.json.tmp'), os.path.join(path, 'header.json'))
+    print("data stored succesfully to: ", path)
+
+
+# -------------------------------------------------------------- READ --------------------------------------------------------------
+class DatasetFiles:
+    """ memory mapped arrays of a dataset directory, opened on first access """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json'), 'r') as file:
+            self.header = json.load(file)
+        if self.header['format_version'] != FORMAT_VERSION:
+            raise RuntimeError('[ERR] unsupported dataset format version: ' + str(self.header['format_version']))
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        array = self.arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+            self.arrays[name] = array
+        return array
+
+
+class LazyColumns(dict):
+    """ dictionary field -> column of a TrajectoryStore that maps the .npy file of a column on first access """
+    def __init__(self, files: DatasetFiles):
+        super(LazyColumns, self).__init__()
+        self.files = files
+
+    def __missing__(self, field):
+        column = self.files['col_' + field]
+        self[field] = column
+        return column
+
+
+class ResidentScenes:
+    """
+    LRU of the scenes (ego vehicle id) whose objects are materialized. Each scene keeps the list of (mapping, key) of its
+    objects, so when more than max_scenes scenes are resident, all the objects of the least recently used one are dropped.
+    """
+    def __init__(self, max_scenes=None):
+        self.max_scenes = max_scenes
+        self.scenes = OrderedDict()
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def touch(self, scene_id):
+        if scene_id in self.scenes:
+            self.scenes.move_to_end(scene_id)
+
+    def add(self, scene_id, mapping, key):
+        self.scenes.setdefault(scene_id, []).append((mapping, key))
+        self.scenes.move_to_end(scene_id)
+        while self.max_scenes is not None and len(self.scenes) > self.max_scenes:
+            _, members = self.scenes.popitem(last=False)
+            for member_mapping, member_key in members:
+                member_mapping.objects.pop(member_key, None)
+
+
+class LazyAgents(Mapping):
+    """
+    read only dictionary agent_id -> agent object of a collection, agents are built the first time they are accessed.
+    The windows of the agents (agent.indexes, see Dataset.get_trajectories_indexes) are kept in self.indexes, so they
+    are attached again when an agent of an evicted scene is built again.
+    """
+    def __init__(self, files: DatasetFiles, store: TrajectoryStore, collection_name, resident: ResidentScenes):
+        self.files = files
+        self.store = store
+        self.collection_name = collection_name
+        self.agent_classes = [load_class(name) for name in files.header['agent_classes']]
+        self.objects = {}
+        self.resident = resident
+        # agent_id -> list of windows of the agent
+        self.indexes = {}
+
+    @property
+    def index(self):
+        return self.files[self.collection_name + '_index']
+
+    def position(self, agent_id):
+        lookup = self.files[self.collection_name + '_lookup']
+        return int(lookup[agent_id]) if 0 <= agent_id < len(lookup) else -1
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.files['agent_id'][self.index].tolist())
+
+    def __contains__(self, agent_id):
+        return isinstance(agent_id, (int, np.integer)) and self.position(agent_id) >= 0
+
+    def __getitem__(self, agent_id):
+        agent = self.objects.get(agent_id)
+        if agent is None:
+            if agent_id not in self:
+                raise KeyError(agent_id)
+            agent = self.build(int(self.index[self.position(agent_id)]))
+            agent.indexes = self.indexes.setdefault(agent_id, [])
+            self.objects[agent_id] = agent
+            self.resident.add(agent.ego_id, self, agent_id)
+        else:
+            self.resident.touch(agent.ego_id)
+        return agent
+
+    def build(self, store_index):
+        agent_class = self.agent_classes[self.files['agent_class'][store_index]]
+        map_index = int(self.files['agent_map'][store_index])
+        agent = agent_class.__new__(agent_class)
+        Agent.__init__(agent, int(self.files['agent_id'][store_index]), int(self.store.agent_scene[store_index]),
+                       None if map_index < 0 else str(self.files['maps'][map_index]))
+        if isinstance(agent, NuscenesAgent):
+            agent.scene_token = agent.ego_id
+        agent.timesteps = ColumnarTimesteps(self.store, store_index)
+        return agent
+
+
+class LazyContexts(Mapping):
+    """ read only dictionary context_id -> Context, contexts are built the first time they are accessed """
+    def __init__(self, files: DatasetFiles, resident: ResidentScenes):
+        self.files = files
+        self.objects = {}
+        self.resident = resident
+
+    def __len__(self):
+        return int(np.count_nonzero(self.files['context_exists']))
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.files['context_exists']).tolist())
+
+    def __contains__(self, context_id):
+        exists = self.files['context_exists']
+        return isinstance(context_id, (int, np.integer)) and 0 <= context_id < len(exists) and bool(exists[context_id])
+
+    def __getitem__(self, context_id):
+        context = self.objects.get(context_id)
+        scene_id = int(self.files['context_scene'][context_id]) if context_id in self else None
+        if context is None:
+            if scene_id is None:
+                raise KeyError(context_id)
+            context = self.build(int(context_id))
+            self.objects[context_id] = context
+            self.resident.add(scene_id, self, context_id)
+        else:
+            self.resident.touch(scene_id)
+        return context
+
+    def build(self, context_id):
+        map_index = int(self.files['context_map'][context_id])
+        context = Context(context_id, None if map_index < 0 else str(self.files['maps'][map_index]))
+        for attribute, offsets_name, values_name in (('neighbors', 'neighbor_offsets', 'neighbors'),
+                                                     ('non_pred_neighbors', 'non_pred_offsets', 'non_pred_neighbors')):
+            offsets = self.files[offsets_name]
+            ids = self.files[values_name][offsets[context_id]: offsets[context_id + 1]]
+            setattr(context, attribute, dict.fromkeys(ids.tolist(), 1))
+        for attribute in CONTEXT_POSITIONS:
+            offsets = self.files[attribute + '_offsets']
+            setattr(context, attribute, self.files[attribute][offsets[context_id]: offsets[context_id + 1]])
+        return context
+
+    def neighbor_counts(self):
+        return np.diff(self.files['neighbor_offsets']).astype(np.int32)
+
+
+def open_dataset(path, verbose=True, max_resident_scenes=None) -> Dataset:
+    """
+    open a dataset stored with save_dataset. Only the header is read; arrays are memory mapped when they are first used
+    and scenes (ego vehicle, its agents and contexts) are materialized when they are queried.
+    :param path               : directory of the dataset files
+    :param max_resident_scenes: max number of scenes whose objects are kept in memory. None keeps all of them
+    :return                   : read only Dataset
+    """
+    files = DatasetFiles(path)
+    store = TrajectoryStore()
+    store.columns = LazyColumns(files)
+    for name in ('frame', 'agent', 'agent_offsets', 'agent_scene', 'agent_step_type'):
+        setattr(store, name, files[name])
+    store.step_types = [(load_class(name), tuple(fields)) for name, fields in files.header['step_types']]
+
+    dataset = Dataset(verbose)
+    dataset.store = store
+    resident = ResidentScenes(max_resident_scenes)
+    for collection_name in COLLECTIONS:
+        setattr(dataset, collection_name, LazyAgents(files, store, collection_name, resident))
+    dataset.contexts = LazyContexts(files, resident)
+    for vocab_name in VOCABULARIES:
+        setattr(dataset, vocab_name, Vocabulary.from_array(files[vocab_name]))
+    print('[MSG] dataset opened from: ', path) if verbose else None
+    return dataset
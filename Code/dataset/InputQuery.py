@@ -1,7 +1,11 @@
 
 from Code.dataset.dataloader import Loader
 from Code.dataset.DataModel import *
+from Code.dataset.SpatialIndex import ContextSpatialIndex
+from Code.dataset.CompactSample import CompactSample
 import numpy as np
+import multiprocessing
+from collections import deque
 from pyquaternion import Quaternion
 
 
@@ -143,12 +147,32 @@ def split_single_input(inputTensor, inputMask, inp_seq_l, tar_seq_l):
     return inp, inp_mask, tar, tar_mask
 
 
+def get_window_numbers(windows):
+    """ number of each window inside the trajectory of its ego vehicle, windows grouped by ego vehicle (see Dataset.get_trajectory_windows) """
+    if len(windows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    positions = np.arange(len(windows))
+    first_of_ego = np.append(True, windows[1:, 0] != windows[:-1, 0])
+    return positions - np.maximum.accumulate(np.where(first_of_ego, positions, 0))
+
+
+# query, windows and parameters used by the workers of InputQuery.get_TransformerCube_Input, inherited when they are forked
+_worker_query = None
+_worker_windows = None
+_worker_params = None
+
+
+def _windows_inputs(bounds, skip=0):
+    return list(_worker_query.windows_inputs(_worker_windows, *bounds, skip=skip, **_worker_params))
+
+
 class InputQuery:
     def __init__(self, dataloader: Loader):
         self.dataset = dataloader.dataset
 
     def get_egocentered_input(self, agent: Agent, agents, total_seq_l: int, N: int, seq_number=0,
-                              offset=-1, bitmap_extractor: BitmapFeature = None, rotate=False, **kwargs):
+                              offset=-1, bitmap_extractor: BitmapFeature = None, rotate=False, window=None,
+                              priority_neighbors=None, window_input=None, angle=None, **kwargs):
         """
         get input scene centered in a specific ego-vehicle timestep.
         :param agent                :  agent object target, treated as center or virtual ego vehicle (meaning it could or could not be a real ego-vehicle)
@@ -160,25 +184,42 @@ class InputQuery:
         :param seq_number           : ego-vehicles might contain large sequences, so we might be interested in get as many scenes as possible from them.
                                       self.get_indexes should have been call, if not, assert will raise an error due to len(ego_vehicle.indexes) = 0
         :param offset               : offset int that indicates the index of the timestep to use as origin. If -1 none is taken
+        :param window               : (start, end) of the sequence (see Dataset.get_trajectory_windows). If given, seq_number
+                                      and agent.indexes are ignored
+        :param priority_neighbors   : ids of the neighbors that take the first slots (see Dataset.get_agent_neighbors)
+        :param window_input         : (InputTensor, InputMask, origin) of the window already built by get_window_inputs, if any
+        :param angle                : rotation angle if rotate is True, drawn at random if None
         :return                     : InputTensor with shape (sequence, neighbors, features) and InputMask (sequence, neighbors) that masks neighbors that do not appear.
         """
-        assert (len(agent.indexes) > 0)
-        angle = 0 if not rotate else np.random.uniform(np.pi/4.0, np.pi)
-        start, end = agent.indexes[seq_number]
+        assert (window is not None or len(agent.indexes) > 0)
+        angle = 0 if not rotate else (np.random.uniform(np.pi/4.0, np.pi) if angle is None else angle)
+        start, end = agent.indexes[seq_number] if window is None else window
         inputTensor = np.zeros((total_seq_l, N, 5))     # (seq, neighbors, features)
         inputMask = np.ones((total_seq_l, N))           # at the beginning, all neighbors have padding
         bitmaps = None
-        # timesteps that will be traversed, timestep[0] = key, timestep[1] = egostep object
-        timesteps = list(agent.timesteps.items())[start: end]
-        origin_timestep: AgentTimestep = timesteps[offset][1] if offset != -1 else None
+        # ids of the timesteps that will be traversed
+        step_ids, _ = agent.step_index()
+        timesteps = step_ids[start: end].tolist()
+        origin_timestep: AgentTimestep = agent.timesteps[timesteps[offset]] if offset != -1 else None
         # get bitmaps for center agent (ego vehicle or agent treated as ego vehicle)
         if bitmap_extractor is not None:
             bitmaps = bitmap_extractor.getMasks(origin_timestep, agent.map_name, angle=angle, **kwargs)
 
+        if window_input is None and isinstance(agent.timesteps, ColumnarTimesteps):
+            # gather all the (timestep, neighbor) features of the window from the trajectory store at once
+            inputTensor, inputMask, origins = self.build_windows([agent], [start], [end], total_seq_l, N, offset, agents,
+                                                                 None if priority_neighbors is None else [priority_neighbors])
+            window_input = inputTensor[0], inputMask[0], tuple(origins[0].tolist())
+        if window_input is not None:
+            inputTensor, inputMask, origin = window_input
+            if rotate:
+                inputTensor = self.rotate_input(inputTensor, angle)
+            return inputTensor, inputMask, bitmaps, origin
+
         # available positions start from 1 because ego vehicle occupies position 0.
-        neighbors_positions = self.dataset.get_agent_neighbors(agent, seq_number)
+        neighbors_positions = self.dataset.get_agent_neighbors(agent, seq_number, window=(start, end), priority=priority_neighbors)
 
-        for s_index, (timestep_id, timestep) in enumerate(timesteps):
+        for s_index, timestep_id in enumerate(timesteps):
             # ADD EGO VEHICLE TIMESTEP AS INPUT
             ego_step = self.dataset.ego_vehicles[agent.ego_id].timesteps[timestep_id]
             inputTensor[s_index, 0, :2] = ego_step.x - origin_timestep.x, ego_step.y - origin_timestep.y
@@ -206,49 +247,276 @@ class InputQuery:
         origin  = (origin_timestep.x, origin_timestep.y, origin_timestep.rot)
         return inputTensor, inputMask, bitmaps, origin
 
+    def build_windows(self, egos, starts, ends, total_seq_l: int, N: int, offset=-1, agents=None, priorities=None):
+        """
+        InputTensor and InputMask of get_egocentered_input (without rotation) for several windows, gathered from the
+        TrajectoryStore of the dataset with a few fancy indexing passes instead of one get_features call by neighbor and
+        timestep. A neighbor of a window is in a context if and only if it has a step in it (loaders add both together), so
+        the (timestep, slot) pairs are the rows of the neighbors whose frame is a timestep of the window.
+        :param egos       : agent objects treated as ego vehicles (columnar, see Dataset.compact)
+        :param starts     : start of the window of each agent
+        :param ends       : end of the window of each agent
+        :param agents     : dictionary of the neighbor agents, self.dataset.agents if None
+        :param priorities : ids of the neighbors that take the first slots of each window (see Dataset.get_agent_neighbors)
+        :param offset     : index of the origin timestep inside each window, in [-size, size) (negative values count from
+                            the end), -1 for no origin. ValueError if it is outside a window
+        :return           : InputTensor (windows, total_seq_l, N, 5), InputMask (windows, total_seq_l, N) and origins
+                            (windows, 3) x, y, rot of the origin timestep (zeros if offset is -1)
+        """
+        store = self.dataset.store
+        agents = self.dataset.agents if agents is None else agents
+        num_windows = len(egos)
+        inputTensor = np.zeros((num_windows, total_seq_l, N, 5))
+        inputMask = np.ones((num_windows, total_seq_l, N))
+        origins = np.zeros((num_windows, 3))
+        if num_windows == 0:
+            return inputTensor, inputMask, origins
+
+        # timesteps of each window, origin row and (window, store agent, slot) of the ego vehicle and the neighbors
+        window_frames, origin_rows, pair_window, pair_agent, pair_slot = [], [], [], [], []
+        for w, (agent, start, end) in enumerate(zip(egos, starts, ends)):
+            window_frames.append(agent.step_index()[0][start: end])
+            if offset != -1:
+                # rows outside the window would be gathered from the previous or next agent of the store
+                if not -(end - start) <= offset < end - start:
+                    raise ValueError('offset ' + str(offset) + ' is outside the window of size ' + str(end - start))
+                origin_rows.append(agent.timesteps.start + start + (offset if offset >= 0 else end - start + offset))
+            # ego vehicle occupies position 0, without speed and acceleration
+            pair_window.append(w)
+            pair_agent.append(self.dataset.ego_vehicles[agent.ego_id].timesteps.agent_index)
+            pair_slot.append(0)
+            neighbors_positions = self.dataset.get_agent_neighbors(agent, 0, window=(start, end),
+                                                                   priority=None if priorities is None else priorities[w])
+            for neighbor_id, slot in neighbors_positions.items():
+                if slot < N:
+                    pair_window.append(w)
+                    pair_agent.append(agents[neighbor_id].timesteps.agent_index)
+                    pair_slot.append(slot)
+        if offset != -1:
+            origin_rows = np.asarray(origin_rows, dtype=np.int64)
+            origins = np.stack([store.columns[field][origin_rows] for field in ('x', 'y', 'rot')], axis=1).astype(np.float64)
+        pair_window = np.asarray(pair_window, dtype=np.int64)
+        pair_slot = np.asarray(pair_slot, dtype=np.int64)
+
+        # all the store rows of the agents of each pair
+        pair_agent = np.asarray(pair_agent, dtype=np.int64)
+        first_rows = store.agent_offsets[pair_agent]
+        counts = store.agent_offsets[pair_agent + 1] - first_rows
+        row_pair = np.repeat(np.arange(len(pair_agent)), counts)
+        rows = first_rows[row_pair] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        row_frames = store.frame[rows].astype(np.int64)
+
+        # match (window, frame) of each row with the timesteps of the windows
+        lengths = np.array([len(frames) for frames in window_frames])
+        frames = np.concatenate(window_frames).astype(np.int64)
+        frame_steps = np.arange(len(frames)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        num_frames = int(max(frames.max(initial=0), row_frames.max(initial=0))) + 1
+        keys = np.repeat(np.arange(num_windows), lengths) * num_frames + frames
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        row_keys = pair_window[row_pair] * num_frames + row_frames
+        positions = np.minimum(np.searchsorted(sorted_keys, row_keys), len(sorted_keys) - 1)
+        found = sorted_keys[positions] == row_keys
+        rows, row_pair, steps = rows[found], row_pair[found], frame_steps[order[positions[found]]]
+
+        windows, slots = pair_window[row_pair], pair_slot[row_pair]
+        for feature, field in enumerate(('x', 'y', 'rot')):
+            inputTensor[windows, steps, slots, feature] = store.columns[field][rows] - origins[windows, feature]
+        neighbors = slots > 0
+        for feature, field in ((3, 'speed'), (4, 'accel')):
+            inputTensor[windows[neighbors], steps[neighbors], slots[neighbors], feature] = store.columns[field][rows[neighbors]]
+        inputMask[windows, steps, slots] = 0
+        return inputTensor, inputMask, origins
+
+    def get_window_inputs(self, windows, total_seq_l: int, N: int, offset=-1, use_ego_vehicles=True, priority_neighbors=None):
+        """
+        batched form of get_egocentered_input (without rotation and bitmaps) for B windows, see build_windows. The dataset
+        has to be columnar (see Dataset.compact) or opened from disk (see DatasetFile.open_dataset)
+        :param windows            : (B, 3) rows (ego_id, start, end) (see Dataset.get_trajectory_windows)
+        :param priority_neighbors : (B, k) ids of the neighbors that take the first slots of each window (-1 padded) or None
+        :return                   : InputTensor (B, total_seq_l, N, 5), InputMask (B, total_seq_l, N) and origins (B, 3)
+        """
+        ego_vehicles: dict = self.dataset.ego_vehicles if use_ego_vehicles else self.dataset.agents
+        windows = np.asarray(windows).reshape(-1, 3)
+        egos = [ego_vehicles[ego_id] for ego_id in windows[:, 0].tolist()]
+        return self.build_windows(egos, windows[:, 1].tolist(), windows[:, 2].tolist(), total_seq_l, N, offset,
+                                  priorities=priority_neighbors)
+
 # ---------------------------------------------------------------- FUNCTIONS TO BUILD INPUTS ----------------------------------------------------------------
 
+    def get_nearest_neighbors(self, windows, k, radius, offset=-1, use_ego_vehicles=True,
+                              spatial_index: ContextSpatialIndex = None):
+        """
+        get the k nearest neighbors within radius meters of each ego vehicle at the origin timestep of each window
+        :param windows         : windows array (see Dataset.get_trajectory_windows)
+        :param offset          : index of the origin timestep inside the window, negative values count from the end of the
+                                 window (as in build_windows). If -1 (no origin) the first timestep is used
+        :param spatial_index   : index of the agent positions, built from the dataset if None
+        :return                : (windows, k) int32 array of neighbor ids sorted by distance, padded with -1
+        """
+        if spatial_index is None:
+            spatial_index = ContextSpatialIndex.from_dataset(self.dataset)
+        ego_vehicles: dict = self.dataset.ego_vehicles if use_ego_vehicles else self.dataset.agents
+        frames = np.zeros(len(windows), dtype=np.int64)
+        centers = np.zeros((len(windows), 2))
+        for w, (ego_id, start, end) in enumerate(windows.tolist()):
+            ego_vehicle = ego_vehicles[ego_id]
+            origin = start + (0 if offset == -1 else offset if offset >= 0 else end - start + offset)
+            frames[w] = ego_vehicle.step_index()[0][origin]
+            centers[w] = ego_vehicle.step_column('x')[origin], ego_vehicle.step_column('y')[origin]
+        neighbor_ids, _ = spatial_index.query(frames, centers, radius, k)
+        return neighbor_ids
+
     def get_TransformerCube_Input(self, inp_seq_l, tar_seq_l, N, offset=-1, use_ego_vehicles=True,
-                                  bitmap_extractor: BitmapFeature = None, path='maps', rotate=False, **kwargs):
+                                  bitmap_extractor: BitmapFeature = None, path='maps', rotate=False,
+                                  spatial_index: ContextSpatialIndex = None, neighbor_radius=None, ego_ids=None, batch_size=256,
+                                  num_workers=1, **kwargs):
+        """
+        get the inputs of all the windows of all the ego vehicles, or only of the ego vehicles in ego_ids if given. With a
+        lazy dataset (see DatasetFile.open_dataset) only the scenes of those ego vehicles are read.
+        If neighbor_radius is given, the N slots of each window are filled first with the nearest neighbors within
+        neighbor_radius meters of the ego vehicle at the origin timestep (see get_nearest_neighbors), instead of using only
+        the order of appearance of the neighbors.
+        With a columnar dataset, the inputs of batch_size windows are built at once (see get_window_inputs).
+        If num_workers > 1, the ego vehicles are partitioned in contiguous groups that forked processes extract (inputs and
+        bitmaps) reading the dataset of this process, and the inputs are returned in the same order of a serial run. The
+        rotations are drawn in this process, so they are the same too. The neighbor slots memoized by the workers are not
+        kept in this process (see Dataset.slot_cache).
+        To write the inputs while they are extracted instead of keeping all of them, see iter_TransformerCube_Input.
+        If compact=True is given, the inputs are CompactSample objects instead of dictionaries (see CompactSample.py).
+        """
+        return list(self.iter_TransformerCube_Input(inp_seq_l, tar_seq_l, N, offset, use_ego_vehicles, bitmap_extractor, path,
+                                                    rotate, spatial_index, neighbor_radius, ego_ids, batch_size, num_workers,
+                                                    **kwargs))
+
+    def iter_TransformerCube_Input(self, inp_seq_l, tar_seq_l, N, offset=-1, use_ego_vehicles=True,
+                                   bitmap_extractor: BitmapFeature = None, path='maps', rotate=False,
+                                   spatial_index: ContextSpatialIndex = None, neighbor_radius=None, ego_ids=None, batch_size=256,
+                                   num_workers=1, skip=0, **kwargs):
+        """
+        generator of the inputs of get_TransformerCube_Input, in the same order, e.g. to write them in shards while they are
+        extracted (see SampleStore.ShardWriter). Memory does not depend on the number of windows: a serial run keeps one
+        batch of windows and a parallel one at most two groups of windows by worker.
+        :param skip : number of leading inputs that are not built nor yielded (e.g. the ones already written by an interrupted
+                      run, see ShardWriter.skip). Their bitmaps are not written again, so the stored inputs keep theirs
+        """
         # get indexes of the sequences
-        self.dataset.get_trajectories_indexes(use_ego_vehicles=use_ego_vehicles, L=inp_seq_l + tar_seq_l, overlap=tar_seq_l)
+        windows = self.dataset.get_trajectory_windows(use_ego_vehicles=use_ego_vehicles, L=inp_seq_l + tar_seq_l, overlap=tar_seq_l,
+                                                      ego_ids=ego_ids)
+        # nearest neighbors of all the windows in a single batch
+        nearest = None
+        if neighbor_radius is not None:
+            nearest = self.get_nearest_neighbors(windows, N, neighbor_radius, offset, use_ego_vehicles, spatial_index)
+        params = dict(inp_seq_l=inp_seq_l, tar_seq_l=tar_seq_l, N=N, offset=offset, use_ego_vehicles=use_ego_vehicles,
+                      bitmap_extractor=bitmap_extractor, path=path, rotate=rotate, batch_size=batch_size, nearest=nearest,
+                      **kwargs)
+        if num_workers <= 1 or len(windows) == 0:
+            yield from self.windows_inputs(windows, 0, len(windows), skip=skip, **params)
+            return
+
+        # same angles of a serial run: one by window and rotation, in order
+        if rotate:
+            params['angles'] = np.random.uniform(np.pi/4.0, np.pi, size=(len(windows), 4))
+        # contiguous groups of ego vehicles, a few by worker to balance them and of a few batches at most to bound memory
+        ego_starts = np.flatnonzero(np.append(True, windows[1:, 0] != windows[:-1, 0]))
+        num_groups = max(4 * num_workers, int(np.ceil(len(windows) / (4 * batch_size))))
+        targets = np.linspace(0, len(windows), num_groups + 1)[1:-1]
+        bounds = np.unique(np.concatenate([[0], ego_starts[np.minimum(np.searchsorted(ego_starts, targets), len(ego_starts) - 1)],
+                                           [len(windows)]]).astype(np.int64)).tolist()
+        # groups whose inputs are all skipped are not submitted, the first one left skips the rest
+        num_rotations = 4 if rotate else 1
+        while len(bounds) > 1 and (bounds[1] - bounds[0]) * num_rotations <= skip:
+            skip -= (bounds[1] - bounds[0]) * num_rotations
+            bounds = bounds[1:]
+        global _worker_query, _worker_windows, _worker_params
+        _worker_query, _worker_windows, _worker_params = self, windows, params
+        try:
+            with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                # groups are submitted as the previous ones are consumed, so at most 2 * num_workers are in memory
+                pending = deque()
+                for g, group_bounds in enumerate(zip(bounds[:-1], bounds[1:])):
+                    pending.append(pool.apply_async(_windows_inputs, (group_bounds, skip if g == 0 else 0)))
+                    if len(pending) >= 2 * num_workers:
+                        yield from pending.popleft().get()
+                while len(pending) > 0:
+                    yield from pending.popleft().get()
+        finally:
+            _worker_query, _worker_windows, _worker_params = None, None, None
+
+    def windows_inputs(self, windows, first, last, inp_seq_l, tar_seq_l, N, offset=-1, use_ego_vehicles=True,
+                       bitmap_extractor: BitmapFeature = None, path='maps', rotate=False, batch_size=256, nearest=None,
+                       angles=None, compact=False, skip=0, **kwargs):
+        """
+        generator of the inputs of the windows first, ..., last - 1 (see get_TransformerCube_Input), that must start at the
+        first window of an ego vehicle.
+        :param nearest : (windows, k) neighbors that take the first slots of each window (see get_nearest_neighbors) or None
+        :param angles  : (windows, 4) angle of each rotation of each window, drawn for each input if None
+        :param compact : yield CompactSample objects, that store only the window and its mask
+        :param skip    : number of leading inputs that are not built nor yielded (see iter_TransformerCube_Input)
+        """
         # USEFUL VARIABLES
         ego_vehicles: dict = self.dataset.ego_vehicles if use_ego_vehicles else self.dataset.agents
+        # vocabulary to export the int ids of the ego vehicles (names of the bitmaps)
+        vocab = self.dataset.scene_vocab if use_ego_vehicles else self.dataset.agent_vocab
         agents: dict = self.dataset.agents
-        list_inputs = []
         # max sequence length
         total_seq_l = inp_seq_l + tar_seq_l
-
-        # traverse all ego vehicles
-        for ego_id, ego_vehicle in ego_vehicles.items():
-            # traverse all the possible trajectories for and ego vehicle
-            for i, (_, _) in enumerate(ego_vehicle.indexes):
-                num_rotations = 1 if not rotate else 4
-                for n_rot in range(num_rotations):
-                    # get inputTensor and its mask centered in egovehicle
-                    inputTensor, inputMask, bitmaps, origin = self.get_egocentered_input(ego_vehicle, agents, total_seq_l, N, seq_number=i,
-                                                                                         offset=offset, bitmap_extractor=bitmap_extractor,
-                                                                                         rotate=rotate, **kwargs)
-                    seq_inputMask = np.zeros(total_seq_l)  # at the beginning, all sequence elements are padded
-                    # split trajectories into input and target
-                    name = ego_id + '_' + str(n_rot) + '_' + str(i)
-                    inp, inp_mask, seq_inpMask, tar, tar_mask, seq_tarMask = split_input(inputTensor, inputMask, seq_inputMask, inp_seq_l, tar_seq_l, N)
-                    list_inputs.append({'past': inp,
-                                        'past_neighMask': inp_mask,
-                                        'past_seqMask': seq_inpMask,
-                                        'future': tar,
-                                        'future_neighMask': tar_mask,
-                                        'future_seqMask': seq_tarMask,
-                                        'full_traj': inputTensor,
-                                        'origin': origin,
-                                        'origin_yaw': origin[2],
-                                        'ego_id': name})
-                    # save bitmaps and store name
-                    if bitmap_extractor is not None:
-                        np.savez_compressed('/'.join([path, name]), bitmaps=bitmaps)
-
-        # return inputs
-        return list_inputs
+        columnar = getattr(self.dataset, 'store', None) is not None
+        batch, batch_start = None, 0
+        num_rotations = 1 if not rotate else 4
+        windows = windows[first: last]
+        nearest = None if nearest is None else nearest[first: last]
+        angles = None if angles is None else angles[first: last]
+
+        # traverse all the possible trajectories of all the ego vehicles
+        for w, ((ego_id, start, end), i) in enumerate(zip(windows.tolist(), get_window_numbers(windows).tolist())):
+            if skip >= num_rotations:
+                skip -= num_rotations
+                continue
+            ego_vehicle = ego_vehicles[ego_id]
+            if columnar and (batch is None or w >= batch_start + batch_size):
+                batch_start = w
+                batch = self.get_window_inputs(windows[w: w + batch_size], total_seq_l, N, offset, use_ego_vehicles,
+                                               None if nearest is None else nearest[w: w + batch_size])
+            window_input = None if batch is None else (batch[0][w - batch_start], batch[1][w - batch_start],
+                                                       tuple(batch[2][w - batch_start].tolist()))
+            # rotations of a window partially written by an interrupted run
+            first_rotation, skip = skip, 0
+            for n_rot in range(first_rotation, num_rotations):
+                # get inputTensor and its mask centered in egovehicle
+                inputTensor, inputMask, bitmaps, origin = self.get_egocentered_input(ego_vehicle, agents, total_seq_l, N, seq_number=i,
+                                                                                     offset=offset, bitmap_extractor=bitmap_extractor,
+                                                                                     rotate=rotate, window=(start, end),
+                                                                                     priority_neighbors=None if nearest is None else nearest[w],
+                                                                                     window_input=window_input,
+                                                                                     angle=None if angles is None else angles[w, n_rot],
+                                                                                     **kwargs)
+                name = vocab.token(ego_id) + '_' + str(n_rot) + '_' + str(i)
+                # save bitmaps and store name
+                if bitmap_extractor is not None:
+                    np.savez_compressed('/'.join([path, name]), bitmaps=bitmaps)
+                if compact:
+                    yield CompactSample(inputTensor, inputMask, inp_seq_l,
+                                        {'origin': origin, 'origin_yaw': origin[2], 'agent_id': ego_id,
+                                         'scene': self.dataset.scene_vocab.token(ego_vehicle.ego_id),
+                                         'map_name': ego_vehicle.map_name, 'ego_id': name})
+                    continue
+                seq_inputMask = np.zeros(total_seq_l)  # at the beginning, all sequence elements are padded
+                # split trajectories into input and target
+                inp, inp_mask, seq_inpMask, tar, tar_mask, seq_tarMask = split_input(inputTensor, inputMask, seq_inputMask, inp_seq_l, tar_seq_l, N)
+                yield {'past': inp,
+                       'past_neighMask': inp_mask,
+                       'past_seqMask': seq_inpMask,
+                       'future': tar,
+                       'future_neighMask': tar_mask,
+                       'future_seqMask': seq_tarMask,
+                       'full_traj': inputTensor,
+                       'origin': origin,
+                       'origin_yaw': origin[2],
+                       'agent_id': ego_id,
+                       'scene': self.dataset.scene_vocab.token(ego_vehicle.ego_id),
+                       'map_name': ego_vehicle.map_name,
+                       'ego_id': name}
 
     def rotate_input(self, inputs, yaw):
         x = inputs[:, :, 0]
@@ -287,7 +555,7 @@ class InputQuery:
                     inputTensor = np.zeros((total_seq_l, 5))
                     inputMask = np.zeros(total_seq_l)
                     # timesteps that will be traversed
-                    timesteps = list(neighbor.timesteps.keys())[start: end]
+                    timesteps = neighbor.step_index()[0][start: end].tolist()
                     origin_offset = timesteps[offset] if offset != -1 else None
 
                     for s_index, timestep_id in enumerate(timesteps):
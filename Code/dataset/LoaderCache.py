@@ -0,0 +1,138 @@
+"""This file contains a content addressed cache of the processed datasets of the loaders (see dataloader.Loader). Each entry is
+   the pickle file (or memory mapped directory, see DatasetFile.py) of a dataset, named by the hash of everything it depends
+   on: loader class and version, source path, split or chunk, loader options and dataset format version. Entries of several
+   configurations coexist, so switching between them is a cache hit, a changed parameter is a miss instead of a stale read,
+   and the least recently used entries are evicted when the cache grows over max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+def cache_key(params: dict) -> str:
+    """ hash of the parameters of a dataset (json serializable values, other values are hashed by their str) """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def path_size(path) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def path_mtime(path) -> float:
+    """ newest modification time of a file or of the files of a directory """
+    if os.path.isdir(path):
+        return max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(root, name))
+                                               for root, _, names in os.walk(path) for name in names])
+    return os.path.getmtime(path)
+
+
+def remove_path(path):
+    """ remove a file or directory, that might have been removed or renamed by another process meanwhile """
+    try:
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class LoaderCache:
+    """
+    directory of processed datasets. An entry is every file of the directory whose name starts with its key: the dataset
+    (<key>.pkl or the directory <key>), the files stored next to it (e.g. <key>.pkl.slots.npz, see Loader.save_slot_cache)
+    and <key>.json with its parameters. <key>.json is written once the dataset is complete (see complete), so an entry
+    without it is an interrupted build or one still in progress (possibly in another process). The modification time of
+    <key>.json is the last use of a complete entry, the newest modification time of its files the last use of an incomplete
+    one. Incomplete entries are only evicted once they were not modified for grace_seconds, so builds in progress survive.
+    """
+    def __init__(self, path, max_bytes=None, grace_seconds=3600.):
+        """
+        :param path          : directory of the cache
+        :param max_bytes     : size bound of the cache, None for no bound
+        :param grace_seconds : time an incomplete entry must be left unmodified before it can be evicted
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        os.makedirs(path, exist_ok=True)
+
+    def entry(self, params: dict, memmap=False) -> str:
+        """ filename of the dataset of params (it might not exist yet) """
+        key = cache_key(params)
+        return os.path.join(self.path, key if memmap else key + '.pkl')
+
+    def info_filename(self, filename) -> str:
+        return os.path.join(self.path, self.entry_key(filename) + '.json')
+
+    def is_complete(self, filename) -> bool:
+        """ True if the dataset of the entry of filename was completely stored """
+        return os.path.isfile(self.info_filename(filename))
+
+    def complete(self, filename, params: dict):
+        """ mark the entry of a dataset filename as complete (and most recently used) storing its parameters """
+        info_filename = self.info_filename(filename)
+        # temporary file of its own, processes completing the same entry do not write the same file
+        descriptor, tmp_filename = tempfile.mkstemp(dir=self.path, prefix=os.path.basename(info_filename) + '.', suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(params, file, indent=1, sort_keys=True, default=str)
+        os.replace(tmp_filename, info_filename)
+
+    @staticmethod
+    def entry_key(filename) -> str:
+        return os.path.basename(filename).split('.')[0]
+
+    def touch(self, filename):
+        """ mark the entry of a dataset filename as the most recently used """
+        os.utime(self.info_filename(filename))
+
+    def entries(self):
+        """
+        key -> [size in bytes, last use, paths, complete] of each entry, from the least to the most recently used. Files
+        removed by another process while listing are skipped
+        """
+        entries = {}
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                size, mtime = path_size(path), path_mtime(path)
+            except FileNotFoundError:
+                continue
+            entry = entries.setdefault(self.entry_key(name), [0, 0., [], False])
+            entry[0] += size
+            entry[2].append(path)
+            if name.endswith('.json'):
+                entry[1], entry[3] = mtime, True
+            elif not entry[3]:
+                entry[1] = max(entry[1], mtime)
+        return dict(sorted(entries.items(), key=lambda item: item[1][1]))
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries until the cache is under max_bytes. Incomplete entries modified in the last
+        grace_seconds are builds in progress and are never removed
+        :param keep : dataset filename whose entry is never removed (the one in use)
+        :return     : keys of the removed entries
+        """
+        if self.max_bytes is None:
+            return []
+        entries = self.entries()
+        size = sum(entry[0] for entry in entries.values())
+        keep_key = None if keep is None else self.entry_key(keep)
+        oldest_build = time.time() - self.grace_seconds
+        removed = []
+        for key, (entry_size, last_use, paths, complete) in entries.items():
+            if size <= self.max_bytes:
+                break
+            if key == keep_key or (not complete and last_use > oldest_build):
+                continue
+            for path in paths:
+                remove_path(path)
+            size -= entry_size
+            removed.append(key)
+        if len(removed) > 0:
+            print('[MSG] loader cache: evicted', len(removed), 'entries, size:', round(size / 2 ** 20, 2), 'MB')
+        return removed
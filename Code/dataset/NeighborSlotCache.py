@@ -0,0 +1,66 @@
+"""This file contains a cache of the neighbor -> slot assignments computed by Dataset.get_agent_neighbors, so extractions with
+   several rotations or repeated extraction runs over the same windows do not traverse the contexts again.
+"""
+
+from collections import OrderedDict
+import os
+import numpy as np
+
+
+class NeighborSlotCache:
+    """
+    LRU cache with the neighbor ids of an (agent, window) in slot order, stored as compact int32 arrays.
+    Keys are tuples (is_ego, agent_id, start, end, priority) where priority is the tuple of priority neighbors (or empty).
+    Slots are consecutive from 1 (position 0 belongs to the ego vehicle), so neighbor_ids[i] occupies slot i + 1.
+    """
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        neighbor_ids = self.entries.get(key)
+        if neighbor_ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return neighbor_ids
+
+    def put(self, key, neighbor_ids):
+        self.entries[key] = np.asarray(neighbor_ids, dtype=np.int32)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # --------------------------------------------------- PERSISTENCE ---------------------------------------------------
+    def save(self, filename):
+        """ store the cache in a npz file: fixed key fields, priorities and neighbor ids as offsets + flat arrays """
+        keys = list(self.entries.keys())
+        values = list(self.entries.values())
+        priorities = [np.asarray(key[4], dtype=np.int32) for key in keys]
+        np.savez(filename,
+                 keys=np.asarray([key[:4] for key in keys], dtype=np.int32).reshape(-1, 4),
+                 priority_offsets=np.cumsum([0] + [len(p) for p in priorities]),
+                 priorities=np.concatenate(priorities) if len(keys) > 0 else np.zeros(0, dtype=np.int32),
+                 neighbor_offsets=np.cumsum([0] + [len(v) for v in values]),
+                 neighbors=np.concatenate(values) if len(keys) > 0 else np.zeros(0, dtype=np.int32))
+        print('[MSG] neighbor slot cache stored to:', filename)
+
+    @classmethod
+    def load(cls, filename, max_entries=65536):
+        cache = cls(max_entries)
+        if not os.path.isfile(filename):
+            return cache
+        data = np.load(filename)
+        p_off, n_off = data['priority_offsets'], data['neighbor_offsets']
+        priorities, neighbors = data['priorities'], data['neighbors']
+        for i, key in enumerate(data['keys'].tolist()):
+            priority = tuple(priorities[p_off[i]: p_off[i + 1]].tolist())
+            cache.put((bool(key[0]), key[1], key[2], key[3], priority), neighbors[n_off[i]: n_off[i + 1]])
+        print('[MSG] neighbor slot cache read from:', filename)
+        return cache
@@ -0,0 +1,159 @@
+"""This file contains a compact copy of the nuscenes tables used by NuscenesLoader (scene, sample, sample_annotation, instance,
+   log and the sample_data/ego_pose records of the RADAR_FRONT sensor). Each table is a npz file of numpy columns: tokens as
+   32 bytes strings, references to other tables as row numbers and names as ids of a list of values, plus the order that
+   sorts the tokens to find the row of a token with a binary search. Reading it takes seconds instead of the minutes of
+   NuScenes(), which loads and reverse indexes all the json tables.
+"""
+
+from collections.abc import Sequence
+import json
+import os
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+# columns kept of each table: field -> (kind, referenced table). Kinds: 'ref' row of a record of another table (-1 if none),
+# 'str' name, 'int', 'float' vector, 'sensor' token of the RADAR_FRONT sample_data, 'list' list of references
+SCHEMA = {
+    'log': {'location': ('str', None)},
+    'scene': {'name': ('str', None), 'log_token': ('ref', 'log'), 'first_sample_token': ('ref', 'sample'),
+              'last_sample_token': ('ref', 'sample')},
+    'sample': {'timestamp': ('int', None), 'scene_token': ('ref', 'scene'), 'prev': ('ref', 'sample'),
+               'next': ('ref', 'sample'), 'data': ('sensor', 'sample_data'), 'anns': ('list', 'sample_annotation')},
+    'sample_annotation': {'sample_token': ('ref', 'sample'), 'instance_token': ('ref', 'instance'),
+                          'category_name': ('str', None), 'translation': ('float', None), 'rotation': ('float', None),
+                          'prev': ('ref', 'sample_annotation'), 'next': ('ref', 'sample_annotation')},
+    'instance': {'category_token': ('str', None), 'first_annotation_token': ('ref', 'sample_annotation'),
+                 'last_annotation_token': ('ref', 'sample_annotation'), 'nbr_annotations': ('int', None)},
+    'sample_data': {'ego_pose_token': ('ref', 'ego_pose')},
+    'ego_pose': {'translation': ('float', None), 'rotation': ('float', None)},
+}
+SENSOR = 'RADAR_FRONT'
+
+
+# -------------------------------------------------------------- WRITE --------------------------------------------------------------
+def save_nuscenes_tables(nuscenes, path, version=None, dataroot=None):
+    """
+    one time conversion of the tables of a NuScenes object to the compact format in the directory path.
+    :param nuscenes: NuScenes object
+    :param path    : directory of the table files
+    :param version : nuscenes version, stored in the header
+    :param dataroot: directory of the nuscenes dataset, stored in the header
+    :return        : None
+    """
+    os.makedirs(path, exist_ok=True)
+    records = {table: getattr(nuscenes, table) for table in SCHEMA if table not in ('sample_data', 'ego_pose')}
+    # only the sample_data and ego_pose records of the sensor used for the ego pose
+    records['sample_data'] = [nuscenes.get('sample_data', sample['data'][SENSOR]) for sample in records['sample']]
+    records['ego_pose'] = [nuscenes.get('ego_pose', sample_data['ego_pose_token']) for sample_data in records['sample_data']]
+    rows = {table: {record['token']: row for row, record in enumerate(table_records)} for table, table_records in records.items()}
+
+    for table, fields in SCHEMA.items():
+        table_records = records[table]
+        tokens = np.array([record['token'] for record in table_records], dtype='S32')
+        arrays = {'token': tokens, 'token_order': np.argsort(tokens, kind='stable').astype(np.int32)}
+        for field, (kind, target) in fields.items():
+            if kind == 'ref':
+                arrays[field] = np.array([rows[target].get(record[field], -1) for record in table_records], dtype=np.int32)
+            elif kind == 'sensor':
+                arrays[field] = np.array([rows[target][record[field][SENSOR]] for record in table_records], dtype=np.int32)
+            elif kind == 'list':
+                values = [[rows[target][token] for token in record[field]] for record in table_records]
+                arrays[field + '_offsets'] = np.cumsum([0] + [len(v) for v in values]).astype(np.int64)
+                arrays[field] = np.array([row for v in values for row in v], dtype=np.int32)
+            elif kind == 'str':
+                names = {}
+                arrays[field] = np.array([names.setdefault(record[field], len(names)) for record in table_records], dtype=np.int32)
+                arrays[field + '_values'] = np.array(list(names.keys()), dtype=str)
+            elif kind == 'int':
+                arrays[field] = np.array([record[field] for record in table_records], dtype=np.int64)
+            else:
+                arrays[field] = np.array([record[field] for record in table_records], dtype=np.float64).reshape(len(table_records), -1)
+        np.savez(os.path.join(path, table + '.npz'), **arrays)
+
+    with open(os.path.join(path, 'header.json'), 'w') as file:
+        json.dump({'format_version': FORMAT_VERSION, 'version': version, 'sensor': SENSOR,
+                   'dataroot': None if dataroot is None else os.path.abspath(dataroot)}, file, indent=1)
+    print('[MSG] nuscenes tables stored to:', path)
+
+
+# -------------------------------------------------------------- READ --------------------------------------------------------------
+class TableRecords(Sequence):
+    """ records of a table in row order, built when they are accessed """
+    def __init__(self, tables, table):
+        self.tables = tables
+        self.table = table
+
+    def __len__(self):
+        return len(self.tables.arrays[self.table]['token'])
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        return self.tables.record(self.table, row)
+
+
+class NuscenesTables:
+    """
+    replacement of the NuScenes object for NuscenesLoader: get(table, token) returns the same record (dictionary) NuScenes
+    returns with the fields of SCHEMA, and self.scene, self.sample, ... are the sequences of records of each table.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json'), 'r') as file:
+            self.header = json.load(file)
+        if self.header['format_version'] != FORMAT_VERSION:
+            raise RuntimeError('[ERR] unsupported nuscenes tables format version: ' + str(self.header['format_version']))
+        self.arrays = {}
+        self.sorted_tokens = {}
+        for table in SCHEMA:
+            with np.load(os.path.join(path, table + '.npz')) as data:
+                self.arrays[table] = {name: data[name] for name in data.files}
+            self.sorted_tokens[table] = self.arrays[table]['token'][self.arrays[table]['token_order']]
+            setattr(self, table, TableRecords(self, table))
+
+    @staticmethod
+    def exists(path, version=None, dataroot=None):
+        """ True if path has tables, built from the given nuscenes version and dataroot (if given) in this format version """
+        filename = os.path.join(path, 'header.json')
+        if not os.path.isfile(filename):
+            return False
+        with open(filename, 'r') as file:
+            header = json.load(file)
+        return header['format_version'] == FORMAT_VERSION and (version is None or header.get('version') == version) and \
+            (dataroot is None or header.get('dataroot') == os.path.abspath(dataroot))
+
+    def row(self, table, token) -> int:
+        """ row of the record of a token, KeyError if it does not exist """
+        key = token.encode() if isinstance(token, str) else token
+        sorted_tokens = self.sorted_tokens[table]
+        position = int(np.searchsorted(sorted_tokens, key))
+        if len(key) == 0 or position == len(sorted_tokens) or sorted_tokens[position] != key:
+            raise KeyError(token)
+        return int(self.arrays[table]['token_order'][position])
+
+    def token(self, table, row) -> str:
+        return '' if row < 0 else self.arrays[table]['token'][row].decode()
+
+    def record(self, table, row) -> dict:
+        arrays = self.arrays[table]
+        record = {'token': self.token(table, row)}
+        for field, (kind, target) in SCHEMA[table].items():
+            if kind == 'ref':
+                record[field] = self.token(target, arrays[field][row])
+            elif kind == 'sensor':
+                record[field] = {SENSOR: self.token(target, arrays[field][row])}
+            elif kind == 'list':
+                offsets = arrays[field + '_offsets']
+                record[field] = [self.token(target, value) for value in arrays[field][offsets[row]: offsets[row + 1]].tolist()]
+            elif kind == 'str':
+                record[field] = str(arrays[field + '_values'][arrays[field][row]])
+            elif kind == 'int':
+                record[field] = int(arrays[field][row])
+            else:
+                record[field] = arrays[field][row].tolist()
+        return record
+
+    def get(self, table, token) -> dict:
+        return self.record(table, self.row(table, token))
@@ -0,0 +1,152 @@
+"""This file contains a catalog of extracted samples (the dictionaries of InputQuery.get_TransformerCube_Input): one row by
+   sample with its scene, map, number of neighbors, origin pose and kinematic stats of the target agent, stored as numpy
+   columns. Each column keeps the order that sorts it and its sorted values, so subsets are selected with binary searches
+   and only the selected samples need to be read (see SampleStore.take). A SampleStore builds the catalog of its samples
+   from the rows written with each shard (see SampleStore.build_catalog), without reading the samples again.
+"""
+
+import numpy as np
+from Code.dataset.Vocabulary import Vocabulary
+
+
+# columns of the catalog. Categorical columns are stored as ids of a Vocabulary
+CATEGORICAL = ('name', 'scene', 'map_name')
+NUMERICAL = ('num_neighbors', 'origin_x', 'origin_y', 'origin_yaw', 'mean_speed', 'max_speed', 'path_length')
+
+
+def sample_row(sample, target_slot=0):
+    """
+    catalog values of a sample. Speeds and path length are in meters by step (the step duration depends on the dataset)
+    :param target_slot : slot of the target agent: 0 if the samples were extracted with use_ego_vehicles=True, else 1 (slot
+                         0 is the ego vehicle of the scene and the agent takes the first neighbor slot, see Agent.init_neighbors)
+    """
+    # a neighbor (slot > 0) is counted if it appears at least once in the past
+    past_mask = np.asarray(sample['past_neighMask'])
+    num_neighbors = int(np.count_nonzero((past_mask[:, 1:] == 0).any(axis=0)))
+    # target agent displacement between consecutive steps where it is present
+    full_traj = np.asarray(sample['full_traj'])
+    inp_seq_l = int(np.count_nonzero(np.asarray(sample['past_seqMask']) == 0))
+    present = np.concatenate([past_mask[:inp_seq_l, target_slot],
+                              np.asarray(sample['future_neighMask'])[1: len(full_traj) - inp_seq_l + 1, target_slot]]) == 0
+    steps = np.flatnonzero(present[1:] & present[:-1])
+    positions = full_traj[:, target_slot, :2]
+    speeds = np.hypot(*(positions[steps + 1] - positions[steps]).T) if len(steps) > 0 else np.zeros(1)
+    origin = sample['origin']
+    # plain python values, so rows can be stored as json (see SampleStore.append)
+    return {'name': sample['ego_id'], 'scene': sample.get('scene'), 'map_name': sample.get('map_name'),
+            'num_neighbors': num_neighbors, 'origin_x': float(origin[0]), 'origin_y': float(origin[1]),
+            'origin_yaw': float(origin[2]), 'mean_speed': float(speeds.mean()), 'max_speed': float(speeds.max()),
+            'path_length': float(speeds.sum())}
+
+
+class SampleCatalog:
+    """
+    columns of the samples: self.columns[name] is an array with one value by sample id (position of the sample in the list
+    or SampleStore it was built from). Categorical columns store the ids of self.vocabs[name], None values have id -1.
+    self.orders[name] is the order that sorts the column (np.argsort, stable) and self.sorted[name] the sorted column.
+    """
+    def __init__(self, columns: dict, vocabs: dict, orders: dict = None, sorted_columns: dict = None):
+        self.columns = columns
+        self.vocabs = vocabs
+        self.orders = orders if orders is not None else {name: np.argsort(column, kind='stable')
+                                                         for name, column in columns.items()}
+        self.sorted = sorted_columns if sorted_columns is not None else {name: column[self.orders[name]]
+                                                                         for name, column in columns.items()}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        build a catalog row by row, only the values of the rows are kept in memory
+        :param rows : iterable of sample_row dictionaries, in order of sample id
+        :return     : SampleCatalog
+        """
+        vocabs = {name: Vocabulary() for name in CATEGORICAL}
+        values = {name: [] for name in CATEGORICAL + NUMERICAL}
+        for row in rows:
+            for name, value in row.items():
+                if name in vocabs:
+                    value = -1 if value is None else vocabs[name].intern(value)
+                values[name].append(value)
+        columns = {name: np.asarray(values[name], dtype=np.int32) for name in CATEGORICAL}
+        columns['num_neighbors'] = np.asarray(values['num_neighbors'], dtype=np.int16)
+        for name in NUMERICAL[1:]:
+            columns[name] = np.asarray(values[name], dtype=np.float32)
+        return cls(columns, vocabs)
+
+    @classmethod
+    def from_samples(cls, samples, use_ego_vehicles=True):
+        """
+        build the catalog of an iterable of samples, read one at a time. The catalog of a SampleStore is built from the
+        rows stored with its shards instead (see SampleStore.build_catalog)
+        :param samples          : iterable of sample dictionaries
+        :param use_ego_vehicles : value used to extract the samples (see InputQuery.get_TransformerCube_Input), it gives the
+                                  slot of the target agent (see sample_row)
+        :return                 : SampleCatalog
+        """
+        target_slot = 0 if use_ego_vehicles else 1
+        return cls.from_rows(sample_row(sample, target_slot) for sample in samples)
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    # -------------------------------------------------------------- QUERIES --------------------------------------------------------------
+    def _range(self, name, low, high):
+        """ sample ids with low <= column <= high (None means no bound), in column order """
+        order = self.orders[name]
+        sorted_column = self.sorted[name]
+        start = 0 if low is None else np.searchsorted(sorted_column, low, side='left')
+        end = len(order) if high is None else np.searchsorted(sorted_column, high, side='right')
+        return order[start: end]
+
+    def _ids(self, name, condition):
+        if name in CATEGORICAL:
+            tokens = [condition] if isinstance(condition, str) or condition is None else condition
+            ids = [-1 if token is None else self.vocabs[name].lookup(token) for token in tokens]
+            # ids that are not in the vocabulary (-1) only match None when None was asked for
+            ids = np.unique([id_ for id_, token in zip(ids, tokens) if id_ >= 0 or token is None])
+            return np.concatenate([self._range(name, id_, id_) for id_ in ids.tolist()] + [np.zeros(0, dtype=np.int64)])
+        if isinstance(condition, tuple):
+            return self._range(name, *condition)
+        return self._range(name, condition, condition)
+
+    def select(self, **conditions):
+        """
+        get the ids of the samples that satisfy all the conditions, e.g.
+        catalog.select(map_name='singapore-onenorth', num_neighbors=(3, None), mean_speed=(None, 0.5))
+        :param conditions : column=value. Categorical columns accept a token or a list of tokens, numerical columns a value
+                            or a (low, high) range with inclusive bounds, None for no bound.
+        :return           : sorted int64 array of sample ids
+        """
+        selected = np.arange(len(self), dtype=np.int64)
+        for name, condition in conditions.items():
+            if name not in self.columns:
+                raise ValueError('unknown catalog column: ' + name)
+            selected = np.intersect1d(selected, self._ids(name, condition), assume_unique=True)
+        return selected
+
+    def get(self, sample_ids, name):
+        """ values of a column for some sample ids, tokens for categorical columns """
+        values = self.columns[name][np.asarray(sample_ids, dtype=np.int64)]
+        if name in CATEGORICAL:
+            return [None if id_ < 0 else self.vocabs[name].token(id_) for id_ in values.tolist()]
+        return values
+
+    # --------------------------------------------------- PERSISTENCE ---------------------------------------------------
+    def save(self, filename):
+        """ store the columns, their sort orders, sorted values and the vocabularies of the categorical columns in a npz file """
+        arrays = {'col_' + name: column for name, column in self.columns.items()}
+        arrays.update({'order_' + name: order for name, order in self.orders.items()})
+        arrays.update({'sorted_' + name: column for name, column in self.sorted.items()})
+        arrays.update({'vocab_' + name: vocab.to_array() for name, vocab in self.vocabs.items()})
+        np.savez(filename, **arrays)
+        print('[MSG] sample catalog stored to:', filename)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        names = CATEGORICAL + NUMERICAL
+        return cls({name: data['col_' + name] for name in names},
+                   {name: Vocabulary.from_array(data['vocab_' + name]) for name in CATEGORICAL},
+                   {name: data['order_' + name] for name in names},
+                   # catalogs stored before the sorted values were kept compute them again
+                   {name: data['sorted_' + name] for name in names} if 'sorted_name' in data.files else None)
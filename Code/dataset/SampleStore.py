@@ -0,0 +1,266 @@
+"""This file contains an append only store of extracted samples (the dictionaries of InputQuery.get_TransformerCube_Input).
+   A store is a directory with one pickle file (shard) by source chunk plus a manifest.json with the chunks already included
+   and their number of samples, so new chunks are added without reading or rewriting the existing shards. A source too large
+   to keep its samples in memory is written in fixed size shards while it is extracted (see ShardWriter). Each shard is
+   written with the catalog rows of its samples (see SampleCatalog.sample_row), so the catalog of the store is built without
+   reading the samples again (see build_catalog).
+"""
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from Code.dataset.SampleCatalog import SampleCatalog, sample_row
+from Code.utils import save_utils as dl
+
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+MANIFEST_LOCK = 'manifest.lock'
+CATALOG = 'catalog.npz'
+
+
+class SampleStore:
+    """
+    directory of sample shards. self.chunks is the list (in order of appending) of the manifest entries
+    {'name': source chunk, 'file': shard file, 'rows': catalog rows file, 'num_samples': number of samples}; sample i of
+    the store is found with the cumulative number of samples of the chunks (self.offsets). self.complete is the list of
+    sources written in shards whose last shard was appended (see ShardWriter).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []
+        self.complete = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        # last shard read, so consecutive samples of a chunk do not read the file again
+        self._shard_position = -1
+        self._shard = None
+        self.refresh()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, MANIFEST)
+
+    def refresh(self):
+        """ read the manifest again, so chunks appended by other processes become visible """
+        if not os.path.isfile(self.manifest_path):
+            return
+        with open(self.manifest_path, 'r') as file:
+            manifest = json.load(file)
+        if manifest['format_version'] != FORMAT_VERSION:
+            raise RuntimeError('[ERR] unsupported sample store format version: ' + str(manifest['format_version']))
+        self.chunks = manifest['chunks']
+        self.complete = manifest.get('complete', [])
+        self.offsets = np.cumsum([0] + [chunk['num_samples'] for chunk in self.chunks])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __contains__(self, chunk_name):
+        return any(chunk['name'] == str(chunk_name) for chunk in self.chunks)
+
+    def chunk_names(self):
+        return [chunk['name'] for chunk in self.chunks]
+
+    def is_complete(self, source):
+        """ True if source was appended as a chunk or all its shards were written (see ShardWriter) """
+        return str(source) in self or str(source) in self.complete
+
+    # -------------------------------------------------------------- WRITE --------------------------------------------------------------
+    @contextmanager
+    def locked(self):
+        """
+        exclusive lock of the manifest between processes. Writers read, modify and replace the manifest while holding it,
+        so a second writer never loses the chunks appended by the first one
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, MANIFEST_LOCK), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_manifest(self, chunks, complete):
+        """ replace the manifest (written to a temporary file and renamed, so a crash never truncates it). Hold locked() """
+        with open(self.manifest_path + '.tmp', 'w') as file:
+            json.dump({'format_version': FORMAT_VERSION, 'chunks': chunks, 'complete': complete}, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        self.refresh()
+
+    def mark_complete(self, source):
+        """ record that all the shards of source were written """
+        with self.locked():
+            if str(source) not in self.complete:
+                self.write_manifest(self.chunks, self.complete + [str(source)])
+
+    def append(self, chunk_name, samples: list, rows: list = None, target_slot=0):
+        """
+        add the samples of a source chunk to the store. The shard and its catalog rows are written first and the manifest
+        is replaced after them, so readers only see complete chunks. They are written while holding the manifest lock, so
+        concurrent writers append one after the other.
+        :param chunk_name : name of the source chunk (e.g. the chunk number). A chunk can only be appended once
+        :param samples    : list of samples of the chunk
+        :param rows       : catalog rows of the samples (see SampleCatalog.sample_row), computed here if None
+        :param target_slot: slot of the target agent of the samples, to compute their rows (see SampleCatalog.sample_row)
+        :return           : None
+        """
+        chunk_name = str(chunk_name)
+        if rows is None:
+            rows = [sample_row(sample, target_slot) for sample in samples]
+        with self.locked():
+            if chunk_name in self:
+                raise ValueError('chunk ' + chunk_name + ' is already in the store: ' + self.path)
+            filename = 'chunk_' + chunk_name + '.pkl'
+            rows_filename = 'chunk_' + chunk_name + '.rows.json'
+            dl.save_pkl_data(samples, os.path.join(self.path, filename + '.tmp'), protocol=4)
+            os.replace(os.path.join(self.path, filename + '.tmp'), os.path.join(self.path, filename))
+            with open(os.path.join(self.path, rows_filename + '.tmp'), 'w') as file:
+                json.dump(rows, file)
+            os.replace(os.path.join(self.path, rows_filename + '.tmp'), os.path.join(self.path, rows_filename))
+
+            self.write_manifest(self.chunks + [{'name': chunk_name, 'file': filename, 'rows': rows_filename,
+                                                'num_samples': len(samples)}], self.complete)
+
+    def build_catalog(self, target_slot=0):
+        """
+        build the SampleCatalog of all the samples of the store, row by row from the rows stored with each chunk, and
+        store it in catalog.npz. Chunks appended without rows are read to compute them
+        :param target_slot : slot of the target agent of the samples without stored rows (see SampleCatalog.sample_row)
+        :return            : SampleCatalog
+        """
+        self.refresh()
+        catalog = SampleCatalog.from_rows(self.iter_rows(target_slot))
+        catalog.save(os.path.join(self.path, CATALOG))
+        return catalog
+
+    # -------------------------------------------------------------- READ --------------------------------------------------------------
+    def load_chunk(self, position):
+        """ samples of the chunk in position of the manifest """
+        if position != self._shard_position:
+            self._shard = dl.load_pkl_data(os.path.join(self.path, self.chunks[position]['file']))
+            self._shard_position = position
+        return self._shard
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        position = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.load_chunk(position)[i - int(self.offsets[position])]
+
+    def take(self, indexes):
+        """ list with the samples of the given indexes (e.g. selected with a SampleCatalog). Each shard is read at most once """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if np.any((indexes < 0) | (indexes >= len(self))):
+            raise IndexError('sample indexes out of range')
+        positions = np.searchsorted(self.offsets, indexes, side='right') - 1
+        samples = [None] * len(indexes)
+        for j in np.argsort(positions, kind='stable').tolist():
+            samples[j] = self.load_chunk(int(positions[j]))[int(indexes[j] - self.offsets[positions[j]])]
+        return samples
+
+    def iter_rows(self, target_slot=0):
+        """ catalog rows of the samples of the store, in order of sample id """
+        for position, chunk in enumerate(self.chunks):
+            if 'rows' in chunk:
+                with open(os.path.join(self.path, chunk['rows']), 'r') as file:
+                    yield from json.load(file)
+            else:
+                yield from (sample_row(sample, target_slot) for sample in self.load_chunk(position))
+
+    def catalog(self):
+        """ SampleCatalog of the samples of the store, None if it was not built or samples were appended since then """
+        filename = os.path.join(self.path, CATALOG)
+        if not os.path.isfile(filename):
+            return None
+        catalog = SampleCatalog.load(filename)
+        return catalog if len(catalog) == len(self) else None
+
+    def __iter__(self):
+        for position in range(len(self.chunks)):
+            yield from self.load_chunk(position)
+
+    def load(self, chunk_names=None):
+        """ list with the samples of the given chunks (all of them if None), in order of appending """
+        samples = []
+        chunk_names = None if chunk_names is None else {str(name) for name in chunk_names}
+        for position, chunk in enumerate(self.chunks):
+            if chunk_names is None or chunk['name'] in chunk_names:
+                samples += self.load_chunk(position)
+        return samples
+
+
+class ShardWriter:
+    """
+    writer of the samples of a source (e.g. a chunk being extracted, see InputQuery.iter_TransformerCube_Input) to a
+    SampleStore in shards of shard_size samples, appended as chunks <source>_shard<k>. Only the samples of the current
+    shard are kept in memory, so a crash loses at most one shard. When the writer is created again for the same source,
+    self.skip is the number of samples of the shards already written: the extraction resumes after them passing it as skip
+    to InputQuery.iter_TransformerCube_Input, so they are not extracted again (nor their bitmaps written again).
+    The catalog row of each sample (see SampleCatalog.sample_row) is computed when it is written and stored with its shard.
+    """
+    def __init__(self, store: SampleStore, source, shard_size=4096, target_slot=0):
+        """ :param target_slot : slot of the target agent of the samples (see SampleCatalog.sample_row) """
+        self.store = store
+        self.source = str(source)
+        self.shard_size = shard_size
+        self.target_slot = target_slot
+        self.buffer = []
+        self.rows = []
+        self.store.refresh()
+        # shards and samples of the source already in the store
+        shards = [chunk for chunk in self.store.chunks if chunk['name'].startswith(self.source + '_shard')]
+        self.num_shards = len(shards)
+        self.skip = sum(chunk['num_samples'] for chunk in shards)
+        self.num_samples = self.skip
+
+    def shard_name(self, k):
+        return self.source + '_shard' + str(k).zfill(5)
+
+    def write(self, sample):
+        """ add a sample, that follows the self.skip samples already written """
+        self.buffer.append(sample)
+        self.rows.append(sample_row(sample, self.target_slot))
+        self.num_samples += 1
+        if len(self.buffer) == self.shard_size:
+            self.flush()
+
+    def write_all(self, samples):
+        """ write all the samples of an iterable and mark the source as complete """
+        for sample in samples:
+            self.write(sample)
+        self.close()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        self.store.append(self.shard_name(self.num_shards), self.buffer, self.rows)
+        self.num_shards += 1
+        self.buffer = []
+        self.rows = []
+
+    def close(self):
+        """ write the last shard and mark the source as complete """
+        self.flush()
+        self.store.mark_complete(self.source)
+        print('[MSG] source', self.source, 'written in', self.num_shards, 'shards,', self.num_samples, 'samples')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an interrupted source is not complete, its partial shard is lost
+        if exc_type is None:
+            self.close()
+
+
+def load_samples(path):
+    """ list of samples of a pickle file or of a SampleStore directory """
+    return SampleStore(path).load() if os.path.isdir(path) else dl.load_pkl_data(path)
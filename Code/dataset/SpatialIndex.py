@@ -0,0 +1,108 @@
+"""This file contains a spatial index over the positions of the prediction agents in each context (timestep) of a Dataset.
+   It is a uniform grid built with numpy: every (context, agent) position is assigned to a cell and the points are sorted by
+   (context, cell), so the agents of a cell in a context are a contiguous range found with a binary search.
+"""
+
+import numpy as np
+
+
+class ContextSpatialIndex:
+    """
+    uniform grid over the positions of the agents in each context. Answers batches of "k nearest agents within a radius of a
+    point in a context" queries without scanning all the agents of the context.
+    """
+    def __init__(self, frames, agent_ids, x, y, cell_size=10.):
+        """
+        :param frames    : context id of each point
+        :param agent_ids : agent id of each point
+        :param x         : x position of each point
+        :param y         : y position of each point
+        :param cell_size : size (meters) of the side of a cell
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        frames, agent_ids, x, y = np.asarray(frames)[valid], np.asarray(agent_ids)[valid], x[valid], y[valid]
+        self.cell_size = float(cell_size)
+        self.x_min = x.min() if len(x) > 0 else 0.
+        self.y_min = y.min() if len(y) > 0 else 0.
+        cells_x, cells_y = self._cells(x, y)
+        self.num_cells_x = int(cells_x.max()) + 1 if len(x) > 0 else 1
+        self.num_cells_y = int(cells_y.max()) + 1 if len(y) > 0 else 1
+
+        keys = self._keys(frames.astype(np.int64), cells_x, cells_y)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.agent_ids = agent_ids[order].astype(np.int32)
+        self.x = x[order].astype(np.float32)
+        self.y = y[order].astype(np.float32)
+
+    @classmethod
+    def from_dataset(cls, dataset, cell_size=10.):
+        """ build the index with the positions of all the prediction agents (dataset.agents) in each context """
+        frames, agent_ids, x, y = [], [], [], []
+        for agent_id, agent in dataset.agents.items():
+            step_ids, _ = agent.step_index()
+            frames.append(step_ids)
+            agent_ids.append(np.full(len(step_ids), agent_id, dtype=np.int32))
+            x.append(agent.step_column('x'))
+            y.append(agent.step_column('y'))
+        if len(frames) == 0:
+            return cls(*(np.zeros(0) for _ in range(4)), cell_size=cell_size)
+        return cls(np.concatenate(frames), np.concatenate(agent_ids), np.concatenate(x), np.concatenate(y), cell_size)
+
+    def _cells(self, x, y):
+        return (np.floor((x - self.x_min) / self.cell_size).astype(np.int64),
+                np.floor((y - self.y_min) / self.cell_size).astype(np.int64))
+
+    def _keys(self, frames, cells_x, cells_y):
+        return (frames * self.num_cells_x + cells_x) * self.num_cells_y + cells_y
+
+    def query(self, frames, centers, radius, k):
+        """
+        get the k nearest agents within radius meters of a point, for a batch of (context, point) queries.
+        :param frames : (B,) context id of each query
+        :param centers: (B, 2) x, y of each query
+        :param radius : search radius in meters
+        :param k      : max number of agents by query
+        :return       : (B, k) int32 agent ids sorted by distance (padded with -1) and (B, k) float32 distances (padded with inf)
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        B = len(frames)
+        ids = np.full((B, k), -1, dtype=np.int32)
+        distances = np.full((B, k), np.inf, dtype=np.float32)
+        if B == 0 or k == 0 or len(self.keys) == 0:
+            return ids, distances
+
+        # cells covered by the radius around each center: (B, C) with C = (2 * reach + 1) ** 2
+        reach = int(np.ceil(radius / self.cell_size))
+        steps = np.arange(-reach, reach + 1)
+        cells_x, cells_y = self._cells(centers[:, 0], centers[:, 1])
+        cells_x = cells_x[:, np.newaxis] + np.repeat(steps, len(steps))[np.newaxis, :]
+        cells_y = cells_y[:, np.newaxis] + np.tile(steps, len(steps))[np.newaxis, :]
+        inside = (cells_x >= 0) & (cells_x < self.num_cells_x) & (cells_y >= 0) & (cells_y < self.num_cells_y)
+        keys = self._keys(frames[:, np.newaxis], cells_x, cells_y)
+        starts = np.where(inside, np.searchsorted(self.keys, keys, side='left'), 0).ravel()
+        ends = np.where(inside, np.searchsorted(self.keys, keys, side='right'), 0).ravel()
+
+        # flatten the ranges of points of all the cells into candidate (query, point) pairs
+        counts = ends - starts
+        query_of_range = np.repeat(np.arange(B), keys.shape[1])
+        candidate_query = np.repeat(query_of_range, counts)
+        range_offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = np.repeat(starts, counts) + np.arange(counts.sum()) - range_offsets
+
+        candidate_distance = np.hypot(self.x[candidates] - centers[candidate_query, 0],
+                                      self.y[candidates] - centers[candidate_query, 1])
+        near = candidate_distance <= radius
+        candidates, candidate_query, candidate_distance = candidates[near], candidate_query[near], candidate_distance[near]
+
+        # sort by query and distance, keep the first k of each query
+        order = np.lexsort((candidate_distance, candidate_query))
+        candidates, candidate_query, candidate_distance = candidates[order], candidate_query[order], candidate_distance[order]
+        first_of_query = np.searchsorted(candidate_query, np.arange(B), side='left')
+        rank = np.arange(len(candidates)) - first_of_query[candidate_query]
+        keep = rank < k
+        ids[candidate_query[keep], rank[keep]] = self.agent_ids[candidates[keep]]
+        distances[candidate_query[keep], rank[keep]] = candidate_distance[keep]
+        return ids, distances
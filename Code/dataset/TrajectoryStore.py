@@ -0,0 +1,147 @@
+"""This file contains a columnar (struct-of-arrays) backend for the Dataset defined in DataModel.py.
+   Instead of keeping one python object per observation inside Agent.timesteps, every observation of every agent is a row
+   of contiguous float32 columns (x, y, rot, speed, accel, ego pose, ...). Rows of the same agent are contiguous, so an agent
+   is just an offset range [agent_offsets[a], agent_offsets[a + 1]) over the columns.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+
+
+# attributes of the timestep classes in DataModel.py that are stored as columns
+STEP_FIELDS = ('x', 'y', 'rot', 'speed', 'accel', 'heading_rate', 'x_speed', 'y_speed', 'x_accel', 'y_accel',
+               'ego_pos_x', 'ego_pos_y', 'ego_rot')
+
+
+class TrajectoryStore:
+    """
+    class to store the timesteps of all the agents of a Dataset as columns.
+    self.columns is a dictionary field_name -> float32 array with one entry per row (observation). Fields that a timestep
+    class does not define are stored as nan.
+
+    self.frame is an int32 array with the context id (see Dataset.context_vocab) of each row.
+    self.agent is an int32 array with the agent index of each row and self.agent_offsets (n_agents + 1) holds the row range
+    of each agent. self.agent_scene is the ego vehicle id (see Dataset.scene_vocab) of each agent.
+
+    self.step_types is a list of (timestep class, fields) used to rebuild timestep objects for code that still expects them.
+    """
+    def __init__(self):
+        self.columns = {field: np.zeros(0, dtype=np.float32) for field in STEP_FIELDS}
+        self.frame = np.zeros(0, dtype=np.int32)
+        self.agent = np.zeros(0, dtype=np.int32)
+        self.agent_offsets = np.zeros(1, dtype=np.int64)
+        self.agent_scene = np.zeros(0, dtype=np.int32)
+        self.agent_step_type = np.zeros(0, dtype=np.int8)
+        self.step_types = []
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def num_agents(self):
+        return len(self.agent_offsets) - 1
+
+    def nbytes(self):
+        arrays = list(self.columns.values()) + [self.frame, self.agent, self.agent_offsets, self.agent_scene,
+                                                self.agent_step_type]
+        return sum(array.nbytes for array in arrays)
+
+    @classmethod
+    def from_agents(cls, agents):
+        """
+        build the store from agent objects (see DataModel.Agent). Agents are indexed in the order they are given.
+        :param agents: iterable of agent objects whose timesteps are python objects keyed by int context ids
+        :return      : TrajectoryStore
+        """
+        store = cls()
+        step_type_index = {}
+        values = {field: [] for field in STEP_FIELDS}
+        frames, offsets, scenes, step_types = [], [0], [], []
+
+        for agent in agents:
+            steps = agent.timesteps
+            # all steps of an agent share the same class, so the first one defines its fields
+            first_step = next(iter(steps.values()), None)
+            fields = tuple(field for field in STEP_FIELDS if first_step is not None and field in vars(first_step))
+            type_key = (type(first_step), fields)
+            if step_type_index.get(type_key) is None:
+                step_type_index[type_key] = len(store.step_types)
+                store.step_types.append(type_key)
+            step_types.append(step_type_index[type_key])
+            scenes.append(agent.ego_id)
+
+            for step_id, step in steps.items():
+                frames.append(step_id)
+                step_vars = vars(step)
+                for field in STEP_FIELDS:
+                    values[field].append(step_vars.get(field, np.nan))
+            offsets.append(len(frames))
+
+        store.columns = {field: np.asarray(column, dtype=np.float32) for field, column in values.items()}
+        store.frame = np.asarray(frames, dtype=np.int32)
+        store.agent_offsets = np.asarray(offsets, dtype=np.int64)
+        store.agent = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(store.agent_offsets))
+        store.agent_scene = np.asarray(scenes, dtype=np.int32)
+        store.agent_step_type = np.asarray(step_types, dtype=np.int8)
+        return store
+
+    def get_step(self, row):
+        """ rebuild the timestep object (class of DataModel.py) stored in a row """
+        step_class, fields = self.step_types[self.agent_step_type[self.agent[row]]]
+        step = step_class.__new__(step_class)
+        for field in fields:
+            setattr(step, field, float(self.columns[field][row]))
+        return step
+
+
+class ColumnarTimesteps(Mapping):
+    """
+    read only view with the same interface as the Agent.timesteps dictionary (step_id -> timestep object), but backed by
+    the rows of one agent in a TrajectoryStore. Keys are iterated in insertion order, as in the original dictionary.
+    """
+    def __init__(self, store: TrajectoryStore, agent_index: int):
+        self.store = store
+        self.agent_index = agent_index
+        self._positions = None
+
+    def __getstate__(self):
+        # positions are rebuilt on demand
+        return {'store': self.store, 'agent_index': self.agent_index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._positions = None
+
+    @property
+    def start(self):
+        return int(self.store.agent_offsets[self.agent_index])
+
+    @property
+    def end(self):
+        return int(self.store.agent_offsets[self.agent_index + 1])
+
+    def step_ids(self):
+        """ int32 array with the step ids of the agent in order (a view, no copy) """
+        return self.store.frame[self.start: self.end]
+
+    def column(self, field):
+        """ float32 array with a field of all the steps of the agent in order (a view, no copy) """
+        return self.store.columns[field][self.start: self.end]
+
+    def positions(self):
+        """ dictionary step_id -> position of the step inside the agent trajectory """
+        if self._positions is None:
+            self._positions = {frame: i for i, frame in enumerate(self.store.frame[self.start: self.end].tolist())}
+        return self._positions
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(self.store.frame[self.start: self.end].tolist())
+
+    def __contains__(self, step_id):
+        return step_id in self.positions()
+
+    def __getitem__(self, step_id):
+        return self.store.get_step(self.start + self.positions()[step_id])
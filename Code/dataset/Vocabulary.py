@@ -0,0 +1,60 @@
+"""This file contains the vocabulary used to intern the external ids of a dataset (nuscenes tokens, shifts scene ids, ...)
+   as dense int ids, so the Dataset only carries ints and the strings are only needed to export results.
+"""
+
+import numpy as np
+
+
+class Vocabulary:
+    """
+    class to map external tokens to dense ids 0, 1, ..., len(vocabulary) - 1 in order of first appearance.
+    self.ids is the dictionary token -> id and self.tokens is the reverse table id -> token. A vocabulary read from disk
+    (see from_array) keeps the tokens in a numpy array and builds self.ids only when a token is looked up.
+    """
+    def __init__(self, tokens=()):
+        self._ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.intern(token)
+
+    @classmethod
+    def from_array(cls, tokens: np.ndarray):
+        vocab = cls()
+        vocab.tokens = tokens
+        vocab._ids = None
+        return vocab
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = {str(token): id_ for id_, token in enumerate(self.tokens)}
+        return self._ids
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+    def intern(self, token) -> int:
+        """ get the id of the token, adding it to the vocabulary if it does not exist """
+        id_ = self.ids.get(token)
+        if id_ is None:
+            if isinstance(self.tokens, np.ndarray):
+                self.tokens = self.tokens.tolist()
+            id_ = len(self.tokens)
+            self.ids[token] = id_
+            self.tokens.append(token)
+        return id_
+
+    def lookup(self, token, default=-1) -> int:
+        """ get the id of the token without adding it, default if it does not exist """
+        return self.ids.get(token, default)
+
+    def token(self, id_):
+        """ get the external token of an id """
+        return str(self.tokens[id_])
+
+    def to_array(self):
+        """ reverse table as a numpy array (id -> token), useful to export ids """
+        return np.asarray(self.tokens, dtype=str)
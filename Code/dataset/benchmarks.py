@@ -0,0 +1,242 @@
+"""This file contains benchmarks of the dataset structures. They use synthetic shifts-like scenes so they can be run without
+   the real datasets, e.g. python -m Code.dataset.benchmarks
+"""
+
+import pickle
+import time
+import tracemalloc
+
+import numpy as np
+from Code.dataset.DataModel import *
+
+
+# -------------------------------------------------------------- SYNTHETIC DATA --------------------------------------------------------------
+def build_synthetic_dataset(num_scenes=100, agents_by_scene=20, steps_by_scene=50, seed=0):
+    """
+    build a Dataset with the same structure the ShiftsLoader builds (one ego vehicle by scene, contexts by timestep).
+    :param num_scenes     : number of scenes (ego vehicles)
+    :param agents_by_scene: number of prediction agents in each scene
+    :param steps_by_scene : number of timesteps of each scene
+    :return               : Dataset
+    """
+    rng = np.random.default_rng(seed)
+    dataset = Dataset(verbose=False)
+    for s in range(num_scenes):
+        scene_id = 'scene' + str(s)
+        ego_id = dataset.scene_vocab.intern(scene_id)
+        ego_vehicle = ShiftsEgoVehicle(ego_id, scene_id)
+        dataset.add_ego_vehicle(ego_id, ego_vehicle)
+        context_ids = []
+        for i in range(steps_by_scene):
+            context_id = dataset.context_vocab.intern(scene_id + '_' + str(i))
+            dataset.add_context(context_id, Context(context_id))
+            ego_vehicle.add_step(context_id, ShiftsEgoStep(*rng.normal(size=7)))
+            context_ids.append(context_id)
+
+        for a in range(agents_by_scene):
+            agent_id = dataset.agent_vocab.intern(scene_id + '_' + str(a))
+            agent = ShiftsAgent(agent_id, ego_id, scene_id)
+            dataset.add_agent(agent_id, agent)
+            # agents appear in a random sub interval of the scene
+            first = int(rng.integers(0, steps_by_scene // 2))
+            for context_id in context_ids[first:]:
+                agent.add_step(context_id, ShiftTimeStep(*rng.normal(size=10)))
+                dataset.insert_context_neighbor(agent_id, context_id)
+    return dataset
+
+
+def measure_load(data: bytes):
+    """ unpickle data and return (seconds, bytes allocated by the loaded object) """
+    tracemalloc.start()
+    start = time.perf_counter()
+    obj = pickle.loads(data)
+    seconds = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return seconds, memory
+
+
+# -------------------------------------------------------------- BENCHMARKS --------------------------------------------------------------
+def benchmark_columnar_store(num_scenes=200, agents_by_scene=20, steps_by_scene=50):
+    """ compare pickle size, load time and memory of the object model against the columnar TrajectoryStore """
+    dataset = build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene)
+    objects_data = pickle.dumps(dataset, pickle.HIGHEST_PROTOCOL)
+    dataset.compact()
+    columnar_data = pickle.dumps(dataset, pickle.HIGHEST_PROTOCOL)
+
+    results = {}
+    for name, data in (('objects', objects_data), ('columnar', columnar_data)):
+        seconds, memory = measure_load(data)
+        results[name] = {'pickle_MB': len(data) / 2 ** 20, 'load_s': seconds, 'memory_MB': memory / 2 ** 20}
+        print('[{}] pickle: {:.1f} MB, load: {:.3f} s, memory: {:.1f} MB'.format(name, results[name]['pickle_MB'],
+                                                                              seconds, results[name]['memory_MB']))
+    return results
+
+
+def benchmark_window_slicing(track_length=2000, window=50):
+    """ compare list(agent.timesteps.items())[start: end] against the positional index (Agent.step_index) on a long track """
+    dataset = build_synthetic_dataset(num_scenes=1, agents_by_scene=1, steps_by_scene=track_length)
+    ego_vehicle = next(iter(dataset.ego_vehicles.values()))
+    starts = range(0, track_length - window)
+
+    start_time = time.perf_counter()
+    for start in starts:
+        timesteps = list(ego_vehicle.timesteps.items())[start: start + window]
+        origin = timesteps[window // 2][1]
+    list_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for start in starts:
+        step_ids, _ = ego_vehicle.step_index()
+        timesteps = step_ids[start: start + window].tolist()
+        origin = ego_vehicle.timesteps[timesteps[window // 2]]
+    index_seconds = time.perf_counter() - start_time
+
+    print('[window slicing] list: {:.4f} s, index: {:.4f} s, speedup: {:.1f}x'.format(list_seconds, index_seconds,
+                                                                                      list_seconds / index_seconds))
+    return list_seconds, index_seconds
+
+
+def benchmark_window_builder(num_scenes=100, agents_by_scene=20, steps_by_scene=50, L=25, N=10):
+    """
+    compare the inputs of all the windows built one neighbor at a time (get_features, object model) against the store
+    gathers of InputQuery.build_windows, one window at a time (get_egocentered_input) and all the windows at once
+    """
+    from Code.dataset.InputQuery import InputQuery
+    loader = type('BenchmarkLoader', (), {})()
+    loader.dataset = build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene)
+    objects_query = InputQuery(loader)
+    loader.dataset = build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene)
+    loader.dataset.compact()
+    columnar_query = InputQuery(loader)
+    windows = loader.dataset.get_trajectory_windows(L=L, overlap=L // 2)
+
+    def build_one_by_one(query):
+        ego_vehicles = query.dataset.ego_vehicles
+        return [query.get_egocentered_input(ego_vehicles[ego_id], query.dataset.agents, L, N, offset=L // 2,
+                                            window=(start, end))[0] for ego_id, start, end in windows.tolist()]
+
+    start_time = time.perf_counter()
+    objects_inputs = build_one_by_one(objects_query)
+    objects_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    build_one_by_one(columnar_query)
+    window_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    batch_inputs, _, _ = columnar_query.get_window_inputs(windows, L, N, offset=L // 2)
+    batch_seconds = time.perf_counter() - start_time
+
+    # the object model keeps float64 values, the store float32
+    same = np.allclose(np.stack(objects_inputs), batch_inputs, atol=1e-4)
+    print('[window builder] {} windows, objects: {:.3f} s, store by window: {:.3f} s, store batch: {:.3f} s, speedup: {:.1f}x, '
+          'same values: {}'.format(len(windows), objects_seconds, window_seconds, batch_seconds,
+                                   objects_seconds / batch_seconds, same))
+    return objects_seconds, window_seconds, batch_seconds
+
+
+def benchmark_memmap_open(path='/tmp/benchmark_dataset', num_scenes=200, agents_by_scene=20, steps_by_scene=50):
+    """ compare the time to load a pickled dataset against opening it as memory mapped arrays (see DatasetFile.py) """
+    from Code.dataset.DatasetFile import save_dataset, open_dataset
+    dataset = build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene)
+    data = pickle.dumps(dataset, pickle.HIGHEST_PROTOCOL)
+    save_dataset(dataset, path)
+
+    start_time = time.perf_counter()
+    pickle.loads(data)
+    pickle_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    opened = open_dataset(path, verbose=False)
+    open_seconds = time.perf_counter() - start_time
+    # first query: one timestep of one ego vehicle
+    start_time = time.perf_counter()
+    ego_vehicle = opened.ego_vehicles[0]
+    ego_vehicle.timesteps[int(ego_vehicle.step_index()[0][0])]
+    query_seconds = time.perf_counter() - start_time
+
+    print('[memmap] pickle load: {:.3f} s, open: {:.4f} s, first query: {:.4f} s'.format(pickle_seconds, open_seconds,
+                                                                                          query_seconds))
+    return pickle_seconds, open_seconds, query_seconds
+
+
+def benchmark_nuscenes_kinematics(dataroot='/data/sets/nuscenes', version='v1.0-mini'):
+    """
+    compare speed, accel and heading rate of all the annotations with PredictHelper (one call by annotation) against the
+    finite differences over each annotation chain used by NuscenesLoader.load_data. It needs the nuscenes devkit and the
+    dataset in dataroot, so it is not run with the synthetic benchmarks of __main__.
+    :return : seconds of PredictHelper and of the vectorized path
+    """
+    from nuscenes.nuscenes import NuScenes
+    from nuscenes.prediction import PredictHelper
+    from Code.dataset.nuscenes_dataloader import get_track_kinematics, quaternions_yaw
+    nuscenes = NuScenes(version, dataroot=dataroot, verbose=False)
+    helper = PredictHelper(nuscenes)
+    chains = []
+    for instance in nuscenes.instance:
+        annotations = [nuscenes.get('sample_annotation', instance['first_annotation_token'])]
+        while annotations[-1]['next'] != '':
+            annotations.append(nuscenes.get('sample_annotation', annotations[-1]['next']))
+        chains.append(annotations)
+
+    start_time = time.perf_counter()
+    helper_values = []
+    for annotations in chains:
+        for annotation in annotations:
+            instance_token, sample_token = annotation['instance_token'], annotation['sample_token']
+            helper_values.append((helper.get_velocity_for_agent(instance_token, sample_token),
+                                  helper.get_acceleration_for_agent(instance_token, sample_token),
+                                  helper.get_heading_change_rate_for_agent(instance_token, sample_token)))
+    helper_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    vectorized_values = []
+    for annotations in chains:
+        timestamps = 1e-6 * np.array([nuscenes.get('sample', a['sample_token'])['timestamp'] for a in annotations])
+        positions = np.array([a['translation'][:2] for a in annotations])
+        yaws = quaternions_yaw(np.array([a['rotation'] for a in annotations]))
+        vectorized_values.append(np.column_stack(get_track_kinematics(timestamps, positions, yaws)))
+    vectorized_seconds = time.perf_counter() - start_time
+
+    helper_values = np.array(helper_values, dtype=np.float64)
+    vectorized_values = np.concatenate(vectorized_values)
+    same = np.allclose(helper_values, vectorized_values, atol=1e-6, equal_nan=True)
+    print('[nuscenes kinematics] {} annotations, PredictHelper: {:.3f} s, vectorized: {:.3f} s, speedup: {:.1f}x, '
+          'same values: {}'.format(len(helper_values), helper_seconds, vectorized_seconds,
+                                   helper_seconds / vectorized_seconds, same))
+    return helper_seconds, vectorized_seconds
+
+
+def benchmark_parallel_extraction(num_workers=(1, 2, 4, 8), num_scenes=200, agents_by_scene=20, steps_by_scene=50, L=25, N=10):
+    """
+    time InputQuery.get_TransformerCube_Input with a serial run and with each number of forked workers, and check that the
+    parallel runs return the same inputs in the same order. The speedup depends on the cores of the machine
+    (os.cpu_count is printed with the timings).
+    :return : dictionary number of workers -> seconds
+    """
+    import os
+    from Code.dataset.InputQuery import InputQuery
+    loader = type('BenchmarkLoader', (), {})()
+    loader.dataset = build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene)
+    loader.dataset.compact()
+    query = InputQuery(loader)
+
+    seconds, serial_inputs = {}, None
+    for workers in num_workers:
+        start_time = time.perf_counter()
+        inputs = query.get_TransformerCube_Input(L // 2, L // 2, N, offset=L // 2 - 1, num_workers=workers)
+        seconds[workers] = time.perf_counter() - start_time
+        if serial_inputs is None:
+            serial_inputs = inputs
+        same = len(inputs) == len(serial_inputs) and all(np.array_equal(a['full_traj'], b['full_traj'])
+                                                         for a, b in zip(inputs, serial_inputs))
+        print('[parallel extraction] {} cores, {} inputs, {} workers: {:.3f} s, speedup: {:.1f}x, same inputs: {}'.format(
+            os.cpu_count(), len(inputs), workers, seconds[workers], seconds[num_workers[0]] / seconds[workers], same))
+    return seconds
+
+
+if __name__ == '__main__':
+    benchmark_columnar_store()
+    benchmark_window_slicing()
+    benchmark_window_builder()
+    benchmark_memmap_open()
+    benchmark_parallel_extraction()
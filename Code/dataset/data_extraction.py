@@ -5,6 +5,8 @@ import os
 from Code.dataset.nuscenes_dataloader import NuscenesLoader
 from Code.dataset.shifts_dataloader import ShiftsLoader
 from Code.dataset.InputQuery import *
+from Code.dataset.DatasetFile import open_dataset
+from Code.dataset.SampleStore import SampleStore, ShardWriter
 from Code.utils import save_utils as dl
 
 
@@ -22,14 +24,32 @@ from Code.utils import save_utils as dl
 
 
 def shifts_extraction(past_length, future_length, neighbors, get_bitmaps: bool, origin_offset=None,
-                      pickle=True, data_start=1, data_end=18, force_overwrite=False):
+                      pickle=True, data_start=1, data_end=18, force_overwrite=False, store_path=None, num_workers=1,
+                      non_pred_policy='keep', shard_size=None, compact=False, columnar=False):
+    """
+    extract the samples of the shifts chunks data_start, ..., data_end. If store_path is given, the samples of each chunk are
+    appended to the SampleStore in store_path (chunks already in its manifest are skipped), else each chunk is stored in
+    its own pickle file (see join_data). num_workers processes decode the scene files of chunks loaded from scratch and
+    extract the samples (see InputQuery.get_TransformerCube_Input).
+    non_pred_policy is what is stored of the tracks that are not prediction requests (see ShiftsLoader).
+    If shard_size is given with store_path, the samples of each chunk are written to the store in shards of shard_size
+    samples while they are extracted (see SampleStore.ShardWriter), so they are never all in memory.
+    If compact is True, samples are stored as CompactSample objects (see CompactSample.py).
+    If columnar is True, the loaders keep the timesteps in a TrajectoryStore (see Loader).
+    The SampleCatalog of the store is built from the rows written with its chunks and stored in it (see
+    SampleStore.build_catalog).
+    """
     assert(data_start >= 1 and data_end <= 188)
     dataroot = '/data/shifts/data/train'
 
     if origin_offset is None:
         origin_offset = past_length - 1
+    store = SampleStore(store_path) if store_path is not None else None
 
     for chunk_number in range(data_start, data_end + 1):
+        if store is not None and store.is_complete(chunk_number):
+            print('[MSG] chunk', chunk_number, 'is already in the sample store. Skipping it')
+            continue
         # path of preloaded data
         pickle_filename = '/data/shifts/train/data_chunk' + str(chunk_number) + '.pkl'
         # path to store inputs
@@ -40,14 +60,27 @@ def shifts_extraction(past_length, future_length, neighbors, get_bitmaps: bool,
         # START EXTRACTION
         chunk_start = (chunk_number-1) * 2000
         chunk_end = chunk_number * 2000
-        shifts_loader = ShiftsLoader(DATAROOT=dataroot, pickle=pickle, pickle_filename=pickle_filename, chunk=(chunk_start, chunk_end))
+        shifts_loader = ShiftsLoader(DATAROOT=dataroot, pickle=pickle, pickle_filename=pickle_filename, chunk=(chunk_start, chunk_end),
+                                     num_workers=num_workers, non_pred_policy=non_pred_policy, columnar=columnar)
         inputQuery = InputQuery(shifts_loader)
         shifts_bitmap = ShiftsBitmap() if get_bitmaps else None
+        if store is not None and shard_size is not None:
+            writer = ShardWriter(store, chunk_number, shard_size)
+            inputs = inputQuery.iter_TransformerCube_Input(past_length, future_length, neighbors, origin_offset,
+                                                           bitmap_extractor=shifts_bitmap, path=maps_path, num_workers=num_workers,
+                                                           compact=compact, skip=writer.skip)
+            writer.write_all(inputs)
+            shifts_loader.save_slot_cache()
+            continue
         inputs = inputQuery.get_TransformerCube_Input(past_length, future_length, neighbors, origin_offset,
-                                                      bitmap_extractor=shifts_bitmap, path=maps_path)
+                                                      bitmap_extractor=shifts_bitmap, path=maps_path, num_workers=num_workers,
+                                                      compact=compact)
+        shifts_loader.save_slot_cache()
 
+        if store is not None:
+            store.append(chunk_number, inputs)
         # dealing with existing files
-        if os.path.isfile(final_path) and not force_overwrite:
+        elif os.path.isfile(final_path) and not force_overwrite:
             print('file: ', final_path, ' exists. Do you want to overwrite it?:')
             answer = input()
             if answer.lower() == 'yes':
@@ -57,8 +90,12 @@ def shifts_extraction(past_length, future_length, neighbors, get_bitmaps: bool,
         else:
             dl.save_pkl_data(inputs, final_path)
 
+    if store is not None:
+        store.build_catalog()
+
 
 def join_data(prepath, start, end):
+    """ join the pickle files of the chunks start, ..., end. Chunks appended to a SampleStore do not need it """
     assert(start >= 1 and end <= 188)
     inputs = []
     for i in range(start, end+1):
@@ -71,7 +108,18 @@ def join_data(prepath, start, end):
 
 
 def nuscenes_extraction(past_length, future_length, neighbors, get_bitmaps: bool, origin_offset=None,
-                        pickle=True, data_partition='train'):
+                        pickle=True, data_partition='train', num_workers=1, store_path=None, shard_size=4096,
+                        compact=False, columnar=False):
+    """
+    extract the samples of a nuscenes partition, num_workers processes extract them (see InputQuery.get_TransformerCube_Input).
+    If store_path is given, the samples are written to the SampleStore in store_path in shards of shard_size samples while
+    they are extracted (see SampleStore.ShardWriter) instead of being stored in a single pickle file. An interrupted
+    extraction resumes after the shards already written, and a partition already complete in the store is skipped.
+    If compact is True, samples are stored as CompactSample objects (see CompactSample.py).
+    If columnar is True, the loader keeps the timesteps in a TrajectoryStore (see Loader).
+    The SampleCatalog of the store is built from the rows written with its shards and stored in it (see
+    SampleStore.build_catalog).
+    """
     # PATH
     dataroot_base = '/data/sets/nuscenes'
     dataroot_train = '/media/juan/Elements'
@@ -90,12 +138,32 @@ def nuscenes_extraction(past_length, future_length, neighbors, get_bitmaps: bool
     final_path = '../data/nuscenes_extended/train/neigh_' + str(neighbors) + '/nuscenes_data.pkl'
     # create needed directories
     dl.valid_path(maps_path, os.path.dirname(final_path))
+    store = SampleStore(store_path) if store_path is not None else None
+    if store is not None and store.is_complete(data_partition):
+        print('[MSG] partition', data_partition, 'is already in the sample store. Skipping it')
+        return
     # START EXTRACTION
-    nuscenes_loader = NuscenesLoader(DATAROOT=dataroot, pickle=pickle, version=version, data_name=data_name, loadMap=True)
+    nuscenes_loader = NuscenesLoader(DATAROOT=dataroot, pickle=pickle, version=version, data_name=data_name, loadMap=True,
+                                     columnar=columnar)
     inputQuery = InputQuery(nuscenes_loader)
     nusc_bitmap = NuscenesBitmap(nuscenes_loader.maps) if get_bitmaps else None
+    if get_bitmaps and num_workers > 1:
+        # parse the maps once, before the workers are forked, so they share them
+        nuscenes_loader.maps.preload()
+    if store is not None:
+        # the target agent takes slot 1 of the samples of use_ego_vehicles=False
+        writer = ShardWriter(store, data_partition, shard_size, target_slot=1)
+        inputs = inputQuery.iter_TransformerCube_Input(past_length, future_length, neighbors, origin_offset,
+                                                       use_ego_vehicles=False, bitmap_extractor=nusc_bitmap, path=maps_path,
+                                                       rotate=True, num_workers=num_workers, compact=compact, skip=writer.skip)
+        writer.write_all(inputs)
+        nuscenes_loader.save_slot_cache()
+        store.build_catalog(target_slot=1)
+        return
     inputs = inputQuery.get_TransformerCube_Input(past_length, future_length, neighbors, origin_offset,
-                                                  use_ego_vehicles=False, bitmap_extractor=nusc_bitmap, path=maps_path, rotate=True)
+                                                  use_ego_vehicles=False, bitmap_extractor=nusc_bitmap, path=maps_path, rotate=True,
+                                                  num_workers=num_workers, compact=compact)
+    nuscenes_loader.save_slot_cache()
     dl.save_pkl_data(inputs, final_path)
 
 
@@ -104,10 +172,11 @@ def get_origin(dataroot):
     files = glob.glob(dataroot)
     for filename in files:
         print('processing file: ', filename)
-        data:Dataset = dl.load_pkl_data(filename)
+        # datasets stored as memory mapped arrays only read the ego vehicle rows
+        data:Dataset = open_dataset(filename) if os.path.isdir(filename) else dl.load_pkl_data(filename)
         for ego_vehicle in data.ego_vehicles.values():
-            origin = list(ego_vehicle.timesteps.values())[24]
-            origins_info[ego_vehicle.agent_id] = [origin.to_tuple(), ego_vehicle.map_name]
+            origin = ego_vehicle.timesteps[int(ego_vehicle.step_index()[0][24])]
+            origins_info[data.scene_vocab.token(ego_vehicle.agent_id)] = [origin.to_tuple(), ego_vehicle.map_name]
 
     dl.save_pkl_data(origins_info, 'origins_info.pkl', 4)
 
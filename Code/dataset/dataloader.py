@@ -1,9 +1,15 @@
 
 from Code.dataset.DataModel import Dataset
+from Code.dataset.NeighborSlotCache import NeighborSlotCache
+from Code.dataset.DatasetFile import save_dataset, open_dataset, FORMAT_VERSION
+from Code.dataset.LoaderCache import LoaderCache
 
 # utilities
 import numpy as np
+import json
+import os
 import pickle
+import tempfile
 
 
 # -------------------------------------------------------------- BASE CLASS ------------------------------------------------------
@@ -23,25 +29,146 @@ class Loader:
              information for the ego vehicle and an agent.
 
     * self.dataset should be obtained when the implementarion of load_data() is called
+    * if columnar is True, the dataset is compacted (see Dataset.compact) before being stored and after being read, so
+      the timesteps of the agents are kept in a TrajectoryStore instead of one object per timestep.
+    * the neighbor slot cache of the dataset (see NeighborSlotCache.py) is stored next to the pickle file, in
+      <pickle_filename>.slots.npz, with save_slot_cache() and read with the pickle data. Storing new data (save_data)
+      removes the slot cache of the previous one.
+    * if memmap is True, processed data is stored as a directory of memory mapped arrays (see DatasetFile.py) instead of a
+      pickle file, so the pickle_filename of the loaders is the path of that directory. In that case max_resident_scenes
+      bounds the number of scenes materialized at the same time (see DatasetFile.ResidentScenes), None keeps all of them.
+    * if cache_dir is given, processed data is stored in a LoaderCache (see LoaderCache.py) instead of pickle_filename: the
+      filename is the hash of the loader parameters (see cache_filename), so data processed with other parameters, source
+      or code version (cache_version) is never read, and cache_max_bytes bounds the size of the cache. Without a cache, the
+      parameters are stored next to the data in <pickle_filename>.params.json, and data of other parameters (e.g. another
+      split stored in the same pickle_filename) is processed again instead of being read. Data stored without a parameters
+      file (before they were stored) is read with a warning.
     """
+    # version of the data stored by the loader, bump it when load_data changes what it stores
+    cache_version = 1
 
-    def __init__(self, DATAROOT, verbose):
+    def __init__(self, DATAROOT, verbose, columnar=False, memmap=False, max_resident_scenes=None, cache_dir=None,
+                 cache_max_bytes=None):
         self.DATAROOT = DATAROOT
+        self.columnar = columnar
+        self.memmap = memmap
+        self.max_resident_scenes = max_resident_scenes
         self.origin_offset = 0
         #self.dataset: dict = {'agents': {}, 'ego_vehicles': {}}
         self.dataset = Dataset()
         self.verbose = verbose
         self.maps = None
+        self.pickle_filename = None
+        self.cache = LoaderCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        # parameters of the processed data (see cache_filename)
+        self.data_params = None
 
     def load_data(self, *args):
         """ method to load data and should be called in the constructor"""
         raise NotImplementedError
 
+    def cache_filename(self, pickle_filename, **params):
+        """
+        filename of the processed data: pickle_filename without a cache, else the entry of the cache for the parameters of
+        the loader (class, version, DATAROOT, format) and the given params (split, chunk, options that change the data).
+        The parameters are kept in self.data_params
+        """
+        params.update({'loader': type(self).__name__, 'cache_version': self.cache_version, 'format_version': FORMAT_VERSION,
+                       'DATAROOT': os.path.abspath(self.DATAROOT), 'columnar': self.columnar, 'memmap': self.memmap})
+        self.data_params = json.loads(json.dumps(params, sort_keys=True, default=str))
+        if self.cache is None:
+            return pickle_filename
+        return self.cache.entry(params, self.memmap)
+
+    # verify if processed data of the parameters of the loader (if known) was already stored in filename
+    def saved_data_exists(self, filename):
+        if self.memmap:
+            exists = os.path.isfile(os.path.join(filename, 'header.json'))
+        else:
+            exists = os.path.isfile(filename)
+        # cache entries are named by their parameters, other files store them next to the data
+        if self.cache is not None:
+            return exists and self.cache.is_complete(filename)
+        if not exists or self.data_params is None:
+            return exists
+        # data stored before the parameters were written next to it is accepted as it is, rebuilding it can take hours
+        if not os.path.isfile(filename + '.params.json'):
+            print('[WARN] data stored in', filename, 'has no parameters file, it is assumed to match the loader parameters.',
+                  'Remove it to process the data again')
+            return True
+        with open(filename + '.params.json', 'r') as file:
+            params = json.load(file)
+        if params != self.data_params:
+            print('[WARN] data stored in', filename, 'was processed with other parameters, it is processed again')
+            return False
+        return True
+
+    # store processed data in the format of the loader
+    def save_data(self, filename):
+        # the slot cache of a previous dataset refers to its agent ids, which a rebuild can assign differently
+        if os.path.isfile(filename + '.slots.npz'):
+            os.remove(filename + '.slots.npz')
+            print('[MSG] removed the neighbor slot cache of the previous data: ', filename + '.slots.npz') if self.verbose else None
+        # the parameters are written once the data is complete
+        if os.path.isfile(filename + '.params.json'):
+            os.remove(filename + '.params.json')
+        if self.cache is not None and self.cache.is_complete(filename):
+            os.remove(self.cache.info_filename(filename))
+        if self.memmap:
+            self.save_memmap_data(filename)
+        else:
+            self.save_pickle_data(filename)
+        if self.cache is None and self.data_params is not None:
+            with open(filename + '.params.json', 'w') as file:
+                json.dump(self.data_params, file, indent=1, sort_keys=True)
+        if self.cache is not None:
+            self.cache.complete(filename, self.data_params)
+            self.cache.evict(keep=filename)
+
+    # read processed data in the format of the loader
+    def read_data(self, filename):
+        if self.cache is not None:
+            self.cache.touch(filename)
+        if self.memmap:
+            return self.load_memmap_data(filename)
+        return self.load_pickle_data(filename)
+
+    # store processed data as memory mapped arrays
+    def save_memmap_data(self, path):
+        self.pickle_filename = path
+        save_dataset(self.dataset, path)
+
+    # open processed data stored as memory mapped arrays
+    def load_memmap_data(self, path):
+        if not os.path.isfile(os.path.join(path, 'header.json')):
+            print('[WARN] directory does not contain dataset files: ', path)
+            return False
+        self.pickle_filename = path
+        self.dataset = open_dataset(path, self.verbose, self.max_resident_scenes)
+        self.dataset.slot_cache = NeighborSlotCache.load(path + '.slots.npz')
+        return True
+
     # store processed data in pkl files
     def save_pickle_data(self, filename):
-        with open(filename, 'wb') as file:
-            pickle.dump(self.dataset, file, pickle.HIGHEST_PROTOCOL)
-            print("data stored succesfully to: ", filename)
+        self.pickle_filename = filename
+        if self.columnar:
+            self.dataset.compact()
+        # written to a temporary file of its own first, so an interrupted run (or another process storing the same data)
+        # never leaves a truncated pickle in filename
+        descriptor, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                                    prefix=os.path.basename(filename) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                pickle.dump(self.dataset, file, pickle.HIGHEST_PROTOCOL)
+            # mkstemp files are only readable by their owner, the pickle keeps the permissions of a file created with open
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_filename, 0o666 & ~umask)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        print("data stored succesfully to: ", filename)
 
     # read processed data in pkl files
     def load_pickle_data(self, filename):
@@ -49,9 +176,19 @@ class Loader:
             file = open(filename, 'rb')
             self.dataset = pickle.load(file)
             file.close()
+            self.pickle_filename = filename
+            if self.columnar:
+                self.dataset.compact()
+            self.dataset.slot_cache = NeighborSlotCache.load(filename + '.slots.npz')
             print('[MSG] pickle data read succesfuly from: ', filename)
             return True
 
         except FileNotFoundError:
             print('[WARN] file does not exist to read pickle data: ', filename)
             return False
+
+    # store the neighbor slot cache next to the pickle file, so following extractions can reuse it
+    def save_slot_cache(self, filename=None):
+        filename = self.pickle_filename if filename is None else filename
+        if filename is not None and self.dataset.slot_cache is not None:
+            self.dataset.slot_cache.save(filename + '.slots.npz')
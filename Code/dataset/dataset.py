@@ -1,6 +1,7 @@
 
 import numpy as np
 import tensorflow as tf
+from Code.dataset.CompactSample import CompactSample, padded_view
 
 
 def stamp_positions_in_bitmap(inputs: np.ndarray, masks: np.ndarray, bitmaps: np.ndarray,
@@ -145,7 +146,85 @@ AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
 #@tf.function
+def compact_element(traj, mask, split):
+    """
+    arrays of an element of buildDataset derived from a compact sample (see CompactSample), the same buildDataset builds
+    for its sample dictionary: past, past_speed, past_seq_mask, past_neigh_mask, past_speed_mask, extra_mask, future,
+    future_speed, future_seq_mask, future_neigh_mask, future_speed_mask, future_shifted
+    :param traj  : (S, N, 3) float32 trajectory
+    :param mask  : (S, N) uint8 neighbor mask
+    :param split : length of the past
+    """
+    seq_l = len(traj)
+    length = max(split, seq_l - split + 1)
+    element = []
+    for start, end in ((0, split), (split - 1, seq_l)):
+        values, neigh_mask, _ = padded_view(traj, mask, start, end, length)
+        seq_mask = adapt_seq_mask(neigh_mask)
+        spa_mask, extra_mask = adapt_spa_mask(neigh_mask)
+        speed = np.transpose(values[1:] - values[:-1], [1, 0, 2])
+        element += [values, speed, seq_mask, spa_mask, seq_mask[:, :, :, 1:]] + ([extra_mask] if start == 0 else [])
+    future = element[6]
+    element.append(future[:, :, :2] - future[0, :, :2][np.newaxis])
+    return tuple(array.astype(np.float32) for array in element)
+
+
+def compact_speed_std(trajs, masks, split):
+    """ std_x, std_y of buildDataset (past speeds taken in pairs of values), one past at a time """
+    seq_l = trajs.shape[1]
+    length = max(split, seq_l - split + 1)
+    sums, squares, counts = np.zeros(2), np.zeros(2), np.zeros(2)
+    position = 0
+    for traj, mask in zip(trajs, masks):
+        past = padded_view(traj, mask, 0, split, length)[0]
+        values = (past[1:] - past[:-1]).ravel().astype(np.float64)
+        # values of the dataset are taken in pairs, the first one of this past might be the second of a pair
+        parity = (position + np.arange(len(values))) % 2
+        for column in range(2):
+            sums[column] += values[parity == column].sum()
+            squares[column] += np.square(values[parity == column]).sum()
+            counts[column] += np.count_nonzero(parity == column)
+        position += len(values)
+    means = sums / counts
+    return np.sqrt(squares / counts - means ** 2).astype(np.float32)
+
+
+def buildCompactDataset(inputs, batch_size, pre_path=None, strategy: tf.distribute.MirroredStrategy=None, shuffle=True):
+    """
+    buildDataset of compact samples (see CompactSample). Only their trajectories (x, y, yaw) and neighbor masks are kept
+    in memory, the past and future views and their masks are derived for each element in the input pipeline
+    (see compact_element), so they are never materialized for the whole dataset.
+    """
+    split = inputs[0].split
+    trajs = np.stack([input_.traj[:, :, :3] for input_ in inputs])
+    masks = np.stack([input_.mask for input_ in inputs])
+    yaws = np.array([float(input_['origin_yaw']) for input_ in inputs], dtype=np.float32)
+    ids = [pre_path + input_['ego_id'] + '.npz' for input_ in inputs]
+    std_x, std_y = compact_speed_std(trajs, masks, split)
+    # shapes of the derived arrays, numpy_function does not know them
+    shapes = [array.shape for array in compact_element(trajs[0], masks[0], split)]
+
+    def derive(traj, mask, yaw, id_):
+        element = tf.numpy_function(func=lambda t, m: compact_element(t, m, split), inp=[traj, mask],
+                                    Tout=[tf.float32] * len(shapes))
+        element = [tf.ensure_shape(array, shape) for array, shape in zip(element, shapes)]
+        bitmaps = tf.numpy_function(func=get_npz_bitmaps, inp=[id_, element[0], element[3], yaw], Tout=tf.float32)
+        return tuple(element[:6]), tuple(element[6:11]), bitmaps, (element[11], traj, yaw, id_)
+
+    dataset = tf.data.Dataset.from_tensor_slices((trajs, masks, yaws, ids))
+    dataset = dataset.map(derive, num_parallel_calls=AUTOTUNE)
+    # SHUFFLE AND BATCH
+    dataset = dataset.batch(batch_size, drop_remainder=True).prefetch(AUTOTUNE)
+    if strategy is not None:
+        dataset = strategy.experimental_distribute_dataset(dataset)
+
+    return dataset, std_x, std_y
+
+
 def buildDataset(inputs, batch_size, pre_path=None, strategy: tf.distribute.MirroredStrategy=None, shuffle=True):
+    # compact samples keep a single trajectory, their views are derived in the input pipeline
+    if isinstance(inputs[0], CompactSample):
+        return buildCompactDataset(inputs, batch_size, pre_path, strategy, shuffle)
     batch_size_per_replica = batch_size
     if strategy is not None:
         num_replicas = strategy.num_replicas_in_sync
@@ -2,9 +2,13 @@
 # base class
 from Code.dataset.dataloader import Loader
 from Code.dataset.DataModel import *
+from Code.dataset.NuscenesTables import NuscenesTables, save_nuscenes_tables
 
 # tools
+import multiprocessing
 import os.path
+import time
+from collections.abc import Mapping
 
 # data manipulation and graphics
 import numpy as np
@@ -22,6 +26,115 @@ from nuscenes.map_expansion import arcline_path_utils
 from nuscenes.map_expansion.bitmap import BitMap
 
 
+# -------------------------------------------------------------- KINEMATICS -----------------------------------------------------------
+def quaternions_yaw(quaternions: np.ndarray) -> np.ndarray:
+    """ yaw of (n, 4) quaternions w, x, y, z as nuscenes quaternion_yaw (angle of the rotated x axis) """
+    w, x, y, z = (quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)).T
+    return np.arctan2(2 * (w * z + x * y), 1 - 2 * (y ** 2 + z ** 2))
+
+
+def quaternions_rotation(quaternions: np.ndarray) -> np.ndarray:
+    """ yaw of (n, 4) quaternions w, x, y, z as Quaternion(q).yaw_pitch_roll[0], used as rotation of the timesteps """
+    w, x, y, z = (quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)).T
+    return np.arctan2(2 * (w * z - x * y), 1 - 2 * (y ** 2 + z ** 2))
+
+
+def get_track_kinematics(timestamps: np.ndarray, positions: np.ndarray, yaws: np.ndarray, max_time_diff=1.5) -> tuple:
+    """
+    speed, acceleration and heading change rate of all the annotations of a track with finite differences, with the same
+    semantics of PredictHelper.get_velocity_for_agent, get_acceleration_for_agent and get_heading_change_rate_for_agent:
+    each value uses the previous annotation, and it is nan for the first one or if they are more than max_time_diff apart.
+    :param timestamps   : (n,) seconds of each annotation
+    :param positions    : (n, 2) x, y of each annotation
+    :param yaws         : (n,) yaw of each annotation
+    :return             : speed (n,), accel (n,), heading_rate (n,)
+    """
+    n = len(timestamps)
+    speed, accel, heading_rate = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+    if n < 2:
+        return speed, accel, heading_rate
+    time_diff = np.diff(timestamps)
+    valid = time_diff <= max_time_diff
+    speed[1:] = np.where(valid, np.linalg.norm(np.diff(positions, axis=0), axis=1) / time_diff, np.nan)
+    accel[1:] = np.where(valid, (speed[1:] - speed[:-1]) / time_diff, np.nan)
+    # angle difference in [-pi, pi)
+    yaw_diff = (np.diff(yaws) + np.pi) % (2 * np.pi) - np.pi
+    heading_rate[1:] = np.where(valid, yaw_diff / time_diff, np.nan)
+    return speed, accel, heading_rate
+
+
+# -------------------------------------------------------------- MAPS -----------------------------------------------------------
+NUSCENES_MAP_NAMES = ('singapore-onenorth', 'singapore-hollandvillage', 'singapore-queenstown', 'boston-seaport')
+# maps already parsed in this process: (dataroot, map_name) -> NuScenesMap, and their (seconds, RSS bytes) to be loaded.
+# Worker processes forked after a map is loaded share the parsed map with the parent
+_loaded_maps = {}
+_map_stats = {}
+
+
+def current_rss():
+    """ resident set size of the process in bytes (0 if /proc is not available) """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class NuscenesMaps(Mapping):
+    """
+    read only dictionary map_name -> NuScenesMap. Each map is parsed the first time it is accessed and shared by all the
+    loaders of the process. To share them with a pool of workers, call preload() before the pool is created (fork).
+    """
+    def __init__(self, dataroot, verbose=True):
+        self.dataroot = dataroot
+        self.verbose = verbose
+
+    def __len__(self):
+        return len(NUSCENES_MAP_NAMES)
+
+    def __iter__(self):
+        return iter(NUSCENES_MAP_NAMES)
+
+    def __contains__(self, map_name):
+        return map_name in NUSCENES_MAP_NAMES
+
+    def __getitem__(self, map_name):
+        if map_name not in self:
+            raise KeyError(map_name)
+        key = (self.dataroot, map_name)
+        nusc_map = _loaded_maps.get(key)
+        if nusc_map is None:
+            rss, start_time = current_rss(), time.perf_counter()
+            nusc_map = NuScenesMap(dataroot=self.dataroot, map_name=map_name)
+            _map_stats[key] = (time.perf_counter() - start_time, current_rss() - rss)
+            _loaded_maps[key] = nusc_map
+            print('[MSG] map {} loaded in {:.2f} s, RSS: +{:.1f} MB'.format(map_name, _map_stats[key][0],
+                                                                          _map_stats[key][1] / 2 ** 20)) if self.verbose else None
+        return nusc_map
+
+    def loaded(self):
+        """ names of the maps already parsed """
+        return [map_name for map_name in NUSCENES_MAP_NAMES if (self.dataroot, map_name) in _loaded_maps]
+
+    def preload(self, map_names=None):
+        """ parse the given maps (all of them if None), e.g. before forking workers so they share them """
+        for map_name in (NUSCENES_MAP_NAMES if map_names is None else map_names):
+            self[map_name]
+
+    def stats(self):
+        """ map_name -> (seconds, RSS bytes) that took to load each parsed map """
+        return {map_name: _map_stats[(self.dataroot, map_name)] for map_name in self.loaded()}
+
+
+# -------------------------------------------------------------- WORKERS -----------------------------------------------------------
+# loader used by the workers of NuscenesLoader.load_data, inherited when they are forked
+_worker_loader = None
+
+
+def _load_tracks(instance_tokens):
+    return [_worker_loader.load_track(instance_token) for instance_token in instance_tokens]
+
+
 # -------------------------------------------------------------- NUSCENES LOADER CLASS -----------------------------------------------------------
 class NuscenesLoader(Loader):
     """
@@ -38,197 +151,318 @@ class NuscenesLoader(Loader):
     """
 
     def __init__(self, DATAROOT='/data/sets/nuscenes', pickle=True, pickle_filename='/data/sets/nuscenes/pickle/nuscenes_data.pkl',
-                 version='v1.0-mini', data_name='mini_train', loadMap=True, verbose=True, rel_offset=10):
-
+                 version='v1.0-mini', data_name='mini_train', loadMap=True, verbose=True, rel_offset=10, columnar=False, memmap=False,
+                 max_resident_scenes=None, tables_path=None, num_workers=1, context_categories=False, cache_dir=None,
+                 cache_max_bytes=None):
+        """
+        :param data_name   : prediction split to load ('mini_train', 'mini_val', 'train', 'train_val' or 'val') or list of
+                             splits. Agents of several splits are loaded once (see load_data)
+        :param columnar    : keep the timesteps in a TrajectoryStore (see Loader). Off by default, so stored pickles keep
+                             the object model
+        :param tables_path : directory of the compact nuscenes tables (see NuscenesTables). If it exists, it is used instead of
+                             NuScenes() to load data from scratch, else it is created the first time data is loaded. Tables
+                             of another version or DATAROOT are rebuilt.
+        :param num_workers : number of processes used to load the agents from scratch (see load_data)
+        :param context_categories: if True, load the humans, objects and non prediction vehicles of each context (see
+                                   load_context_categories). Off by default, the models do not consume them
+        :param cache_dir   : directory of the loader cache (see Loader). If given, pickle_filename is ignored
+        """
         # parent constructor
-        super(NuscenesLoader, self).__init__(DATAROOT, verbose)
+        super(NuscenesLoader, self).__init__(DATAROOT, verbose, columnar, memmap, max_resident_scenes, cache_dir, cache_max_bytes)
 
         # specify nuscenes attributes
         self.version: str = version
         self.data_name: str = data_name
+        self.splits: tuple = (data_name,) if isinstance(data_name, str) else tuple(data_name)
+        # split -> instance tokens of the split (see get_split_instances)
+        self.split_instances = {}
         self.rel_offset = rel_offset
         self.nuscenes = None
         self.helper = None
+        # sample tables indexed by context id (see load_sample_tables)
+        self.ego_poses = None
+        self.sample_timestamps = None
 
-        # nuscenes map expansion attributes
+        # nuscenes map expansion attributes, each map is loaded the first time it is used (see NuscenesMaps)
         if loadMap:
-            self.maps = {
-                'singapore-onenorth': NuScenesMap(dataroot=DATAROOT, map_name='singapore-onenorth'),
-                'singapore-hollandvillage': NuScenesMap(dataroot=DATAROOT, map_name='singapore-hollandvillage'),
-                'singapore-queenstown': NuScenesMap(dataroot=DATAROOT, map_name='singapore-queenstown'),
-                'boston-seaport': NuScenesMap(dataroot=DATAROOT, map_name='boston-seaport')
-            }
+            self.maps = NuscenesMaps(DATAROOT, verbose)
 
+        # processed data of these parameters in the loader cache, if any (see Loader.cache_filename)
+        pickle_filename = self.cache_filename(pickle_filename, version=version, splits=list(self.splits), rel_offset=rel_offset,
+                                              context_categories=context_categories)
         # flag to indicate if data can be loaded from pickle files
-        pickle_ok: bool = os.path.isfile(pickle_filename)
+        pickle_ok: bool = self.saved_data_exists(pickle_filename)
 
         if pickle and pickle_ok:
             # its okay to read pickle files to load data
-            self.load_pickle_data(pickle_filename)
+            self.read_data(pickle_filename)
 
         else:
             # load data from scratch
-            self.nuscenes = NuScenes(version, dataroot=DATAROOT)
-            self.helper = PredictHelper(self.nuscenes)
+            self.load_nuscenes(tables_path)
             self.get_context_information()
+            self.load_sample_tables()
             self.load_ego_vehicles()
-            self.load_data()
-            self.save_pickle_data(pickle_filename)
+            self.load_data(num_workers)
+            if context_categories:
+                self.load_context_categories()
+            self.save_data(pickle_filename)
 
         NuscenesAgent.context_dict = self.dataset.contexts
 
+    def load_nuscenes(self, tables_path=None):
+        """
+        set self.nuscenes with the compact tables of tables_path if they exist and were built from self.version and
+        self.DATAROOT, else with NuScenes() (and store the tables, replacing the ones of other versions)
+        """
+        if tables_path is not None and NuscenesTables.exists(tables_path, self.version, self.DATAROOT):
+            print('[MSG] reading nuscenes tables from: ', tables_path) if self.verbose else None
+            self.nuscenes = NuscenesTables(tables_path)
+            return
+        self.nuscenes = NuScenes(self.version, dataroot=self.DATAROOT)
+        self.helper = PredictHelper(self.nuscenes)
+        if tables_path is not None:
+            if NuscenesTables.exists(tables_path):
+                print('[WARN] nuscenes tables of another version or dataroot are rebuilt: ', tables_path)
+            save_nuscenes_tables(self.nuscenes, tables_path, self.version, self.DATAROOT)
+
     # set verbose mode which determines if it should print the relevant information while processing the data
     def setVerbose(self, verbose: bool):
         self.verbose = verbose
 
-    # get attributes of and agent in a specific moment in time (sample)
-    def __get_agent_attributes(self, sample_annotation) -> tuple:
-        # get tokens and sample
-        sample_token = sample_annotation['sample_token']
-        instance_token = sample_annotation['instance_token']
-        sample = self.nuscenes.get('sample', sample_token)
-
-        # get attributes
-        abs_pos = sample_annotation['translation']
-        rotation = Quaternion(sample_annotation['rotation']).yaw_pitch_roll[0]
-        speed = self.helper.get_velocity_for_agent(instance_token, sample_token)
-        accel = self.helper.get_acceleration_for_agent(instance_token, sample_token)
-        heading_rate = self.helper.get_heading_change_rate_for_agent(instance_token, sample_token)
-
-        # get sample_data_token of a sensor to read EGO_POSE
-        sample_data_token = sample['data']['RADAR_FRONT']
-
-        # get ego_pose
-        ego_pose_token = self.nuscenes.get('sample_data', sample_data_token)['ego_pose_token']
-        ego_pose = self.nuscenes.get('ego_pose', ego_pose_token)
-        ego_pose_x, ego_pose_y = ego_pose['translation'][:2]
-        ego_rotation = Quaternion(ego_pose['rotation']).yaw_pitch_roll[0]
-
-        return abs_pos[0], abs_pos[1], rotation, speed, accel, heading_rate, ego_pose_x, ego_pose_y, ego_rotation
+    def load_sample_tables(self):
+        """
+        build the tables of all the samples indexed by context id: self.ego_poses (samples, 3) with the ego x, y and rotation,
+        read from the RADAR_FRONT sensor, and self.sample_timestamps (samples,) in seconds.
+        :return: None
+        """
+        samples = self.nuscenes.sample
+        context_ids = np.array([self.dataset.context_vocab.intern(sample['token']) for sample in samples], dtype=np.int64)
+        # sample -> sample_data of RADAR_FRONT -> ego_pose
+        ego_poses = [self.nuscenes.get('ego_pose', self.nuscenes.get('sample_data', sample['data']['RADAR_FRONT'])['ego_pose_token'])
+                     for sample in samples]
+        translations = np.array([ego_pose['translation'][:2] for ego_pose in ego_poses], dtype=np.float64).reshape(-1, 2)
+        rotations = np.array([ego_pose['rotation'] for ego_pose in ego_poses], dtype=np.float64).reshape(-1, 4)
+
+        self.ego_poses = np.full((len(self.dataset.context_vocab), 3), np.nan)
+        self.ego_poses[context_ids, :2] = translations
+        self.ego_poses[context_ids, 2] = quaternions_rotation(rotations)
+        self.sample_timestamps = np.full(len(self.dataset.context_vocab), np.nan)
+        self.sample_timestamps[context_ids] = 1e-6 * np.array([sample['timestamp'] for sample in samples], dtype=np.float64)
+
+    # get attributes of an agent in all the samples (context ids) of its annotation chain
+    def __get_track_attributes(self, annotations: list, context_ids: list) -> np.ndarray:
+        timestamps = self.sample_timestamps[context_ids]
+        positions = np.array([annotation['translation'][:2] for annotation in annotations], dtype=np.float64)
+        quaternions = np.array([annotation['rotation'] for annotation in annotations], dtype=np.float64).reshape(-1, 4)
+        rotations = quaternions_rotation(quaternions)
+        speed, accel, heading_rate = get_track_kinematics(timestamps, positions, quaternions_yaw(quaternions))
+
+        # columns: pos_x, pos_y, rotation, speed, accel, heading_rate, ego_pose_x, ego_pose_y, ego_rotation
+        return np.column_stack([positions, rotations, speed, accel, heading_rate, self.ego_poses[context_ids]])
 
     def load_ego_vehicles(self):
         scenes = self.nuscenes.scene
         # traverse all scenes (basically all ego-vehicles)
         for scene in scenes:
-            # read token and use it as id for ego_vehicle
-            token = scene['token']
+            # read token and intern it as id for ego_vehicle
+            ego_id = self.dataset.scene_vocab.intern(scene['token'])
             # get the map_name of the agent
             location = self.nuscenes.get('log', scene['log_token'])['location']
             # add ego vehicle to dataset
-            self.dataset.add_ego_vehicle(token, NuscenesEgoVehicle(token, location))
+            self.dataset.add_ego_vehicle(ego_id, NuscenesEgoVehicle(ego_id, location))
             # read its first sample token
             sample_token = scene['first_sample_token']
             # traverse all timesteps
             while sample_token != '':
                 sample = self.nuscenes.get('sample', sample_token)
-                # get sample_data_token of a sensor to read EGO_POSE
-                sample_data_token = sample['data']['RADAR_FRONT']
-                # get ego_pose
-                ego_pose_token = self.nuscenes.get('sample_data', sample_data_token)['ego_pose_token']
-                ego_pose = self.nuscenes.get('ego_pose', ego_pose_token)
-                ego_pose_x, ego_pose_y = ego_pose['translation'][:2]
-                ego_rotation = Quaternion(ego_pose['rotation']).yaw_pitch_roll[0]
-                # add egostep
-                self.dataset.ego_vehicles[token].add_step(sample_token, Egostep(ego_pose_x, ego_pose_y, ego_rotation))
+                # add egostep with the ego_pose of the sample
+                context_id = self.dataset.context_vocab.intern(sample_token)
+                ego_pose_x, ego_pose_y, ego_rotation = self.ego_poses[context_id].tolist()
+                self.dataset.ego_vehicles[ego_id].add_step(context_id, Egostep(ego_pose_x, ego_pose_y, ego_rotation))
                 sample_token = sample['next']
 
-    def load_data(self):
+    def load_track(self, instance_token) -> tuple:
+        """
+        read the whole annotation chain of an instance. Contexts should have been loaded (see get_context_information).
+        :return: scene token, location (map name), context ids and attributes (see __get_track_attributes) of the chain
+        """
+        instance = self.nuscenes.get('instance', instance_token)
+        # get head_annotation
+        first_annotation_token: str = instance['first_annotation_token']
+        first_annotation: dict = self.nuscenes.get('sample_annotation', first_annotation_token)
+        # tmp annotation to traverse them
+        tmp_annotation = first_annotation
+        # get the map_name of the agent
+        scene_token = self.nuscenes.get('sample', first_annotation['sample_token'])['scene_token']
+        scene = self.nuscenes.get('scene', scene_token)
+        location = self.nuscenes.get('log', scene['log_token'])['location']
+
+        # traverse forward sample_annotations from first_annotation to get the whole annotation chain
+        annotations = []
+        while tmp_annotation is not None:
+            annotations.append(tmp_annotation)
+            # move to next sample_annotation if possible
+            try:
+                tmp_annotation = self.nuscenes.get('sample_annotation', tmp_annotation['next'])
+            except KeyError:
+                tmp_annotation = None
+
+        # attributes of all the chain as rows: [0]-> pos_x, [1]-> pos_y, [2]-> rotation, [3]-> speed, [4]-> accel,
+        # [5]-> heading_rate, [6]-> ego_pose_x, [7]-> ego_pose_y, [8]-> ego_rotation
+        context_ids = [self.dataset.context_vocab.lookup(annotation['sample_token']) for annotation in annotations]
+        return scene_token, location, context_ids, self.__get_track_attributes(annotations, context_ids)
+
+    def get_split_instances(self, split) -> list:
+        """ instance tokens of a prediction split in order of first appearance, read once by split """
+        instance_tokens = self.split_instances.get(split)
+        if instance_tokens is None:
+            # list of the form <instance_token>_<sample_token>
+            tokens: list = get_prediction_challenge_split(split, dataroot=self.DATAROOT)
+            instance_tokens = list(dict.fromkeys(token.split("_")[0] for token in tokens))
+            self.split_instances[split] = instance_tokens
+        return instance_tokens
+
+    def get_split_agents(self, split) -> list:
+        """ ids of the agents of a prediction split, e.g. to extract a single split (ego_ids of get_TransformerCube_Input) """
+        agent_ids = [self.dataset.agent_vocab.lookup(token) for token in self.get_split_instances(split)]
+        return [agent_id for agent_id in agent_ids if agent_id in self.dataset.agents]
+
+    def load_data(self, num_workers=1):
         """
-        this function traverses the agents in the nuscenes scheme and stores all the relevant information such as positions, rotations, etc.
+        this function traverses the agents of the requested splits (self.splits) in the nuscenes scheme and stores all the
+        relevant information such as positions, rotations, etc. Agents in several splits are loaded once.
+        :param num_workers: number of processes that read the annotation chains of the instances. The instances are split in
+                            contiguous partitions and the tracks are added to the dataset in the order of the instances, so
+                            the dataset is the same for any number of workers.
         :return: None
         """
-        # list of the form <instance_token>_<sample_token>
-        train: list = get_prediction_challenge_split('train', dataroot=self.DATAROOT)
-        trainval: list = get_prediction_challenge_split('train_val', dataroot=self.DATAROOT)
-        val: list = get_prediction_challenge_split('val', dataroot=self.DATAROOT)
-
-        mini_train = train + trainval + val
-        # split instance_token from sample_token
-        inst_sampl_tokens = np.array([token.split("_") for token in mini_train])
-        instance_tokens = set(inst_sampl_tokens[:, 0])
+        # instances of all the splits in order of first appearance
+        instance_tokens = list(dict.fromkeys(token for split in self.splits for token in self.get_split_instances(split)))
         # self.dictionary of agents to make access easier
         agents: dict[NuscenesAgent] = self.dataset.agents
+        # skip the agents that already exist, their information was already retrieved
+        instance_tokens = [token for token in instance_tokens if agents.get(self.dataset.agent_vocab.lookup(token)) is None]
+
+        if num_workers > 1 and len(instance_tokens) > 0:
+            global _worker_loader
+            _worker_loader = self
+            bounds = np.linspace(0, len(instance_tokens), min(4 * num_workers, len(instance_tokens)) + 1).astype(int).tolist()
+            partitions = [instance_tokens[start: end] for start, end in zip(bounds[:-1], bounds[1:])]
+            # workers are forked, so they share the nuscenes tables and the contexts already loaded
+            try:
+                with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                    tracks = [track for partition in pool.map(_load_tracks, partitions) for track in partition]
+            finally:
+                _worker_loader = None
+        else:
+            tracks = map(self.load_track, instance_tokens)
 
         # traverse all instances and samples
-        for instance_token in instance_tokens:
-            instance = self.nuscenes.get('instance', instance_token)
-            # verify if agent does not exist, if it does information was already retrieved
-            if agents.get(instance_token) is None:
-                print('new agent: ', instance_token) if self.verbose else None
-                # get head_annotation
-                first_annotation_token: str = instance['first_annotation_token']
-                first_annotation: dict = self.nuscenes.get('sample_annotation', first_annotation_token)
-                # tmp annotation to traverse them
-                tmp_annotation = first_annotation
-                # get the map_name of the agent
-                scene_token = self.nuscenes.get('sample', first_annotation['sample_token'])['scene_token']
-                scene = self.nuscenes.get('scene', scene_token)
-                location = self.nuscenes.get('log', scene['log_token'])['location']
-                # agent does not exist, create new agent
-                agent = NuscenesAgent(instance_token, scene_token, location)
-                agents[instance_token] = agent
-                agent.scene_token = scene_token
-
-                # traverse forward sample_annotations from first_annotation
-                while tmp_annotation is not None:
-                    sample_token = tmp_annotation['sample_token']
-                    # insert neighbors to corresponding context dictionary
-                    self.dataset.insert_context_neighbor(instance_token, sample_token)
-
-                    # get agent attributes tuple as: [0]-> pos_x, [1]-> pos_y, [2]-> rotation: list, [3]-> speed: float ,
-                    # [4]-> accel: float, [5]-> heading_rate: float, [6]-> ego_pose_x, [7]-> ego_pose_y, [8]-> ego_rotation : list
-                    attributes: tuple = self.__get_agent_attributes(tmp_annotation)
-                    # set attributes of agent
-                    agent_step = NuscenesAgentTimestep(attributes[0], attributes[1], attributes[2], attributes[3], attributes[4],
-                                                       attributes[5], attributes[6], attributes[7], attributes[8])
-                    agent.add_step(sample_token, agent_step)
-
-                    # move to next sample_annotation if possible
-                    try:
-                        tmp_annotation = self.nuscenes.get('sample_annotation', tmp_annotation['next'])
-                    except KeyError:
-                        tmp_annotation = None
+        for instance_token, (scene_token, location, context_ids, attributes) in zip(instance_tokens, tracks):
+            print('new agent: ', instance_token) if self.verbose else None
+            agent_id = self.dataset.agent_vocab.intern(instance_token)
+            # agent does not exist, create new agent
+            scene_id = self.dataset.scene_vocab.intern(scene_token)
+            agent = NuscenesAgent(agent_id, scene_id, location)
+            agents[agent_id] = agent
+            agent.scene_token = scene_id
+            for context_id, step_attributes in zip(context_ids, attributes.tolist()):
+                # insert neighbors to corresponding context dictionary
+                self.dataset.insert_context_neighbor(agent_id, context_id)
+                agent.add_step(context_id, NuscenesAgentTimestep(*step_attributes))
 
     def get_context_information(self):
         """
         function to get the context information. We ought to rember that context in this dataset is obtained from the
-        SAMPLE_ANNOTATION table. By the moment we obtain the pedestrians and obstacles information in a record of sample_annotation
-        (a record of an agent in time) and we store the SAMPLE_ANNOTATION TOKEN so we can then obtain any information that
-        is relevant to the model, like its position, its attributes, etc, by quering the database of this record.
+        SAMPLE_ANNOTATION table. This function builds a Context (with its map name) for each sample; humans, objects and
+        non prediction vehicles are read by load_context_categories once the prediction agents are known.
 
         :return: None
         """
-
-        def add_non_agent_info(collection: dict, sample_annotation):
-            sample_annotation_token = sample_annotation['token']
-            if collection.get(sample_annotation_token) is None:
-                collection[sample_annotation_token] = {
-                    'abs_pos': sample_annotation['translation'][0:2]
-                }
+        # scene token -> map name
+        locations = {}
         # traverse all timesteps
         for sample in self.nuscenes.sample:
             sample_token = sample['token']
             # get map name
-            scene_token = self.nuscenes.get('sample', sample_token)['scene_token']
-            scene = self.nuscenes.get('scene', scene_token)
-            location = self.nuscenes.get('log', scene['log_token'])['location']
+            scene_token = sample['scene_token']
+            location = locations.get(scene_token)
+            if location is None:
+                scene = self.nuscenes.get('scene', scene_token)
+                location = self.nuscenes.get('log', scene['log_token'])['location']
+                locations[scene_token] = location
             # build new Context object
-            self.dataset.contexts[sample_token] = Context(sample_token, location)
-            sample_annotation_tokens = sample['anns']
-
-            # get context information
-            for ann_token in sample_annotation_tokens:
-                sample_annotation = self.nuscenes.get('sample_annotation', ann_token)
-                # get the instance category
-                categories = sample_annotation['category_name'].split('.')
-
-                # add the token to the corresponding list if necessary
-                if categories[0] == 'human':
-                    #context['humans'].append(sample_annotation['token'])
-                    pass
-                elif categories[0] == ('movable_object' or 'static_object'):
-                    #context['objects'].append(sample_annotation['token'])
-                    pass
-                elif categories[0] == 'vehicle':
-                    #context['non_pred_neighbors'].add(sample_annotation['token'])
-                    pass
+            context_id = self.dataset.context_vocab.intern(sample_token)
+            self.dataset.contexts[context_id] = Context(context_id, location)
+
+    def load_context_categories(self):
+        """
+        fill the humans, objects (movable and static objects) and non prediction vehicles of each context with a single
+        pass over the sample_annotation table. Positions are stored as (n, 2) float32 arrays by context, the instances of
+        the non prediction vehicles are interned as agent ids in context.non_pred_neighbors. With NuscenesTables, the
+        columns of the table are used directly instead of traversing its records.
+        :return: None
+        """
+        groups = {'human': 0, 'movable_object': 1, 'static_object': 1, 'vehicle': 2}
+        if isinstance(self.nuscenes, NuscenesTables):
+            # instances are rows of the instance table
+            arrays = self.nuscenes.arrays['sample_annotation']
+            sample_tokens = self.nuscenes.arrays['sample']['token']
+            sample_contexts = np.array([self.dataset.context_vocab.lookup(token.decode()) for token in sample_tokens.tolist()],
+                                       dtype=np.int64).reshape(-1)
+            context_ids = np.where(arrays['sample_token'] >= 0, sample_contexts[arrays['sample_token']], -1)
+            category_groups = np.array([groups.get(str(name).split('.')[0], -1) for name in arrays['category_name_values']],
+                                       dtype=np.int8).reshape(-1)
+            group = category_groups[arrays['category_name']]
+            positions = arrays['translation'][:, :2].astype(np.float32)
+            instances = arrays['instance_token'].astype(np.int64)
+            instance_token = lambda instance: self.nuscenes.token('instance', instance)
+        else:
+            # instances are numbered in order of appearance
+            annotations = self.nuscenes.sample_annotation
+            n = len(annotations)
+            context_ids = np.zeros(n, dtype=np.int64)
+            group = np.full(n, -1, dtype=np.int8)
+            positions = np.zeros((n, 2), dtype=np.float32)
+            instances = np.zeros(n, dtype=np.int64)
+            instance_numbers = {}
+            for i, annotation in enumerate(annotations):
+                context_ids[i] = self.dataset.context_vocab.lookup(annotation['sample_token'])
+                group[i] = groups.get(annotation['category_name'].split('.')[0], -1)
+                positions[i] = annotation['translation'][:2]
+                instances[i] = instance_numbers.setdefault(annotation['instance_token'], len(instance_numbers))
+            instance_tokens = list(instance_numbers.keys())
+            instance_token = lambda instance: instance_tokens[instance]
+
+        # vehicles that are prediction agents are already neighbors of the context
+        vehicle_instances = np.unique(instances[group == 2])
+        agent_instances = [instance for instance in vehicle_instances.tolist()
+                           if self.dataset.agent_vocab.lookup(instance_token(instance)) in self.dataset.agents]
+        keep = (group >= 0) & (context_ids >= 0) & ~((group == 2) & np.isin(instances, agent_instances))
+        # sort by (context, group), so the annotations of a context and group are a contiguous range
+        rows = np.flatnonzero(keep)
+        rows = rows[np.lexsort((group[rows], context_ids[rows]))]
+        keys = context_ids[rows] * 3 + group[rows]
+        starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+        ends = np.append(starts[1:], len(rows))
+
+        # agent ids of the non prediction vehicles, interned in order of appearance
+        vehicle_rows = rows[group[rows] == 2]
+        vehicle_instances, first_rows = np.unique(instances[vehicle_rows], return_index=True)
+        vehicle_instances = vehicle_instances[np.argsort(first_rows)].tolist()
+        vehicle_ids = dict(zip(vehicle_instances, (self.dataset.agent_vocab.intern(instance_token(instance))
+                                                   for instance in vehicle_instances)))
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            range_rows = rows[start: end]
+            context: Context = self.dataset.contexts[int(context_ids[range_rows[0]])]
+            range_group = group[range_rows[0]]
+            if range_group == 0:
+                context.humans = positions[range_rows]
+            elif range_group == 1:
+                context.objects = positions[range_rows]
+            else:
+                for instance in instances[range_rows].tolist():
+                    context.add_non_pred_neighbor(vehicle_ids[instance])
+                context.non_pred_positions = positions[range_rows]
@@ -1,89 +1,284 @@
 
 # base class
 from Code.dataset.dataloader import Loader
+from Code.dataset.InputQuery import InputQuery
+from Code.dataset.Vocabulary import Vocabulary
+from Code.dataset.TrajectoryStore import STEP_FIELDS
+from Code.dataset.SpatialIndex import ContextSpatialIndex
 
 # data manipulation and tools
 import numpy as np
 from Code.dataset.DataModel import *
 import os
+import multiprocessing
+from collections import deque
 
 # shifts libraries
 from ysdc_dataset_api.dataset import MotionPredictionDataset
 from ysdc_dataset_api.features import FeatureRenderer
-from ysdc_dataset_api.utils import get_file_paths, scenes_generator, transform_2d_points, VehicleTrack
+from ysdc_dataset_api.utils import get_file_paths, scenes_generator, transform_2d_points, VehicleTrack, read_scene_from_file
 
 
+# ingest policies of the non prediction agents (see ShiftsLoader)
+NON_PRED_POLICIES = ('keep', 'drop', 'radius', 'positions')
+# bytes of a row of the TrajectoryStore (float32 columns, frame and agent), to estimate the memory of the ingest policies
+STORE_ROW_NBYTES = 4 * (len(STEP_FIELDS) + 2)
+
+
+# -------------------------------------------------------------- SCENE DECODING --------------------------------------------------------------
+def get_scene_arrays(scene, path) -> tuple:
+    """
+    plain numpy arrays of a scene, so scenes can be decoded in worker processes and added to a Dataset in file order.
+    :param scene : shifts Scene
+    :param path  : path of the scene file
+    :return      : scene id, path, ego (steps, 7) ego features, and one row by (timestep, track) in order of appearance:
+                   steps, track_ids, is_pred (track is a prediction request) and features (rows, 7) track features
+    """
+    # tracks of interest
+    prediction_requests_ids = {pr.track_id for pr in scene.prediction_requests}
+    # join past and future steps
+    timesteps = list(scene.past_vehicle_tracks) + list(scene.future_vehicle_tracks)
+    ego_steps = list(scene.past_ego_track) + list(scene.future_ego_track)
+    ego = np.array([(step.position.x, step.position.y, step.yaw, step.linear_velocity.x, step.linear_velocity.y,
+                     step.linear_acceleration.x, step.linear_acceleration.y) for step in ego_steps], dtype=np.float64).reshape(-1, 7)
+    tracks = [(i, track) for i, track_step in enumerate(timesteps[:len(ego_steps)]) for track in track_step.tracks]
+    steps = np.array([i for i, _ in tracks], dtype=np.int32)
+    track_ids = np.array([track.track_id for _, track in tracks], dtype=np.int64)
+    is_pred = np.array([track.track_id in prediction_requests_ids for _, track in tracks], dtype=bool)
+    features = np.array([(track.position.x, track.position.y, track.yaw, track.linear_velocity.x, track.linear_velocity.y,
+                          track.linear_acceleration.x, track.linear_acceleration.y) for _, track in tracks],
+                        dtype=np.float64).reshape(-1, 7)
+    return scene.id, path, ego, steps, track_ids, is_pred, features
+
+
+def near_rows(steps, is_pred, features, ego, radius) -> np.ndarray:
+    """
+    mask of the rows (see get_scene_arrays) within radius meters of the ego vehicle or of a prediction track at the same
+    step. The prediction tracks are found with a ContextSpatialIndex of cells of radius meters, so each row is only
+    compared with the prediction tracks of the neighbor cells of its step, not with all of them.
+    """
+    positions = features[:, :2]
+    near = np.hypot(*(positions - ego[steps, :2]).T) <= radius
+    pred = np.flatnonzero(is_pred)
+    if len(pred) > 0:
+        index = ContextSpatialIndex(steps[pred], pred, positions[pred, 0], positions[pred, 1], cell_size=radius)
+        nearest, _ = index.query(steps, positions, radius, 1)
+        near |= nearest[:, 0] >= 0
+    return near
+
+
+def decode_scenes(paths) -> list:
+    """ get_scene_arrays of the scene files of paths, read and decoded in this process """
+    return [get_scene_arrays(read_scene_from_file(path), path) for path in paths]
+
+
+def parallel_scenes_generator(filepaths, num_workers, chunksize=8):
+    """
+    generator of the get_scene_arrays of the scene files, in file order. A pool of processes reads and decodes groups of
+    chunksize files, and groups are submitted as the previous ones are consumed, so at most 2 * num_workers groups are
+    read ahead. The workers read the files they decode (read_scene_from_file): the thread pool reader that prefetches
+    the raw files is not implemented, and the scenes are still added to the dataset (ShiftsLoader.add_scene) serially in
+    the parent process.
+    """
+    # workers are forked on every platform, as the other loader pools (see NuscenesLoader.load_data)
+    with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+        pending = deque()
+        for start in range(0, len(filepaths), chunksize):
+            pending.append(pool.apply_async(decode_scenes, (filepaths[start: start + chunksize],)))
+            if len(pending) >= 2 * num_workers:
+                yield from pending.popleft().get()
+        while len(pending) > 0:
+            yield from pending.popleft().get()
+
+
+def scene_arrays_generator(filepaths, num_workers=1):
+    """ generator of the get_scene_arrays of the scene files, in file order, decoded by num_workers processes if > 1 """
+    if num_workers > 1:
+        return parallel_scenes_generator(filepaths, num_workers)
+    return (get_scene_arrays(scene, path) for scene, path in scenes_generator(filepaths, yield_fpath=True))
+
+
+def stream_samples(DATAROOT, inp_seq_l, tar_seq_l, N, chunk=(0, 1000), offset=-1, bitmap_extractor: BitmapFeature = None,
+                   path='maps', num_workers=1, columnar=False, **kwargs):
+    """
+    generator of the samples of the scenes of the files chunk[0], ..., chunk[1] - 1 of DATAROOT, without loading the chunk.
+    Shifts scenes are self contained (one ego vehicle with its past and future tracks), so each scene is loaded alone
+    (see ShiftsSceneLoader), its samples are extracted and yielded and the scene is released before the next one is read.
+    Memory does not grow with the number of scenes and the first samples are available after the first scene.
+    :param num_workers : processes that decode the scene files (see scene_arrays_generator)
+    :param columnar    : keep the timesteps of each scene in a TrajectoryStore (see Loader)
+    :param kwargs      : rest of the parameters of InputQuery.get_TransformerCube_Input
+    :return            : generator of the sample dictionaries of InputQuery.get_TransformerCube_Input, in file order. They
+                         are the same samples get_TransformerCube_Input returns for a ShiftsLoader of the same chunk
+    """
+    filepaths = get_file_paths(DATAROOT)[chunk[0]: chunk[1]]
+    # shared by all the scenes, so the ids of the ego vehicles (agent_id of the samples) are the ids of a chunk loader
+    scene_vocab = Vocabulary()
+    for scene_arrays in scene_arrays_generator(filepaths, num_workers):
+        scene_loader = ShiftsSceneLoader(scene_arrays, scene_vocab, columnar)
+        yield from InputQuery(scene_loader).get_TransformerCube_Input(inp_seq_l, tar_seq_l, N, offset,
+                                                                      bitmap_extractor=bitmap_extractor, path=path, **kwargs)
+
+
+# -------------------------------------------------------------- SHIFTS LOADER CLASS --------------------------------------------------------------
 class ShiftsLoader(Loader):
-    def __init__(self, DATAROOT, pickle=True, pickle_filename='/data/shifts/data.pkl', chunk=(0, 1000), verbose=True):
-        # super constructor
-        super(ShiftsLoader, self).__init__(DATAROOT, verbose)
-        self.renderer = None
+    def __init__(self, DATAROOT, pickle=True, pickle_filename='/data/shifts/data.pkl', chunk=(0, 1000), verbose=True,
+                 columnar=False,
+                 memmap=False,
+                 max_resident_scenes=None,
+                 num_workers=1,
+                 non_pred_policy='keep',
+                 non_pred_radius=50.,
+                 cache_dir=None,
+                 cache_max_bytes=None):
+        """
+        :param columnar        : keep the timesteps in a TrajectoryStore (see Loader). Off by default, so stored pickles
+                                 keep the object model
+        :param num_workers     : number of processes that decode the scene files when data is loaded from scratch (see load_data)
+        :param non_pred_policy : what is stored of the tracks that are not prediction requests (InputQuery does not read them)
+                                 'keep'      : all their steps in dataset.non_pred_agents
+                                 'drop'      : nothing
+                                 'radius'    : only their steps within non_pred_radius meters of the ego vehicle or of a
+                                               prediction agent
+                                 'positions' : only their x, y in context.non_pred_positions (in the order of
+                                               context.non_pred_neighbors), no agent objects
+        :param cache_dir       : directory of the loader cache (see Loader). If given, pickle_filename is ignored
+        """
+        self.init_loader(DATAROOT, verbose, columnar, non_pred_policy, non_pred_radius, memmap, max_resident_scenes, cache_dir,
+                         cache_max_bytes)
+        # processed data of these parameters in the loader cache, if any (see Loader.cache_filename)
+        pickle_filename = self.cache_filename(pickle_filename, chunk=list(chunk), non_pred_policy=non_pred_policy,
+                                              non_pred_radius=non_pred_radius if non_pred_policy == 'radius' else None)
         # flag to indicate if data can be loaded from pickle files
-        pickle_ok: bool = os.path.isfile(pickle_filename)
+        pickle_ok: bool = self.saved_data_exists(pickle_filename)
 
         if pickle and pickle_ok:
             # its okay to read pickle files to load data
-            self.load_pickle_data(pickle_filename)
+            self.read_data(pickle_filename)
         else:
             # load data from scratch
-            self.load_data(chunk)
-            self.save_pickle_data(pickle_filename)
+            self.load_data(chunk, num_workers)
+            self.save_data(pickle_filename)
 
         ShiftsAgent.context_dict = self.dataset.contexts
 
-    def load_ego_vehicles_and_context(self, ego_id, ego_steps, location=None):
+    def init_loader(self, DATAROOT, verbose, columnar, non_pred_policy, non_pred_radius, *loader_args):
+        """ setup shared by the shifts loaders: base Loader (with the rest of its parameters) and non prediction agents policy """
+        if non_pred_policy not in NON_PRED_POLICIES:
+            raise ValueError('unknown non prediction agents policy: ' + str(non_pred_policy))
+        # super constructor
+        Loader.__init__(self, DATAROOT, verbose, columnar, *loader_args)
+        self.renderer = None
+        self.non_pred_policy = non_pred_policy
+        self.non_pred_radius = non_pred_radius
+        # rows of non prediction tracks read, stored as steps and stored as positions (see load_data)
+        self.non_pred_rows = {'read': 0, 'steps': 0, 'positions': 0}
+
+    def load_ego_vehicles_and_context(self, scene_id, ego_steps: np.ndarray, location=None):
+        """ add the ego vehicle of a scene and one context by step (rows of ego_steps). Returns the ids of the contexts of the scene """
+        ego_id = self.dataset.scene_vocab.intern(scene_id)
         ego_vehicle = ShiftsEgoVehicle(ego_id, location)
         self.dataset.add_ego_vehicle(ego_id, ego_vehicle)
+        context_ids = []
 
-        for i, step in enumerate(ego_steps):
+        for i, step in enumerate(ego_steps.tolist()):
             # step_id should be the id of the context object in the Context scene
-            step_id = ego_id + '_' + str(i)
+            step_id = self.dataset.context_vocab.intern(scene_id + '_' + str(i))
             self.dataset.add_context(step_id, Context(step_id))
-            step = ShiftsEgoStep(step.position.x, step.position.y, step.yaw, step.linear_velocity.x,
-                                 step.linear_velocity.y, step.linear_acceleration.x, step.linear_acceleration.y)
-            ego_vehicle.add_step(step_id, step)
-
-    def load_data(self, chunk=(0, 1000)):
-        def get_step(track, ego):
-            agent_step = ShiftTimeStep(track.position.x, track.position.y, track.yaw, track.linear_velocity.x,
-                                       track.linear_velocity.y, track.linear_acceleration.x, track.linear_acceleration.y,
-                                       ego.position.x, ego.position.y, ego.yaw)
-            return agent_step
-
-        filepaths = get_file_paths(self.DATAROOT)
-        scenes_paths = scenes_generator(filepaths[chunk[0]: chunk[1]], yield_fpath=True)
+            ego_vehicle.add_step(step_id, ShiftsEgoStep(*step))
+            context_ids.append(step_id)
+        return ego_id, context_ids
+
+    def add_scene(self, scene_arrays: tuple):
+        """ add the ego vehicle, contexts and agents of a scene (see get_scene_arrays) """
+        scene_id, path, ego, steps, track_ids, is_pred, features = scene_arrays
+        # load ego vehicle and contexts of the scene
+        ego_id, context_ids = self.load_ego_vehicles_and_context(scene_id, ego, location=path)
+        ego_positions = ego[:, :3].tolist()
+        # track_id -> agent id, so each track of the scene is interned only once
+        scene_agents = {}
+        # non prediction rows stored as steps and as positions, by the ingest policy
+        as_steps = ~is_pred if self.non_pred_policy == 'keep' else np.zeros(len(is_pred), dtype=bool)
+        if self.non_pred_policy == 'radius':
+            as_steps = ~is_pred & near_rows(steps, is_pred, features, ego, self.non_pred_radius)
+        as_positions = ~is_pred if self.non_pred_policy == 'positions' else np.zeros(len(is_pred), dtype=bool)
+        self.non_pred_rows['read'] += int(np.count_nonzero(~is_pred))
+        self.non_pred_rows['steps'] += int(np.count_nonzero(as_steps))
+        self.non_pred_rows['positions'] += int(np.count_nonzero(as_positions))
+        positions = {}
+
+        # traverse all agents of each timestep
+        for i, track_id, pred, track_features, step, position in zip(steps.tolist(), track_ids.tolist(), is_pred.tolist(),
+                                                                     features.tolist(), as_steps.tolist(), as_positions.tolist()):
+            if not (pred or step or position):
+                continue
+            context_id = context_ids[i]
+            # build a unique agent id in all dataset
+            agent_id = scene_agents.get(track_id)
+            if agent_id is None:
+                agent_id = self.dataset.agent_vocab.intern(scene_id + '_' + str(track_id))
+                scene_agents[track_id] = agent_id
+            # non prediction agent that only keeps its position in the context
+            if position:
+                self.dataset.contexts[context_id].add_non_pred_neighbor(agent_id)
+                positions.setdefault(context_id, []).append(track_features[:2])
+                continue
+            agent_step = ShiftTimeStep(*track_features, *ego_positions[i])
+            # if agent IS NOT A CANDIDATE FOR PREDICTION, add as non prediction agent
+            if not pred:
+                # CREATE agent if does not exist. Use path as map name (SEE ShitAgent doc)
+                if self.dataset.non_pred_agents.get(agent_id) is None:
+                    self.dataset.non_pred_agents[agent_id] = ShiftsAgent(agent_id, ego_id, path)
+                # insert timestep, step_id = context_id
+                self.dataset.non_pred_agents[agent_id].add_step(context_id, agent_step)
+                # insert as non prediction neighbor
+                self.dataset.contexts[context_id].add_non_pred_neighbor(agent_id)
+            else:
+                # CREATE agent if does not exist. Use path as map name (SEE ShitAgent doc)
+                if self.dataset.agents.get(agent_id) is None:
+                    print('new agent: ', self.dataset.agent_vocab.token(agent_id)) if self.verbose else None
+                    self.dataset.agents[agent_id] = ShiftsAgent(agent_id, ego_id, path)
+                # insert timestep, step_id = context_id
+                self.dataset.agents[agent_id].add_step(context_id, agent_step)
+                # insert agent as neighbor (scene.id + i = context_id or same as step_id)
+                self.dataset.contexts[context_id].add_pred_neighbor(agent_id)
+
+        for context_id, context_positions in positions.items():
+            self.dataset.contexts[context_id].non_pred_positions = np.array(context_positions, dtype=np.float32)
+
+    def load_data(self, chunk=(0, 1000), num_workers=1):
+        """
+        load the scenes of the files chunk[0], ..., chunk[1] - 1 of DATAROOT.
+        :param num_workers : if > 1, num_workers processes read and decode groups of files, at most 2 * num_workers groups
+                             ahead of the scene being added (see parallel_scenes_generator). Scenes are added serially in
+                             file order, so the dataset is the same for any number of workers.
+        :return: None
+        """
+        filepaths = get_file_paths(self.DATAROOT)[chunk[0]: chunk[1]]
         # traverse scenes
-        for scene, path in scenes_paths:
-            #get tracks of interest
-            prediction_requests_ids = {pr.track_id for pr in scene.prediction_requests}
-            # join past and future steps
-            timesteps = list(scene.past_vehicle_tracks) + list(scene.future_vehicle_tracks)
-            ego_steps = list(scene.past_ego_track) + list(scene.future_ego_track)
-            # load ego vehicle and contexts of the scene
-            self.load_ego_vehicles_and_context(scene.id, ego_steps, location=path)
-
-            # traverse each past timestep
-            for i, (track_step, ego_step) in enumerate(zip(timesteps, ego_steps)):
-                context_id = scene.id + '_' + str(i)
-                # traverse all agents
-                for track in track_step.tracks:
-                    # build a unique agent id in all dataset
-                    agent_id = scene.id + '_' + str(track.track_id)
-                    # if agent IS NOT A CANDIDATE FOR PREDICTION, add as non prediction agent
-                    if track.track_id not in prediction_requests_ids:
-                        # CREATE agent if does not exist. Use path as map name (SEE ShitAgent doc)
-                        if self.dataset.non_pred_agents.get(agent_id) is None:
-                            self.dataset.non_pred_agents[agent_id] = ShiftsAgent(agent_id, scene.id, path)
-                        # insert timestep, step_id = context_id
-                        self.dataset.non_pred_agents[agent_id].add_step(context_id, get_step(track, ego_step))
-                        # insert as non prediction neighbor
-                        self.dataset.contexts[context_id].add_non_pred_neighbor(agent_id)
-                    else:
-                        # CREATE agent if does not exist. Use path as map name (SEE ShitAgent doc)
-                        if self.dataset.agents.get(agent_id) is None:
-                            print('new agent: ', agent_id) if self.verbose else None
-                            self.dataset.agents[agent_id] = ShiftsAgent(agent_id, scene.id, path)
-                        # insert timestep, step_id = context_id
-                        self.dataset.agents[agent_id].add_step(context_id, get_step(track, ego_step))
-                        # insert agent as neighbor (scene.id + i = context_id or same as step_id)
-                        self.dataset.contexts[context_id].add_pred_neighbor(agent_id)
+        for scene_arrays in scene_arrays_generator(filepaths, num_workers):
+            self.add_scene(scene_arrays)
+
+        # estimated memory of the non prediction rows that are not stored as steps of the trajectory store (store rows
+        # only, the agent objects and dictionaries of the rows are not counted; it is not a measured figure)
+        rows = self.non_pred_rows
+        saved = (rows['read'] - rows['steps']) * STORE_ROW_NBYTES - rows['positions'] * 2 * 4
+        print('[MSG] non prediction agents (' + self.non_pred_policy + '):', rows['steps'], 'of', rows['read'], 'rows stored as steps,',
+              rows['positions'], 'as positions.', '~' + str(round(saved / 2 ** 20, 2)), 'MB saved (estimate)') if self.verbose else None
+
+
+class ShiftsSceneLoader(ShiftsLoader):
+    """
+    ShiftsLoader of a single scene, built from its get_scene_arrays and never stored (see stream_samples). The scene
+    vocabulary can be shared by the scenes of a stream so the ids of their ego vehicles do not collide. Its non prediction
+    agents are dropped by default (see ShiftsLoader non_pred_policy), samples do not use them.
+    """
+    def __init__(self, scene_arrays: tuple, scene_vocab: Vocabulary = None, columnar=False, non_pred_policy='drop',
+                 non_pred_radius=50.):
+        self.init_loader(None, False, columnar, non_pred_policy, non_pred_radius)
+        self.dataset.verbose = False
+        if scene_vocab is not None:
+            self.dataset.scene_vocab = scene_vocab
+        self.add_scene(scene_arrays)
+        if columnar:
+            self.dataset.compact()
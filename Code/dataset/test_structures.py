@@ -0,0 +1,318 @@
+"""This file contains behaviour checks of the dataset structures: each vectorized or stored path gives the same values as
+   the loop or object path it replaces. Run them with python -m pytest Code/dataset/test_structures.py. The checks that
+   build a Dataset need the shifts api that DataModel.py imports, they are skipped without it.
+"""
+
+import numpy as np
+import pytest
+from Code.dataset.TrajectoryStore import TrajectoryStore, ColumnarTimesteps, STEP_FIELDS
+from Code.dataset.SpatialIndex import ContextSpatialIndex
+from Code.dataset.SampleCatalog import SampleCatalog, sample_row
+from Code.dataset.SampleStore import SampleStore, ShardWriter
+
+
+# -------------------------------------------------------------- DATA --------------------------------------------------------------
+def synthetic_dataset(num_scenes=5, agents_by_scene=6, steps_by_scene=30, seed=0):
+    """ shifts like Dataset of benchmarks.py """
+    pytest.importorskip('ysdc_dataset_api')
+    from Code.dataset.benchmarks import build_synthetic_dataset
+    return build_synthetic_dataset(num_scenes, agents_by_scene, steps_by_scene, seed)
+
+
+def synthetic_samples(num_samples=40, seq_l=20, inp_seq_l=10, N=4, seed=0):
+    """ sample dictionaries with the keys of InputQuery.get_TransformerCube_Input """
+    rng = np.random.default_rng(seed)
+    samples = []
+    for i in range(num_samples):
+        full_traj = rng.normal(size=(seq_l, N, 5))
+        mask = (rng.random((seq_l, N)) < 0.3).astype(np.float64)
+        mask[:, 0] = 0
+        samples.append({'past_neighMask': mask[:inp_seq_l], 'future_neighMask': mask[inp_seq_l - 1:],
+                        'past_seqMask': np.zeros(inp_seq_l), 'full_traj': full_traj, 'origin': rng.normal(size=3) * 10,
+                        'ego_id': 'sample' + str(i), 'scene': 'scene' + str(i % 5), 'map_name': [None, 'a', 'b'][i % 3]})
+    return samples
+
+
+class Step:
+    """ timestep with some of the STEP_FIELDS, as the timestep classes of DataModel.py """
+    def __init__(self, x, y, rot):
+        self.x, self.y, self.rot = x, y, rot
+
+
+class Track:
+    def __init__(self, ego_id, timesteps):
+        self.ego_id = ego_id
+        self.timesteps = timesteps
+
+
+# -------------------------------------------------------------- TRAJECTORY STORE --------------------------------------------------------------
+def test_store_keeps_the_timesteps_of_the_agents():
+    rng = np.random.default_rng(0)
+    tracks = [Track(a % 2, {int(frame): Step(*rng.normal(size=3)) for frame in rng.permutation(50)[:rng.integers(1, 20)]})
+              for a in range(8)]
+    store = TrajectoryStore.from_agents(tracks)
+    assert len(store) == sum(len(track.timesteps) for track in tracks)
+    for a, track in enumerate(tracks):
+        timesteps = ColumnarTimesteps(store, a)
+        # same step ids, in insertion order
+        assert list(timesteps) == list(track.timesteps)
+        for field in ('x', 'y', 'rot'):
+            np.testing.assert_allclose(timesteps.column(field), [getattr(step, field) for step in track.timesteps.values()],
+                                       rtol=1e-6)
+        # fields the timestep class does not define are nan
+        assert np.isnan(timesteps.column('speed')).all()
+        step_id = next(iter(track.timesteps))
+        step = timesteps[step_id]
+        assert type(step) is Step and set(vars(step)) == {'x', 'y', 'rot'}
+        assert step.x == pytest.approx(track.timesteps[step_id].x, rel=1e-6)
+    assert store.agent_scene.tolist() == [a % 2 for a in range(8)]
+    assert set(store.columns) == set(STEP_FIELDS)
+
+
+def test_compact_dataset_keeps_the_values_of_the_objects():
+    dataset = synthetic_dataset()
+    objects = {agent_id: {step_id: vars(step).copy() for step_id, step in agent.timesteps.items()}
+               for agent_id, agent in dataset.agents.items()}
+    dataset.compact()
+    for agent_id, agent in dataset.agents.items():
+        assert list(agent.timesteps) == list(objects[agent_id])
+        for step_id, values in objects[agent_id].items():
+            step = vars(agent.timesteps[step_id])
+            assert set(step) == set(values)
+            # the store keeps float32 values
+            np.testing.assert_allclose([step[name] for name in values], list(values.values()), rtol=1e-6, atol=1e-6)
+
+
+# -------------------------------------------------------------- POSITIONAL INDEX --------------------------------------------------------------
+def test_step_index_is_the_position_of_each_timestep():
+    dataset = synthetic_dataset()
+    from Code.dataset.DataModel import ShiftTimeStep
+    for compacted in (False, True):
+        if compacted:
+            dataset.compact()
+        for agent in list(dataset.agents.values()) + list(dataset.ego_vehicles.values()):
+            step_ids, positions = agent.step_index()
+            assert step_ids.tolist() == list(agent.timesteps.keys())
+            assert positions == {step_id: i for i, step_id in enumerate(agent.timesteps.keys())}
+            np.testing.assert_array_equal(agent.step_column('x'), [step.x for step in agent.timesteps.values()])
+
+    # the index of an object agent is rebuilt when steps are added
+    dataset = synthetic_dataset()
+    agent = next(iter(dataset.agents.values()))
+    agent.step_index()
+    new_step_id = max(dataset.contexts.keys()) + 1
+    agent.add_step(new_step_id, ShiftTimeStep(*np.zeros(10)))
+    step_ids, positions = agent.step_index()
+    assert step_ids[-1] == new_step_id and positions[new_step_id] == len(step_ids) - 1
+
+
+# -------------------------------------------------------------- WINDOWS --------------------------------------------------------------
+def loop_windows(dataset, use_ego_vehicles, L, overlap, min_neighbors):
+    """ windows of the per step loop that get_trajectory_windows replaces, sorted by ego vehicle and start """
+    windows = []
+    for ego_id, ego_vehicle in (dataset.ego_vehicles if use_ego_vehicles else dataset.agents).items():
+        timesteps = list(ego_vehicle.timesteps.keys())
+        if L == -1:
+            windows.append((ego_id, 0, len(timesteps)))
+            continue
+        start, end = 0, L
+        while end <= len(timesteps):
+            if len(dataset.contexts[timesteps[start]].neighbors) < min_neighbors:
+                start += 1
+                end += 1
+                continue
+            windows.append((ego_id, start, end))
+            start = end - overlap
+            end = start + L
+    return sorted(windows)
+
+
+@pytest.mark.parametrize('use_ego_vehicles', [True, False])
+@pytest.mark.parametrize('L, overlap, min_neighbors', [(-1, 0, 0), (10, 0, 0), (10, 5, 0), (7, 3, 4), (12, 11, 5)])
+def test_windows_are_the_ones_of_the_per_step_loop(use_ego_vehicles, L, overlap, min_neighbors):
+    dataset = synthetic_dataset()
+    expected = loop_windows(dataset, use_ego_vehicles, L, overlap, min_neighbors)
+    assert dataset.get_trajectory_windows(use_ego_vehicles, L, overlap, min_neighbors).tolist() == [list(w) for w in expected]
+    dataset.compact()
+    windows = dataset.get_trajectories_indexes(use_ego_vehicles, L, overlap, min_neighbors)
+    assert windows.tolist() == [list(w) for w in expected]
+    # idempotent: indexes are replaced, not appended
+    dataset.get_trajectories_indexes(use_ego_vehicles, L, overlap, min_neighbors)
+    ego_vehicles = dataset.ego_vehicles if use_ego_vehicles else dataset.agents
+    assert sum(len(ego_vehicle.indexes) for ego_vehicle in ego_vehicles.values()) == len(expected)
+
+
+def window_queries(L):
+    """ InputQuery of the object model and of the compact dataset, with the windows of the dataset """
+    objects_loader, columnar_loader = type('TestLoader', (), {})(), type('TestLoader', (), {})()
+    objects_loader.dataset = synthetic_dataset()
+    from Code.dataset.InputQuery import InputQuery
+    columnar_loader.dataset = synthetic_dataset()
+    columnar_loader.dataset.compact()
+    return InputQuery(objects_loader), InputQuery(columnar_loader), columnar_loader.dataset.get_trajectory_windows(L=L,
+                                                                                                                  overlap=L // 2)
+
+
+@pytest.mark.parametrize('offset', [0, 5, 9, -3])
+def test_batch_windows_are_the_inputs_of_the_object_model(offset, L=10, N=4):
+    objects_query, columnar_query, windows = window_queries(L)
+    inputs, masks, origins = columnar_query.get_window_inputs(windows, L, N, offset=offset)
+    assert len(windows) > 0 and inputs.shape == (len(windows), L, N, 5)
+    ego_vehicles = objects_query.dataset.ego_vehicles
+    for w, (ego_id, start, end) in enumerate(windows.tolist()):
+        inputTensor, inputMask, _, origin = objects_query.get_egocentered_input(ego_vehicles[ego_id], objects_query.dataset.agents,
+                                                                                L, N, offset=offset, window=(start, end))
+        # the object model keeps float64 values, the store float32
+        np.testing.assert_allclose(inputs[w], inputTensor, atol=1e-4)
+        np.testing.assert_array_equal(masks[w], inputMask)
+        np.testing.assert_allclose(origins[w], origin, atol=1e-4)
+
+
+@pytest.mark.parametrize('offset', [10, -11])
+def test_batch_windows_reject_an_origin_outside_the_window(offset, L=10, N=4):
+    _, columnar_query, windows = window_queries(L)
+    with pytest.raises(ValueError):
+        columnar_query.get_window_inputs(windows, L, N, offset=offset)
+
+
+# -------------------------------------------------------------- SPATIAL INDEX --------------------------------------------------------------
+@pytest.mark.parametrize('cell_size', [2., 10., 50.])
+def test_spatial_index_finds_the_nearest_agents_of_a_brute_force_search(cell_size):
+    rng = np.random.default_rng(0)
+    points = 2000
+    frames = rng.integers(0, 10, points)
+    agent_ids = np.arange(points)
+    x, y = rng.uniform(-100, 100, points), rng.uniform(-100, 100, points)
+    x[::50] = np.nan
+    index = ContextSpatialIndex(frames, agent_ids, x, y, cell_size)
+    query_frames = rng.integers(0, 11, 200)
+    centers = rng.uniform(-120, 120, (200, 2))
+    radius, k = 15., 5
+    ids, distances = index.query(query_frames, centers, radius, k)
+    for q in range(200):
+        distance = np.hypot(x.astype(np.float32) - centers[q, 0], y.astype(np.float32) - centers[q, 1])
+        candidates = np.flatnonzero((frames == query_frames[q]) & (distance <= radius))
+        expected = candidates[np.argsort(distance[candidates], kind='stable')][:k]
+        found = ids[q][ids[q] >= 0]
+        np.testing.assert_allclose(np.sort(distances[q][:len(found)]), np.sort(distance[expected]), rtol=1e-5)
+        assert set(found.tolist()) == set(expected.tolist())
+        assert np.all(np.diff(distances[q][:len(found)]) >= 0)
+        assert np.all(np.isinf(distances[q][len(found):]))
+
+
+# -------------------------------------------------------------- DATASET FILES --------------------------------------------------------------
+@pytest.mark.parametrize('max_resident_scenes', [None, 2])
+def test_stored_dataset_opens_with_the_same_agents_and_contexts(tmp_path, max_resident_scenes):
+    dataset = synthetic_dataset()
+    from Code.dataset.DatasetFile import save_dataset, open_dataset
+    context = next(iter(dataset.contexts.values()))
+    context.non_pred_positions = np.array([[1., 2.], [3., 4.]], dtype=np.float32)
+    save_dataset(dataset, str(tmp_path / 'dataset'))
+    opened = open_dataset(str(tmp_path / 'dataset'), verbose=False, max_resident_scenes=max_resident_scenes)
+
+    for name in ('agent_vocab', 'context_vocab', 'scene_vocab'):
+        assert [str(token) for token in getattr(opened, name).tokens] == [str(t) for t in getattr(dataset, name).tokens]
+    for collection_name in ('ego_vehicles', 'agents', 'non_pred_agents'):
+        collection, opened_collection = getattr(dataset, collection_name), getattr(opened, collection_name)
+        assert list(opened_collection) == list(collection)
+        for agent_id, agent in collection.items():
+            opened_agent = opened_collection[agent_id]
+            assert type(opened_agent) is type(agent)
+            assert (opened_agent.agent_id, opened_agent.ego_id, opened_agent.map_name) == (agent.agent_id, agent.ego_id,
+                                                                                           agent.map_name)
+            assert list(opened_agent.timesteps) == list(agent.timesteps)
+            for field in STEP_FIELDS:
+                np.testing.assert_array_equal(opened_agent.step_column(field), agent.step_column(field))
+    assert list(opened.contexts) == list(dataset.contexts)
+    for context_id, context in dataset.contexts.items():
+        opened_context = opened.contexts[context_id]
+        assert list(opened_context.neighbors) == list(context.neighbors)
+        assert list(opened_context.non_pred_neighbors) == list(context.non_pred_neighbors)
+        assert opened_context.map == context.map
+        np.testing.assert_array_equal(opened_context.non_pred_positions, context.non_pred_positions)
+    np.testing.assert_array_equal(opened.neighbor_counts(), dataset.neighbor_counts())
+
+
+# -------------------------------------------------------------- SAMPLE CATALOG --------------------------------------------------------------
+@pytest.mark.parametrize('conditions', [{'map_name': 'a'}, {'map_name': None}, {'map_name': ['b', 'unknown']},
+                                        {'scene': 'scene1', 'num_neighbors': (2, None)},
+                                        {'mean_speed': (None, 1.5), 'origin_x': (-5., 5.)}, {'num_neighbors': 3},
+                                        {'map_name': 'unknown'}])
+def test_catalog_selects_the_samples_of_a_linear_scan(conditions, tmp_path):
+    samples = synthetic_samples()
+    rows = [sample_row(sample) for sample in samples]
+
+    def matches(row, name, condition):
+        if name in ('name', 'scene', 'map_name'):
+            return row[name] in (condition if isinstance(condition, list) else [condition])
+        low, high = condition if isinstance(condition, tuple) else (condition, condition)
+        value = np.float32(row[name]) if name != 'num_neighbors' else row[name]
+        return (low is None or value >= low) and (high is None or value <= high)
+
+    expected = [i for i, row in enumerate(rows) if all(matches(row, name, c) for name, c in conditions.items())]
+    catalog = SampleCatalog.from_samples(samples)
+    assert catalog.select(**conditions).tolist() == expected
+    catalog.save(str(tmp_path / 'catalog.npz'))
+    assert SampleCatalog.load(str(tmp_path / 'catalog.npz')).select(**conditions).tolist() == expected
+
+
+def test_store_catalog_is_the_catalog_of_its_samples(tmp_path):
+    samples = synthetic_samples()
+    store = SampleStore(str(tmp_path / 'store'))
+    store.append('first', samples[:15])
+    with ShardWriter(store, 'second', shard_size=7) as writer:
+        for sample in samples[15:]:
+            writer.write(sample)
+    expected = SampleCatalog.from_samples(samples)
+    catalog = store.build_catalog()
+    for name, column in expected.columns.items():
+        np.testing.assert_array_equal(catalog.columns[name], column)
+    assert store.catalog() is not None and len(store.catalog()) == len(samples)
+    assert catalog.get([0, 1, 2], 'map_name') == [None, 'a', 'b']
+
+
+# -------------------------------------------------------------- SAMPLE STORE --------------------------------------------------------------
+def same_samples(samples, expected):
+    assert len(samples) == len(expected)
+    for sample, expected_sample in zip(samples, expected):
+        assert sample['ego_id'] == expected_sample['ego_id']
+        np.testing.assert_array_equal(sample['full_traj'], expected_sample['full_traj'])
+
+
+def test_interrupted_writer_resumes_after_the_written_shards(tmp_path):
+    samples = synthetic_samples(num_samples=23)
+    store = SampleStore(str(tmp_path / 'store'))
+    with pytest.raises(KeyboardInterrupt):
+        with ShardWriter(store, 'source', shard_size=5) as writer:
+            for i, sample in enumerate(samples):
+                if i == 13:
+                    raise KeyboardInterrupt
+                writer.write(sample)
+    # the two full shards are kept, the partial third one is lost and the source is not complete
+    store = SampleStore(str(tmp_path / 'store'))
+    assert len(store) == 10 and not store.is_complete('source')
+
+    writer = ShardWriter(store, 'source', shard_size=5)
+    assert writer.skip == 10
+    writer.write_all(samples[writer.skip:])
+    store = SampleStore(str(tmp_path / 'store'))
+    assert store.is_complete('source') and len(store) == len(samples)
+    assert store.chunk_names() == ['source_shard' + str(k).zfill(5) for k in range(5)]
+    same_samples(store.load(), samples)
+    same_samples(store.take([22, 0, 11]), [samples[22], samples[0], samples[11]])
+    # a complete source has nothing left to extract
+    assert ShardWriter(store, 'source', shard_size=5).skip == len(samples)
+
+
+def test_store_keeps_the_chunks_of_every_writer(tmp_path):
+    samples = synthetic_samples(num_samples=12)
+    first, second = SampleStore(str(tmp_path / 'store')), SampleStore(str(tmp_path / 'store'))
+    first.append(0, samples[:4])
+    second.append(1, samples[4:8])
+    first.append(2, samples[8:])
+    with pytest.raises(ValueError):
+        second.append(1, samples[4:8])
+    store = SampleStore(str(tmp_path / 'store'))
+    assert store.chunk_names() == ['0', '1', '2'] and all(store.is_complete(chunk) for chunk in range(3))
+    same_samples(store.load(), samples)
+    same_samples(store.load(['2', '0']), samples[:4] + samples[8:])
@@ -13,6 +13,7 @@ from Code.models.VAE_ModelTraj import STTransformer
 # from Code.models.RNN_Transformer import STTransformer
 from Code.models.AgentFormer import STE_Transformer
 from Code.dataset.dataset import buildDataset
+from Code.dataset.SampleStore import load_samples
 from Code.utils.save_utils import load_pkl_data, save_pkl_data, valid_file, valid_path, load_parameters
 from Code.eval.quantitative_eval import ADE, FDE
 from Code.eval.qualitative_eval import stamp_traj
@@ -298,8 +299,8 @@ if __name__ == '__main__':
     lr = training_params['lr']
 
     # GET DATA
-    data = load_pkl_data(data_params['data_path'])
-    eval_data = load_pkl_data(data_params['eval_data_path'])
+    data = load_samples(data_params['data_path'])
+    eval_data = load_samples(data_params['eval_data_path'])
 
     # GET DATASETS
     strategy = tf.distribute.MirroredStrategy()